@@ -0,0 +1,115 @@
+"""
+Micro-benchmark of the Kafka message decode stage.
+
+Encodes the same synthetic events in every wire format (lenient: the current
+escaped JSON string, json: a plain JSON object, binary: the fixed-width record),
+optionally corrupts a share of them, and times pipeline.decode over a cached
+DataFrame of message values in Spark local mode. Reports the cost per million
+messages and checks that every format decodes to the same transactions.
+
+    python bench/decode_benchmark.py --messages 500000 --malformed 0.01
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, 'python', 'src')
+LOOKUP_CSV = os.path.join(ROOT, 'look_up_table.csv')
+ZIP_CSV = os.path.join(SRC, 'db', 'uszipsv.csv')
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SRC)
+
+from generator import TransactionGenerator
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=200000, help='messages per format')
+    parser.add_argument('--malformed', type=float, default=0.01, help='share of corrupted messages')
+    parser.add_argument('--formats', default='lenient,json,binary', help='comma-separated wire formats')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per format, the best one counts')
+    parser.add_argument('--cores', type=int, default=os.cpu_count() or 2, help='Spark local cores')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default=None, help='result JSON')
+    return parser.parse_args()
+
+
+def encode_all(events, wire_format, malformed, seed):
+    """Encoded message values, with every 1/malformed-th one truncated."""
+    if wire_format == 'binary':
+        values = [TransactionGenerator.encode_binary(event) for event in events]
+    else:
+        values = [TransactionGenerator.encode(event, escaped=wire_format == 'lenient').encode('utf-8')
+                  for event in events]
+    if malformed > 0:
+        step = max(int(1 / malformed), 1)
+        for i in range(seed % step, len(values), step):
+            values[i] = values[i][:len(values[i]) // 2]
+    return values
+
+
+def main():
+    args = parse_args()
+    from pyspark.sql import SparkSession
+    from pyspark.sql.functions import col, sum as sum_, xxhash64
+    from pipeline import decode
+
+    spark = SparkSession.builder \
+        .master(f"local[{args.cores}]") \
+        .appName("fraud_decode_benchmark") \
+        .config("spark.ui.enabled", "false") \
+        .getOrCreate()
+    spark.sparkContext.setLogLevel('ERROR')
+
+    generator = TransactionGenerator(LOOKUP_CSV, ZIP_CSV, seed=args.seed)
+    # A few ids in look_up_table.csv are in exponent notation, which the binary format cannot carry
+    events = [event for event in generator.events(args.messages) if event['card_id'].isdigit()]
+    results = {}
+    for wire_format in args.formats.split(','):
+        values = encode_all(events, wire_format, args.malformed, args.seed)
+        raw = spark.createDataFrame([(value,) for value in values], "value binary") \
+            .repartition(args.cores).cache()
+        raw.count()
+
+        decoded = decode.decode(raw, wire_format)
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            decoded.write.format("noop").mode("overwrite").save()
+            timings.append(time.perf_counter() - started)
+
+        # Same transactions whatever the format: count and an order-independent checksum
+        good = decoded.filter(col("decode_error").isNull())
+        summary = good.select(xxhash64("card_id", "member_id", "amount", "postcode", "pos_id",
+                                       "transaction_dt").alias("h")) \
+            .agg(sum_(col("h") % 1000003).alias("checksum")).first()
+        best = min(timings)
+        results[wire_format] = {
+            'messages': len(values),
+            'decoded': good.count(),
+            'dead_letters': decode.dead_letters(raw, wire_format).count(),
+            'bytes_per_message': sum(len(value) for value in values) / len(values),
+            'best_seconds': best,
+            'seconds_per_million': best / len(values) * 1e6,
+            'checksum': summary['checksum'],
+        }
+        raw.unpersist()
+        print(f"{wire_format:8} {results[wire_format]['seconds_per_million']:8.2f} s/M messages, "
+              f"{results[wire_format]['bytes_per_message']:6.1f} bytes/message, "
+              f"{results[wire_format]['decoded']} decoded, {results[wire_format]['dead_letters']} dead letters")
+    spark.stop()
+
+    if len({result['checksum'] for result in results.values()}) > 1:
+        print("Warning: the formats did not decode to the same transactions")
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump({'config': vars(args), 'formats': results}, handle, indent=2)
+        print(f"Results saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import json
+import zlib
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+# Format of transaction_dt in the POS events, as parsed by the streaming query
+EVENT_DT_FORMAT = '%d-%m-%Y %H:%M:%S'
+
+
+class TransactionGenerator:
+    """
+    Synthetic POS transactions in the shape driver.py reads from transactions-topic-verified.
+
+    Card ids come from look_up_table.csv and postcodes from uszipsv.csv. Cards are
+    drawn with a Zipf-like skew (rank ** -zipf_s, 0 for uniform) and a fraud_ratio
+    share of the events is made suspicious: an amount above the card's UCL or a
+    purchase at a random far-away postcode.
+    """
+
+    def __init__(self, lookup_csv, zip_csv, fraud_ratio=0.05, zipf_s=1.1, seed=42):
+        self.random = np.random.default_rng(seed)
+        cards = pd.read_csv(lookup_csv, dtype=str)
+        self.card_ids = cards['card_id'].to_numpy()
+        self.home_postcodes = pd.to_numeric(cards['postcode'], errors='coerce').fillna(0).astype(np.int64).to_numpy()
+        self.ucls = pd.to_numeric(cards['UCL'], errors='coerce').fillna(0).to_numpy()
+        # Stable member id per card, so repeated events of a card look like the same customer
+        self.member_ids = np.array([zlib.crc32(card.encode('utf-8')) * 10 + 1 for card in self.card_ids])
+        self.postcodes = pd.read_csv(zip_csv, header=None)[0].astype(np.int64).to_numpy()
+        self.fraud_ratio = fraud_ratio
+
+        # Hot cards get the low ranks, in a random order
+        ranks = self.random.permutation(len(self.card_ids)) + 1
+        weights = ranks.astype(float) ** -zipf_s
+        self.weights = weights / weights.sum()
+
+    def events(self, count, start=None, spacing=timedelta(seconds=1)):
+        """Return count events (dicts of strings) starting at start and spaced by spacing."""
+        start = start or datetime.now()
+        cards = self.random.choice(len(self.card_ids), size=count, p=self.weights)
+        fraud = self.random.random(count) < self.fraud_ratio
+        far_away = self.random.random(count) < 0.5  # Half of the fraud is geographic, half is amount
+        events = []
+        for i, card in enumerate(cards):
+            ucl = max(self.ucls[card], 1.0)
+            amount = self.random.uniform(1, ucl * 0.5)
+            postcode = self.home_postcodes[card]
+            if fraud[i] and far_away[i]:
+                postcode = self.random.choice(self.postcodes)
+            elif fraud[i]:
+                amount = ucl * self.random.uniform(1.2, 3.0)
+            events.append({
+                'card_id': str(self.card_ids[card]),
+                'member_id': str(self.member_ids[card]),
+                'amount': str(int(amount)),
+                'postcode': str(postcode),
+                'pos_id': str(self.random.integers(10 ** 14, 10 ** 15)),
+                'transaction_dt': (start + spacing * i).strftime(EVENT_DT_FORMAT),
+            })
+        return events
+
+    @staticmethod
+    def encode(event, escaped=True):
+        """
+        Serialize an event as a Kafka message value.
+
+        escaped=True reproduces the current producer, which sends the JSON object
+        as a quoted, backslash-escaped string.
+        """
+        payload = json.dumps(event)
+        return json.dumps(payload) if escaped else payload
+
+    @staticmethod
+    def encode_binary(event):
+        """Serialize an event in the binary wire format (see pipeline.decode)."""
+        from pipeline import decode
+        epoch_seconds = datetime.strptime(event['transaction_dt'], EVENT_DT_FORMAT).timestamp()
+        return decode.pack_binary(event['card_id'], event['member_id'], event['amount'], event['postcode'],
+                                  event['pos_id'], epoch_seconds)
+
+
+def to_frame(events):
+    """Typed pandas frame of events, as the streaming query sees them after parsing."""
+    frame = pd.DataFrame(events)
+    for column in ['member_id', 'amount', 'postcode', 'pos_id']:
+        frame[column] = pd.to_numeric(frame[column]).astype(np.int64)
+    frame['transaction_dt'] = pd.to_datetime(frame['transaction_dt'], format=EVENT_DT_FORMAT)
+    return frame
@@ -0,0 +1,308 @@
+"""
+End-to-end benchmark of the fraud detection pipeline.
+
+Runs the streaming scoring query in Spark local mode against a SQLite stand-in
+for HBase, fed with synthetic POS events at a target rate, and measures:
+
+- end to end: rows/sec and p50/p95/p99 latency from an event being written to
+  the input directory to its micro-batch being written by the sink;
+- per stage: the cost of enrichment, distance, rules and writes, timed in-process
+  over the same kind of events.
+
+Results are saved as JSON; pass --compare with an earlier result to see the change.
+
+    python bench/run_benchmark.py --events 50000 --rate 2000 --output bench/results/run.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, 'python', 'src')
+LOOKUP_CSV = os.path.join(ROOT, 'look_up_table.csv')
+ZIP_CSV = os.path.join(SRC, 'db', 'uszipsv.csv')
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SRC, 'rules'))
+sys.path.insert(0, SRC)
+
+from generator import TransactionGenerator, to_frame
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=20000, help='number of events to stream')
+    parser.add_argument('--rate', type=float, default=1000, help='target events per second')
+    parser.add_argument('--fraud-ratio', type=float, default=0.05, help='share of suspicious events')
+    parser.add_argument('--zipf', type=float, default=1.1, help='card skew exponent, 0 for uniform')
+    parser.add_argument('--file-interval', type=float, default=0.5, help='seconds between input files')
+    parser.add_argument('--cores', type=int, default=os.cpu_count() or 2, help='Spark local cores')
+    parser.add_argument('--batch-size', type=int, default=1000, help='sink mutation batch size')
+    parser.add_argument('--geo', choices=['udf', 'join'], default='udf', help='geo-velocity path of the query')
+    parser.add_argument('--stage-rows', type=int, default=20000, help='rows for the per-stage timings')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds to wait for the stream to drain')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default=None, help='result JSON (default bench/results/<time>.json)')
+    parser.add_argument('--compare', default=None, help='earlier result JSON to compare with')
+    return parser.parse_args()
+
+
+def configure_environment(workdir):
+    # Set before Spark starts so the local Python workers inherit it
+    os.environ['FRAUD_DAO_BACKEND'] = 'sqlite'
+    os.environ['FRAUD_DAO_SQLITE_PATH'] = os.path.join(workdir, 'store.db')
+    os.environ['FRAUD_ZIP_CSV'] = ZIP_CSV
+    os.environ['PYTHONPATH'] = os.pathsep.join([SRC, os.path.join(SRC, 'rules'), os.environ.get('PYTHONPATH', '')])
+
+
+def seed_store():
+    """Load look_up_table.csv into the local store and return the DAO."""
+    from db import dao
+    from pipeline import enrichment
+
+    hdao = dao.HBaseDao.get_instance()
+    hdao.ensure_table(enrichment.LOOKUP_TABLE, {'info': dict(max_versions=5)})
+    hdao.ensure_table('card_transactions', {'info': dict()})
+    profiles = pd.read_csv(LOOKUP_CSV, dtype=str)
+    # Stored in the layout FRAUD_PROFILE_FORMAT selects
+    hdao.write_profile_updates([(enrichment.lookup_key(row.card_id), {
+        b'info:card_id': row.card_id.encode('utf-8'),
+        b'info:transaction_dt': row.transaction_dt.encode('utf-8'),
+        b'info:score': row.score.encode('utf-8'),
+        b'info:postcode': row.postcode.encode('utf-8'),
+        b'info:UCL': row.UCL.encode('utf-8'),
+    }) for row in profiles.itertuples(index=False)], 5000)
+    return hdao
+
+
+def percentiles(values):
+    if len(values) == 0:
+        return {'p50': None, 'p95': None, 'p99': None, 'max': None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'max': float(np.max(values))}
+
+
+def timed(function, rows):
+    """Run function once and return its cost in microseconds per row and rows per second."""
+    started = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - started
+    return {'rows': rows, 'seconds': elapsed, 'us_per_row': elapsed / rows * 1e6, 'rows_per_sec': rows / elapsed}
+
+
+def stage_costs(generator, rows, batch_size):
+    """Time each pipeline stage in-process over the same batch of events."""
+    from db import dao
+    from db import geo_map
+    from pipeline import enrichment
+    from pipeline import sink
+    import rules as rules_engine
+
+    hdao = dao.HBaseDao.get_instance()
+    gmap = geo_map.GEO_Map.get_instance()
+    frame = to_frame(generator.events(rows))
+    results = {}
+
+    def enrich():
+        frame_with_profiles = enrichment.enrich_frame(frame.copy(), enrichment.fetch_profiles(frame['card_id']))
+        results['enriched'] = frame_with_profiles
+    stages = {'enrichment': timed(enrich, rows)}
+    enriched = results['enriched']
+    last_postcode = pd.to_numeric(enriched['last_postcode'], errors='coerce')
+
+    def distance():
+        results['distance'] = gmap.distance_many(last_postcode, enriched['postcode'])
+    stages['distance'] = timed(distance, rows)
+
+    last_dt = pd.to_datetime(enriched['last_transaction_date'], format='%Y-%m-%dT%H:%M:%S.%fZ', errors='coerce')
+    hours = ((enriched['transaction_dt'] - last_dt).dt.total_seconds() / 3600).abs()
+
+    def rules():
+        # The streaming query runs the same rules as Spark expressions; this is their NumPy form
+        speed = np.where(hours > 0, results['distance'] / hours.where(hours > 0), -1.0)
+        statuses, _ = rules_engine.evaluate_arrays({'amount': enriched['amount'], 'UCL': enriched['UCL'],
+                                                    'score': enriched['score'], 'speed': speed})
+        results['status'] = [status.upper() if status != 'error' else status for status in statuses]
+    stages['rules'] = timed(rules, rows)
+
+    scored = enriched.assign(status=results['status'])
+
+    def writes():
+        hdao.write_batch(((sink.transaction_key(row), sink.transaction_cells(row))
+                          for row in scored.itertuples(index=False)), sink.TRANSACTIONS_TABLE, batch_size)
+    stages['writes'] = timed(writes, rows)
+    stages['fraud_share'] = sum(status == 'FRAUD' for status in results['status']) / rows
+    return stages
+
+
+class EventFeeder(threading.Thread):
+    """Writes events to the streaming input directory as files, at the target rate."""
+
+    def __init__(self, generator, directory, events, rate, interval):
+        super().__init__(daemon=True)
+        self.generator = generator
+        self.directory = directory
+        self.staging = os.path.join(directory, '..', 'staging')
+        os.makedirs(self.staging, exist_ok=True)
+        self.events = events
+        self.per_file = max(1, int(rate * interval))
+        self.interval = interval
+        self.written_at = {}  # File name -> time it became visible to the query
+
+    def run(self):
+        started = time.time()
+        sent = 0
+        index = 0
+        while sent < self.events:
+            count = min(self.per_file, self.events - sent)
+            name = f'events-{index:06d}.json'
+            staged = os.path.join(self.staging, name)
+            with open(staged, 'w') as handle:
+                for event in self.generator.events(count):
+                    handle.write(self.generator.encode(event) + '\n')
+            # Files must appear atomically for the file source
+            os.rename(staged, os.path.join(self.directory, name))
+            self.written_at[name] = time.time()
+            sent += count
+            index += 1
+            time.sleep(max(0.0, started + index * self.interval - time.time()))
+
+
+class LatencyRecorder:
+    """foreachBatch wrapper: runs the real sink and records per-event latency and batch timings."""
+
+    def __init__(self, sink, feeder):
+        self.sink = sink
+        self.feeder = feeder
+        self.latencies = []
+        self.batches = []
+        self.rows = 0
+        self.finished_at = None
+
+    def __call__(self, batch_df, batch_id):
+        from pyspark.sql.functions import col
+        started = time.time()
+        batch_df.persist()
+        self.sink(batch_df, batch_id)
+        counts = batch_df.groupBy(col("source_file")).count().collect()
+        batch_df.unpersist()
+        done = time.time()
+        rows = 0
+        for row in counts:
+            written = self.feeder.written_at.get(os.path.basename(row['source_file']), started)
+            self.latencies.extend([done - written] * row['count'])
+            rows += row['count']
+        self.rows += rows
+        self.finished_at = done
+        self.batches.append({'batch_id': batch_id, 'rows': rows, 'seconds': done - started})
+
+
+def end_to_end(args, generator, workdir):
+    """Stream the events through the scoring query and measure throughput and latency."""
+    from pyspark.sql import SparkSession
+    from pyspark.sql.functions import input_file_name
+    from pipeline import sink
+    from pipeline import transform
+
+    spark = SparkSession.builder \
+        .master(f"local[{args.cores}]") \
+        .appName("fraud_detection_benchmark") \
+        .config("spark.sql.shuffle.partitions", str(args.cores)) \
+        .config("spark.ui.enabled", "false") \
+        .getOrCreate()
+    spark.sparkContext.setLogLevel('ERROR')
+
+    input_dir = os.path.join(workdir, 'input')
+    os.makedirs(input_dir, exist_ok=True)
+    feeder = EventFeeder(generator, input_dir, args.events, args.rate, args.file_interval)
+    recorder = LatencyRecorder(sink.HBaseBatchSink(batch_size=args.batch_size, query_name='benchmark'), feeder)
+
+    raw = spark.readStream.text(input_dir)
+    transactions = transform.parse_transactions(raw, extra_columns=[input_file_name().alias("source_file")])
+    zips = transform.zip_table(spark) if args.geo == 'join' else None
+    scored = transform.score_transactions(transactions, extra_columns=["source_file"], zips=zips)
+    query = scored.writeStream \
+        .foreachBatch(recorder) \
+        .option("checkpointLocation", os.path.join(workdir, 'checkpoint')) \
+        .start()
+
+    feeder.start()
+    deadline = time.time() + args.timeout
+    while recorder.rows < args.events and time.time() < deadline and query.isActive:
+        time.sleep(0.2)
+    query.stop()
+    spark_version = spark.version
+    spark.stop()
+
+    first_written = min(feeder.written_at.values()) if feeder.written_at else time.time()
+    elapsed = (recorder.finished_at or time.time()) - first_written
+    latencies_ms = np.array(recorder.latencies) * 1000
+    return {
+        'rows': recorder.rows,
+        'complete': recorder.rows >= args.events,
+        'seconds': elapsed,
+        'rows_per_sec': recorder.rows / elapsed if elapsed > 0 else None,
+        'latency_ms': percentiles(latencies_ms),
+        'batches': len(recorder.batches),
+        'batch_seconds': percentiles(np.array([batch['seconds'] for batch in recorder.batches])),
+        'spark_version': spark_version,
+    }
+
+
+def compare(previous, current):
+    """Print the change of the headline metrics against an earlier run."""
+    metrics = [('end_to_end', 'rows_per_sec'), ('end_to_end', 'latency_ms', 'p50'),
+               ('end_to_end', 'latency_ms', 'p95'), ('end_to_end', 'latency_ms', 'p99')]
+    metrics += [('stages', stage, 'us_per_row') for stage in ['enrichment', 'distance', 'rules', 'writes']]
+    print(f"{'metric':40} {'previous':>12} {'current':>12} {'change':>8}")
+    for path in metrics:
+        old, new = previous, current
+        for part in path:
+            old = old.get(part) if isinstance(old, dict) else None
+            new = new.get(part) if isinstance(new, dict) else None
+        change = f"{(new - old) / old * 100:+.1f}%" if old and new is not None else 'n/a'
+        print(f"{'.'.join(path):40} {old if old is not None else 'n/a':>12.6} {new if new is not None else 'n/a':>12.6} {change:>8}")
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix='fraud_bench_')
+    configure_environment(workdir)
+    seed_store()
+    generator = TransactionGenerator(LOOKUP_CSV, ZIP_CSV, args.fraud_ratio, args.zipf, args.seed)
+
+    result = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'config': vars(args),
+        'python_version': platform.python_version(),
+        'stages': stage_costs(generator, args.stage_rows, args.batch_size),
+        'end_to_end': end_to_end(args, generator, workdir),
+    }
+    from db import dao
+    result['dao'] = dao.HBaseDao.get_instance().stats()
+    result['profile_cache'] = dao.HBaseDao.get_instance().profile_cache_stats()
+
+    output = args.output or os.path.join(ROOT, 'bench', 'results',
+                                         datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as handle:
+        json.dump(result, handle, indent=2, default=str)
+    print(json.dumps({'end_to_end': result['end_to_end'], 'stages': result['stages']}, indent=2, default=str))
+    print(f"Results saved to {output}")
+
+    if args.compare:
+        with open(args.compare) as handle:
+            compare(json.load(handle), result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Converts look_up_table profiles from string cells to the packed layout.
+
+Every row stored as separate info:* string cells under the card_id + '.0' key is
+rewritten as one packed cell (python/src/db/profile_format.py) under the plain
+card_id key, the layout the streaming job reads and writes with
+FRAUD_PROFILE_FORMAT=packed. Rows already packed are left alone, so the tool can
+be stopped and run again.
+
+    python convert_lookup_profiles.py --dry-run
+    python convert_lookup_profiles.py --delete-old      # then set FRAUD_PROFILE_FORMAT=packed
+"""
+import argparse
+import os
+import sys
+import time
+
+import happybase
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'python', 'src'))
+from db import profile_format
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--table', default='look_up_table')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=9090)
+    parser.add_argument('--batch-size', type=int, default=1000, help='mutations per HBase batch')
+    parser.add_argument('--scan-batch', type=int, default=1000, help='rows fetched per scanner call')
+    parser.add_argument('--delete-old', action='store_true', help='delete each row under its old key once converted')
+    parser.add_argument('--dry-run', action='store_true', help='only count what would be converted')
+    return parser.parse_args()
+
+
+def convert(args):
+    connection = happybase.Connection(args.host, port=args.port)
+    table = connection.table(args.table)
+
+    counts = {'converted': 0, 'already': 0, 'invalid': 0}
+    started = time.time()
+    writes = table.batch(batch_size=args.batch_size)
+    deletes = table.batch(batch_size=args.batch_size)
+    try:
+        for key, row in table.scan(batch_size=args.scan_batch):
+            key = key.decode('utf-8')
+            if profile_format.PACKED_COLUMN in row:
+                counts['already'] += 1
+                continue
+            card_id = key[:-2] if key.endswith('.0') else key
+            try:
+                # The id from the key wins over a stored info:card_id cell, which the old loader wrote as a float
+                cells = profile_format.packed_cells({**row, b'info:card_id': card_id.encode('utf-8')})
+            except ValueError as e:
+                counts['invalid'] += 1
+                print(f"Skipping row {key}: {e}")
+                continue
+            counts['converted'] += 1
+            if not args.dry_run:
+                new_key = profile_format.lookup_key(card_id, 'packed')
+                writes.put(new_key.encode('utf-8'), cells)
+                if args.delete_old:
+                    if new_key == key:
+                        deletes.delete(key.encode('utf-8'), columns=list(row))
+                    else:
+                        deletes.delete(key.encode('utf-8'))
+            if counts['converted'] % 100000 == 0:
+                print(f"{counts['converted']} profiles converted, "
+                      f"{counts['converted'] / (time.time() - started):.0f} rows/sec")
+        # Packed rows first, so a failure never leaves a card without a profile
+        writes.send()
+        deletes.send()
+    finally:
+        connection.close()
+    print(f"Done in {time.time() - started:.1f}s: {counts}")
+
+
+if __name__ == '__main__':
+    convert(parse_args())
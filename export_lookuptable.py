@@ -0,0 +1,61 @@
+"""
+Exports the live look_up_table to a CSV snapshot for the stateful engine and replay.
+
+The stateful engine (FRAUD_ENGINE=stateful) seeds each card the first time it sees
+it from a snapshot CSV (FRAUD_PROFILE_SNAPSHOT), not from HBase. The loader's own
+CSV does not have the postcode and time updates the lookup engine has written since,
+so export the table when switching engines and point FRAUD_PROFILE_SNAPSHOT at it.
+Both profile layouts (string cells and packed) are read.
+
+    python export_lookuptable.py /home/hadoop/look_up_table_snapshot.csv
+    hdfs dfs -put -f /home/hadoop/look_up_table_snapshot.csv /sharma/look_up_table.csv
+"""
+import argparse
+import csv
+import os
+import sys
+import time
+
+import happybase
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'python', 'src'))
+from db import profile_format
+
+# Columns of the snapshot, in the order of the loader's look_up_table.csv
+SNAPSHOT_COLUMNS = ['card_id', 'transaction_dt', 'score', 'postcode', 'UCL']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('output', help='snapshot CSV to write')
+    parser.add_argument('--table', default='look_up_table')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=9090)
+    parser.add_argument('--scan-batch', type=int, default=1000, help='rows fetched per scanner call')
+    return parser.parse_args()
+
+
+def export(args):
+    connection = happybase.Connection(args.host, port=args.port)
+    started = time.time()
+    count = 0
+    try:
+        with open(args.output + '.tmp', 'w', newline='') as handle:
+            writer = csv.writer(handle)
+            writer.writerow(SNAPSHOT_COLUMNS)
+            for key, row in connection.table(args.table).scan(batch_size=args.scan_batch):
+                cells = profile_format.expand(row)
+                key = key.decode('utf-8')
+                card_id = cells.get(b'info:card_id', b'').decode('utf-8') or (key[:-2] if key.endswith('.0') else key)
+                writer.writerow([card_id] + [cells.get(f'info:{name}'.encode('utf-8'), b'').decode('utf-8')
+                                             for name in SNAPSHOT_COLUMNS[1:]])
+                count += 1
+        # Replace the snapshot only once it is complete
+        os.replace(args.output + '.tmp', args.output)
+    finally:
+        connection.close()
+    print(f"Exported {count} profiles to {args.output} in {time.time() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    export(parse_args())
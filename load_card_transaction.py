@@ -1,74 +1,188 @@
+"""
+Bulk loader for card_transactions.
+
+Streams the CSV in chunks and writes them with batched mutations from a pool of
+worker processes, each holding its own HBase connection. Finished chunks are
+recorded in a checkpoint file, so an interrupted load resumes where it stopped.
+Rows get the same keys as the streaming sink writes (python/src/db/row_keys.py),
+derived from the transaction itself, which makes re-writing a partly loaded
+chunk harmless.
+
+    python load_card_transaction.py                      # drop, recreate and load
+    python load_card_transaction.py --append new_transactions.csv
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ProcessPoolExecutor, wait
+
 import happybase
 
-# To create a connection
-connection = happybase.Connection('localhost', port=9090, autoconnect=False)
-
-# To open connection and perform operations
-def open_connection():
-    connection.open()
-
-# To close the opened connection
-def close_connection():
-    connection.close()
-
-# To list all tables in HBase
-def list_tables():
-    print("Fetching all tables")
-    open_connection()
-    tables = connection.tables()
-    close_connection()
-    print("All tables fetched")
-    return tables
-
-# To create the required table
-def create_table(name, cf):
-    print(f"Creating table {name}")
-    tables = list_tables()
-    if name.encode('utf-8') in tables:  # Ensure name is in bytes format for comparison
-        print(f"Table {name} already exists, deleting table {name}")
-        open_connection()
-        connection.disable_table(name)
-        connection.delete_table(name)
-        close_connection()
-        print(f"Table {name} deleted")
-    
-    open_connection()
-    connection.create_table(name, cf)
-    close_connection()
-    print(f"Table {name} created")
-
-# To get the created table
-def get_table(name):
-    open_connection()
-    table = connection.table(name)
-    close_connection()
-    return table
-
-# To batch insert data
-def batch_insert_data(filename, table_name):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'python', 'src'))
+from db import row_keys
+
+COLUMNS = ['card_id', 'member_id', 'amount', 'postcode', 'pos_id', 'transaction_dt', 'status']
+
+# Connection of a worker process, opened once when the worker starts
+connection = None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('filename', nargs='?', default='/home/hadoop/card_transactions.csv')
+    parser.add_argument('--table', default='card_transactions')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=9090)
+    parser.add_argument('--workers', type=int, default=4, help='writer processes')
+    parser.add_argument('--chunk-size', type=int, default=10000, help='rows per chunk (the unit of resume)')
+    parser.add_argument('--batch-size', type=int, default=1000, help='mutations per HBase batch')
+    parser.add_argument('--checkpoint', default=None, help='progress file (default <filename>.checkpoint)')
+    parser.add_argument('--append', action='store_true', help='keep the existing table instead of recreating it')
+    return parser.parse_args()
+
+
+# To create the required table; an existing table is kept in append mode and deleted otherwise
+def create_table(name, cf, host, port, append):
+    connection = happybase.Connection(host, port=port)
+    try:
+        if name.encode('utf-8') in connection.tables():  # Ensure name is in bytes format for comparison
+            if append:
+                print(f"Table {name} already exists, appending to it")
+                return
+            print(f"Table {name} already exists, deleting table {name}")
+            connection.disable_table(name)
+            connection.delete_table(name)
+            print(f"Table {name} deleted")
+        connection.create_table(name, cf)
+        print(f"Table {name} created")
+    finally:
+        connection.close()
+
+
+# To read the CSV as (chunk number, row number of its first row, rows) without loading the whole file
+def read_chunks(filename, chunk_size):
+    with open(filename, "r", newline='') as file:
+        rows = []
+        chunk_no = 0
+        row_no = 0
+        for record in csv.reader(file):
+            # To skip the header row
+            if not record or record[0] == 'card_id':
+                continue
+            rows.append(record)
+            if len(rows) == chunk_size:
+                yield chunk_no, row_no, rows
+                chunk_no += 1
+                row_no += len(rows)
+                rows = []
+        if rows:
+            yield chunk_no, row_no, rows
+
+
+# To open the connection of a worker process
+def init_worker(host, port):
+    global connection
+    connection = happybase.Connection(host, port=port)
+
+
+# To write one chunk with batched mutations; runs in a worker process
+def write_chunk(table_name, batch_size, chunk_no, row_no, rows):
+    table = connection.table(table_name)
+    skipped = 0
+    with table.batch(batch_size=batch_size) as b:
+        for record in rows:
+            card_id, member_id, amount, postcode, pos_id, transaction_dt = record[:6]
+            parsed_dt = row_keys.parse_transaction_dt(transaction_dt)
+            if parsed_dt is None:
+                skipped += 1  # No key without a transaction time
+                continue
+            key = row_keys.transaction_key(card_id, parsed_dt, member_id, amount, postcode, pos_id)
+            b.put(bytes(key, 'utf-8'),
+                  {f'info:{column}'.encode('utf-8'): bytes(value, 'utf-8') for column, value in zip(COLUMNS, record)})
+    if skipped:
+        print(f"Chunk {chunk_no} (rows from {row_no}): skipped {skipped} rows without a valid transaction_dt")
+    return chunk_no, len(rows) - skipped
+
+
+class Checkpoint:
+    """Chunks already written, saved atomically after every chunk that finishes."""
+
+    def __init__(self, path, filename, chunk_size):
+        self.path = path
+        self.identity = {'filename': os.path.abspath(filename), 'chunk_size': chunk_size}
+        self.done = set()
+        self.rows = 0
+        if os.path.exists(path):
+            with open(path) as handle:
+                saved = json.load(handle)
+            if {key: saved.get(key) for key in self.identity} != self.identity:
+                raise SystemExit(f"Checkpoint {path} belongs to a different load ({saved}), remove it to start over")
+            self.done = set(saved['done'])
+            self.rows = saved['rows']
+        else:
+            self.save()
+
+    @property
+    def resuming(self):
+        return bool(self.done)
+
+    def mark(self, chunk_no, rows):
+        self.done.add(chunk_no)
+        self.rows += rows
+        self.save()
+
+    def save(self):
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as handle:
+            json.dump(dict(self.identity, done=sorted(self.done), rows=self.rows), handle)
+        os.replace(temporary, self.path)
+
+
+# To load the CSV into the table, keeping at most two chunks per worker in flight
+def batch_insert_data(args, checkpoint):
     print("Starting batch insert of events")
-    with open(filename, "r") as file:
-        table = get_table(table_name)
-        open_connection()
-        i = 0
-        for line in file:
-            temp = line.strip().split(",")
-            # To skip the first row
-            if temp[0] != 'card_id':
-                table.put(bytes(str(i), 'utf-8'), {
-                    'info:card_id': bytes(temp[0], 'utf-8'),
-                    'info:member_id': bytes(temp[1], 'utf-8'),
-                    'info:amount': bytes(temp[2], 'utf-8'),
-                    'info:postcode': bytes(temp[3], 'utf-8'),
-                    'info:pos_id': bytes(temp[4], 'utf-8'),
-                    'info:transaction_dt': bytes(temp[5], 'utf-8'),
-                    'info:status': bytes(temp[6], 'utf-8')
-                })
-                i += 1
-        close_connection()
-    print("Batch insert done")
+    started = time.time()
+    loaded = 0
+    in_flight = set()
+    with ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(args.host, args.port)) as pool:
+        def collect(return_when):
+            nonlocal loaded
+            finished, pending = wait(in_flight, return_when=return_when)
+            for future in finished:
+                chunk_no, rows = future.result()
+                checkpoint.mark(chunk_no, rows)
+                loaded += rows
+            elapsed = time.time() - started
+            print(f"{checkpoint.rows} rows loaded ({len(checkpoint.done)} chunks), "
+                  f"{loaded / elapsed if elapsed else 0:.0f} rows/sec")
+            return pending
+
+        for chunk_no, row_no, rows in read_chunks(args.filename, args.chunk_size):
+            if chunk_no in checkpoint.done:
+                continue
+            in_flight.add(pool.submit(write_chunk, args.table, args.batch_size, chunk_no, row_no, rows))
+            if len(in_flight) >= 2 * args.workers:
+                in_flight = collect(FIRST_COMPLETED)
+        if in_flight:
+            collect(ALL_COMPLETED)
+    elapsed = time.time() - started
+    print(f"Batch insert done: {loaded} rows in {elapsed:.1f}s ({loaded / elapsed if elapsed else 0:.0f} rows/sec)")
 
-# To batch insert data of card_transactions.csv
-create_table('card_transactions', {'info': dict()})
-batch_insert_data('/home/hadoop/card_transactions.csv', 'card_transactions')
 
+def main():
+    args = parse_args()
+    checkpoint = Checkpoint(args.checkpoint or args.filename + '.checkpoint', args.filename, args.chunk_size)
+    if checkpoint.resuming:
+        print(f"Resuming: {len(checkpoint.done)} chunks ({checkpoint.rows} rows) already loaded")
+    else:
+        create_table(args.table, {'info': dict()}, args.host, args.port, args.append)
+    batch_insert_data(args, checkpoint)
+    os.remove(checkpoint.path)  # A finished load leaves nothing to resume
+
+
+# To batch insert data of card_transactions.csv
+if __name__ == '__main__':
+    main()
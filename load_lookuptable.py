@@ -1,73 +1,258 @@
+"""
+Builds look_up_table from the card transaction history and uploads it to HBase.
+
+For every card it computes the UCL (moving average + 3 standard deviations of the
+amounts of its last N genuine transactions) and the postcode and time of its
+latest genuine transaction. The history is read in chunks and vectorized with
+pandas; only the last N genuine transactions of each card are kept, and they are
+saved in a state directory together with a watermark (the latest transaction
+time processed).
+
+With --incremental only transactions from the watermark on are read (rows of the
+watermark's second that were already processed are skipped), and only the cards
+that have new genuine transactions are recomputed and uploaded, so a nightly
+refresh costs in proportion to the day's volume instead of the whole history.
+
+    python load_lookuptable.py --scores /home/hadoop/card_scores.csv            # full build
+    python load_lookuptable.py --incremental /home/hadoop/new_transactions.csv  # nightly refresh
+    python load_lookuptable.py --precomputed /home/hadoop/look_up_table.csv     # upload a ready table
+
+--format packed stores every profile as one binary cell under the plain card_id key
+(see python/src/db/profile_format.py); it defaults to FRAUD_PROFILE_FORMAT, like the
+streaming job.
+"""
+import argparse
+import json
+import os
+import sys
+
 import happybase
+import numpy as np
 import pandas as pd
 
-# Initialize HBase connection
-connection = happybase.Connection('localhost', port=9090, autoconnect=False)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'python', 'src'))
+from db import profile_format
 
-def open_connection():
-    connection.open()
+# Format of transaction_dt in card_transactions.csv and in look_up_table
+HISTORY_DT_FORMAT = '%d-%m-%Y %H:%M:%S'
+LOOKUP_DT_FORMAT = profile_format.LOOKUP_DT_FORMAT
 
-def close_connection():
-    connection.close()
+RECENT_COLUMNS = ['card_id', 'amount', 'postcode', 'transaction_dt']
 
-def list_tables():
-    print("Fetching all tables")
-    open_connection()
-    tables = connection.tables()
-    close_connection()
-    print("All tables fetched")
-    return tables
 
-def create_table(name, cf):
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('history', nargs='?', default='/home/hadoop/card_transactions.csv',
+                        help='card transactions CSV (card_id, member_id, amount, postcode, pos_id, transaction_dt, status)')
+    parser.add_argument('--table', default='look_up_table')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=9090)
+    parser.add_argument('--window', type=int, default=10, help='genuine transactions per card the UCL is computed over')
+    parser.add_argument('--state-dir', default='/home/hadoop/look_up_state', help='kept transactions and watermark')
+    parser.add_argument('--incremental', action='store_true', help='only process transactions after the watermark')
+    parser.add_argument('--scores', default=None, help='CSV with card_id and score columns to upload as info:score')
+    parser.add_argument('--precomputed', default=None, help='upload this look_up_table CSV as it is instead')
+    parser.add_argument('--chunk-size', type=int, default=500000, help='history rows read at a time')
+    parser.add_argument('--batch-size', type=int, default=5000, help='mutations per HBase batch')
+    parser.add_argument('--format', choices=['cells', 'packed'], default=profile_format.PROFILE_FORMAT,
+                        help='profile storage layout (default: FRAUD_PROFILE_FORMAT or cells)')
+    return parser.parse_args()
+
+
+def create_table(connection, name, cf):
     print("Creating table " + name)
-    tables = list_tables()
-    if name.encode('utf-8') not in tables:
-        open_connection()
+    if name.encode('utf-8') not in connection.tables():
         connection.create_table(name, cf)
-        close_connection()
         print("Table created")
     else:
         print("Table already present")
 
-def get_table(name):
-    open_connection()
-    table = connection.table(name)
-    close_connection()
-    return table
-
-# Create the lookup table
-create_table('look_up_table', {'info': dict(max_versions=5)})
-
-# Load data from the CSV file into a DataFrame
-def load_csv_to_dataframe(file_path):
-    print(f"Loading data from {file_path}")
-    df = pd.read_csv(file_path)
-    return df
-
-# To batch insert data from the DataFrame into HBase
-def batch_insert_data(df, tableName):
-    print("Starting batch insert of events")
-    table = get_table(tableName)
-    
-    open_connection()
-    with table.batch(batch_size=4) as b:
-        for index, row in df.iterrows():
-            b.put(
-                bytes(str(row['card_id']), 'utf-8'), {
-                    b'info:card_id': bytes(str(row['card_id']), 'utf-8'),
-                    b'info:transaction_dt': bytes(str(row['transaction_dt']), 'utf-8'),
-                    b'info:score': bytes(str(row['score']), 'utf-8'),
-                    b'info:postcode': bytes(str(row['postcode']), 'utf-8'),
-                    b'info:UCL': bytes(str(row['UCL']), 'utf-8')
-                }
-            )
+
+# To read the genuine transactions of the history, a chunk at a time, from the watermark on if there is one.
+# Rows in the watermark's own second are read again (a late row can share it); see drop_seen()
+def read_genuine(path, chunk_size, watermark=None):
+    columns = ['card_id', 'amount', 'postcode', 'transaction_dt', 'status']
+    for chunk in pd.read_csv(path, usecols=columns, dtype=str, chunksize=chunk_size):
+        chunk['transaction_dt'] = pd.to_datetime(chunk['transaction_dt'], format=HISTORY_DT_FORMAT, errors='coerce')
+        chunk['amount'] = pd.to_numeric(chunk['amount'], errors='coerce')
+        chunk['postcode'] = pd.to_numeric(chunk['postcode'], errors='coerce')
+        chunk = chunk.dropna(subset=['card_id', 'amount', 'postcode', 'transaction_dt'])
+        if watermark is not None:
+            chunk = chunk[chunk['transaction_dt'] >= watermark]
+        yield chunk[chunk['status'] == 'GENUINE'][RECENT_COLUMNS]
+
+
+# To drop the rows at the watermark that the previous run already kept, so they are not counted twice
+def drop_seen(chunk, recent, watermark):
+    at_watermark = chunk['transaction_dt'] == watermark
+    if recent is None or not at_watermark.any():
+        return chunk
+    def keys(df):
+        return zip(df['card_id'], df['amount'].astype(float), df['postcode'].astype(float), df['transaction_dt'])
+    seen = set(keys(recent[recent['transaction_dt'] == watermark]))
+    duplicate = pd.Series([key in seen for key in keys(chunk)], index=chunk.index) & at_watermark
+    return chunk[~duplicate]
+
+
+# To keep only the last `window` transactions of every card
+def merge_recent(recent, new, window):
+    combined = new if recent is None else pd.concat([recent, new], ignore_index=True)
+    combined = combined.sort_values(['card_id', 'transaction_dt'], kind='stable')
+    return combined.groupby('card_id', sort=False).tail(window).reset_index(drop=True)
+
+
+# To compute UCL, last postcode and last transaction_dt of every card in `recent`
+def build_profiles(recent):
+    recent = recent.sort_values(['card_id', 'transaction_dt'], kind='stable')
+    by_card = recent.groupby('card_id', sort=True)
+    # Population standard deviation, like Hive's STDDEV the table used to be built with
+    ucl = by_card['amount'].mean() + 3 * by_card['amount'].std(ddof=0)
+    last = by_card[['postcode', 'transaction_dt']].last()
+    return pd.DataFrame({
+        'card_id': ucl.index,
+        'UCL': ucl.to_numpy(),
+        'postcode': last['postcode'].to_numpy(),
+        'transaction_dt': last['transaction_dt'].to_numpy(),
+    })
+
+
+class State:
+    """Last genuine transactions of every card and the latest transaction time processed."""
+
+    def __init__(self, directory, window):
+        self.recent_path = os.path.join(directory, 'recent.csv')
+        self.meta_path = os.path.join(directory, 'watermark.json')
+        self.directory = directory
+        self.window = window
+
+    def load(self):
+        with open(self.meta_path) as handle:
+            meta = json.load(handle)
+        if meta['window'] != self.window:
+            raise SystemExit(f"State in {self.directory} was built with --window {meta['window']}, "
+                             f"run a full build to change it")
+        recent = pd.read_csv(self.recent_path, dtype={'card_id': str})
+        recent['transaction_dt'] = pd.to_datetime(recent['transaction_dt'])
+        return recent, pd.Timestamp(meta['watermark'])
+
+    def save(self, recent, watermark):
+        os.makedirs(self.directory, exist_ok=True)
+        recent.to_csv(self.recent_path + '.tmp', index=False)
+        os.replace(self.recent_path + '.tmp', self.recent_path)
+        with open(self.meta_path + '.tmp', 'w') as handle:
+            json.dump({'window': self.window, 'watermark': watermark.isoformat()}, handle)
+        os.replace(self.meta_path + '.tmp', self.meta_path)
+
+
+# To read the card scores to upload, as strings keyed by card_id
+def load_scores(path):
+    scores = pd.read_csv(path, usecols=['card_id', 'score'], dtype=str).dropna()
+    return scores.drop_duplicates('card_id', keep='last').set_index('card_id')['score']
+
+
+# To batch insert the given cells; columns maps a qualifier to an array of strings (None to skip a cell)
+def batch_insert_data(connection, table_name, card_ids, columns, batch_size, layout='cells'):
+    print(f"Starting batch insert of {len(card_ids)} cards")
+    table = connection.table(table_name)
+    qualifiers = [(f'info:{name}'.encode('utf-8'), values) for name, values in columns.items()]
+    skipped = 0
+    with table.batch(batch_size=batch_size) as b:
+        for start in range(0, len(card_ids), batch_size):
+            keys = [profile_format.lookup_key(card_id, layout).encode('utf-8')
+                    for card_id in card_ids[start:start + batch_size]]
+            # A packed profile is a single cell: the new values are merged into the stored profile of each card
+            stored = dict(table.rows(keys)) if layout == 'packed' else {}
+            for i, key in enumerate(keys, start):
+                cells = {b'info:card_id': card_ids[i].encode('utf-8')}
+                for qualifier, values in qualifiers:
+                    if values[i] is not None:
+                        cells[qualifier] = values[i].encode('utf-8')
+                if layout == 'packed':
+                    try:
+                        cells = profile_format.packed_cells({**profile_format.expand(stored.get(key, {})), **cells})
+                    except ValueError:
+                        skipped += 1  # Card ids that are not integers cannot be packed
+                        continue
+                b.put(key, cells)
+    if skipped:
+        print(f"Skipped {skipped} cards whose card_id is not an integer")
     print("Batch insert done")
-    close_connection()
 
-# Path to the CSV file
-csv_file_path = '/home/hadoop/look_up_table.csv'
 
-# Load data and insert into HBase
-df = load_csv_to_dataframe("/home/hadoop/look_up_table.csv")
-batch_insert_data(df, 'look_up_table')
+def profile_columns(profiles, scores):
+    columns = {
+        'UCL': np.char.mod('%.2f', profiles['UCL'].to_numpy(dtype=float)).astype(object),
+        'postcode': profiles['postcode'].astype('int64').astype(str).to_numpy(dtype=object),
+        'transaction_dt': profiles['transaction_dt'].dt.strftime(LOOKUP_DT_FORMAT).to_numpy(dtype=object),
+    }
+    if scores is not None:
+        matched = scores.reindex(profiles['card_id'])
+        columns['score'] = matched.where(matched.notna(), None).to_numpy(dtype=object)
+    return columns
+
+
+# To upload a precomputed look_up_table CSV (card_id, transaction_dt, score, postcode, UCL)
+def upload_precomputed(connection, args):
+    df = pd.read_csv(args.precomputed, dtype=str).dropna(subset=['card_id'])
+    columns = {name: df[name].where(df[name].notna(), None).to_numpy(dtype=object)
+               for name in ('transaction_dt', 'score', 'postcode', 'UCL')}
+    batch_insert_data(connection, args.table, df['card_id'].to_numpy(), columns, args.batch_size, args.format)
+
+
+def build(connection, args):
+    if not args.incremental and not args.scores:
+        # Cards without an info:score are scored as 0, which makes every one of their transactions FRAUD
+        raise SystemExit("A full build needs --scores (an incremental build keeps the stored scores)")
+    state = State(args.state_dir, args.window)
+    if args.incremental:
+        recent, watermark = state.load()
+        print(f"Incremental build from {watermark}")
+    else:
+        recent, watermark = None, None
+
+    changed = set()
+    latest = watermark
+    for chunk in read_genuine(args.history, args.chunk_size, watermark):
+        if watermark is not None:
+            chunk = drop_seen(chunk, recent, watermark)
+        if chunk.empty:
+            continue
+        changed.update(chunk['card_id'].unique())
+        latest = chunk['transaction_dt'].max() if latest is None else max(latest, chunk['transaction_dt'].max())
+        recent = merge_recent(recent, chunk, args.window)
+    print(f"{len(changed)} cards with new genuine transactions")
+    if recent is None:
+        print("No genuine transactions found")
+        return
+
+    scores = load_scores(args.scores) if args.scores else None
+    profiles = build_profiles(recent[recent['card_id'].isin(changed)])
+    batch_insert_data(connection, args.table, profiles['card_id'].to_numpy(),
+                      profile_columns(profiles, scores), args.batch_size, args.format)
+
+    if scores is not None and not args.incremental:
+        # Cards without genuine transactions still get their score
+        rest = scores[~scores.index.isin(changed)]
+        batch_insert_data(connection, args.table, rest.index.to_numpy(),
+                          {'score': rest.to_numpy(dtype=object)}, args.batch_size, args.format)
+
+    if latest is not None:
+        state.save(recent, latest)
+
+
+def main():
+    args = parse_args()
+    connection = happybase.Connection(args.host, port=args.port)
+    try:
+        # Create the lookup table
+        create_table(connection, args.table, {'info': dict(max_versions=5)})
+        if args.precomputed:
+            upload_precomputed(connection, args)
+        else:
+            build(connection, args)
+    finally:
+        connection.close()
+
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Rewrites card_transactions rows into the salted, time-ordered key layout.
+
+Rows written by the old loader (sequential integer keys) and by the old streaming
+job (card_id.member_id.timestamp.suffix keys) get the key row_keys.transaction_key
+derives from their cells, the one the loader and the sink now use. Rows already in
+the new layout are left alone, so the tool can be stopped and run again.
+
+    python migrate_row_keys.py --delete-old                        # in place
+    python migrate_row_keys.py --target card_transactions_v2       # into a new table
+"""
+import argparse
+import os
+import sys
+import time
+
+import happybase
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'python', 'src'))
+from db import row_keys
+
+KEY_COLUMNS = [b'info:card_id', b'info:transaction_dt', b'info:member_id', b'info:amount', b'info:postcode',
+               b'info:pos_id']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--source', default='card_transactions')
+    parser.add_argument('--target', default=None, help='table to write to (default: the source table)')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=9090)
+    parser.add_argument('--batch-size', type=int, default=1000, help='mutations per HBase batch')
+    parser.add_argument('--scan-batch', type=int, default=1000, help='rows fetched per scanner call')
+    parser.add_argument('--delete-old', action='store_true', help='delete each row under its old key once copied')
+    parser.add_argument('--dry-run', action='store_true', help='only count what would be migrated')
+    return parser.parse_args()
+
+
+# To compute the new key of a row from its cells, None if a key cell is missing or invalid
+def new_key(row):
+    values = [row.get(column, b'').decode('utf-8') for column in KEY_COLUMNS]
+    card_id, transaction_dt, member_id, amount, postcode, pos_id = values
+    parsed_dt = row_keys.parse_transaction_dt(transaction_dt)
+    if not card_id or parsed_dt is None:
+        return None
+    return row_keys.transaction_key(card_id, parsed_dt, member_id, amount, postcode, pos_id)
+
+
+def migrate(args):
+    connection = happybase.Connection(args.host, port=args.port)
+    target_name = args.target or args.source
+    if target_name.encode('utf-8') not in connection.tables():
+        connection.create_table(target_name, {'info': dict()})
+        print(f"Table {target_name} created")
+    source = connection.table(args.source)
+    target = connection.table(target_name)
+
+    counts = {'migrated': 0, 'already': 0, 'invalid': 0}
+    started = time.time()
+    writes = target.batch(batch_size=args.batch_size)
+    deletes = source.batch(batch_size=args.batch_size)
+    try:
+        for key, row in source.scan(batch_size=args.scan_batch):
+            key = key.decode('utf-8')
+            if row_keys.is_transaction_key(key):
+                counts['already'] += 1
+                continue
+            migrated_key = new_key(row)
+            if migrated_key is None:
+                counts['invalid'] += 1
+                print(f"Skipping row {key}: no card_id or unparseable transaction_dt")
+                continue
+            counts['migrated'] += 1
+            if not args.dry_run:
+                writes.put(migrated_key.encode('utf-8'), row)
+                if args.delete_old:
+                    deletes.delete(key.encode('utf-8'))
+            if counts['migrated'] % 100000 == 0:
+                print(f"{counts['migrated']} rows migrated, {counts['migrated'] / (time.time() - started):.0f} rows/sec")
+        # New rows first, so a failure never leaves a transaction under neither key
+        writes.send()
+        deletes.send()
+    finally:
+        connection.close()
+    print(f"Done in {time.time() - started:.1f}s: {counts}")
+
+
+if __name__ == '__main__':
+    migrate(parse_args())
@@ -0,0 +1,89 @@
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import registry
+
+
+def worker_count(in_flight, retries):
+    """Threads (and HBase connections) needed to run every attempt of in_flight requests at once."""
+    return in_flight * (retries + 1)
+
+
+class AsyncFetcher:
+    """
+    Concurrent multi-row reads over a storage backend.
+
+    The keys are split into requests of chunk_size keys and up to in_flight of them
+    are outstanding at once, so a partition waits about as long as its slowest round
+    of requests rather than the sum of all of them. The backend calls are blocking
+    (happybase Thrift clients), so an asyncio loop drives them on a thread pool. A
+    timed-out call is abandoned but keeps its thread (and, with the HBase backend,
+    its connection) until it returns, so the pool has worker_count() threads: enough
+    for every attempt of in_flight requests, so a retry never waits for a thread
+    inside its own timeout. HBaseDao sizes the connection pool to match.
+
+    A request that fails or exceeds timeout seconds is retried up to retries times,
+    waiting backoff * 2^attempt seconds (with jitter) in between.
+    """
+
+    def __init__(self, backend, in_flight=8, chunk_size=100, timeout=2.0, retries=2, backoff=0.05):
+        self.backend = backend
+        self.in_flight = in_flight
+        self.chunk_size = chunk_size
+        self.timeout = timeout  # Seconds per request, None to wait for the backend's own timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(max_workers=worker_count(in_flight, retries),
+                                           thread_name_prefix='async-fetch')
+
+    def fetch(self, table, keys):
+        """
+        Read the rows of the given keys (bytes) and return them in the order of keys:
+        a dict per key, empty when the row does not exist, None when its request failed.
+        """
+        return asyncio.run(self.fetch_async(table, keys))
+
+    async def fetch_async(self, table, keys):
+        """Coroutine version of fetch(), for callers that already run an event loop."""
+        keys = list(keys)
+        results = [None] * len(keys)
+        semaphore = asyncio.Semaphore(self.in_flight)
+        chunks = [range(start, min(start + self.chunk_size, len(keys)))
+                  for start in range(0, len(keys), self.chunk_size)]
+        await asyncio.gather(*(self.fetch_chunk(semaphore, table, keys, positions, results)
+                               for positions in chunks))
+        return results
+
+    async def fetch_chunk(self, semaphore, table, keys, positions, results):
+        # Fill results at the chunk's positions; they stay None if every attempt fails
+        chunk = [keys[position] for position in positions]
+        async with semaphore:
+            for attempt in range(self.retries + 1):
+                started = time.perf_counter()
+                try:
+                    rows = dict(await self.request(table, chunk))
+                    registry.REGISTRY.observe('storage_seconds', time.perf_counter() - started,
+                                              operation='async_fetch')
+                    for position, key in zip(positions, chunk):
+                        results[position] = rows.get(key, {})
+                    return
+                except Exception as e:
+                    registry.REGISTRY.inc('storage_errors', operation='async_fetch')
+                    if attempt == self.retries:
+                        print(f"Error retrieving data: {e!r} ({len(chunk)} keys, {attempt + 1} attempts)")
+                        return
+                    registry.REGISTRY.inc('storage_retries', operation='async_fetch')
+                    await asyncio.sleep(self.backoff * 2 ** attempt * (0.5 + random.random()))
+
+    async def request(self, table, chunk):
+        # One multi-row read on a worker thread. A timed-out read is abandoned, not interrupted:
+        # its thread stays busy until the backend returns or its socket timeout fires
+        loop = asyncio.get_running_loop()
+        call = loop.run_in_executor(self.executor, self.backend.rows, table, chunk)
+        return await asyncio.wait_for(call, self.timeout)
+
+    def close(self):
+        """Stop the worker threads."""
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,228 @@
+import sqlite3
+import threading
+
+
+class StorageBackend:
+    """
+    Storage behind HBaseDao.
+
+    Rows are dicts mapping b'family:qualifier' column names to bytes values, the
+    same shape happybase returns, so callers do not depend on the backend used.
+    """
+
+    def row(self, table, key):
+        """Return the row stored under key, or an empty dict."""
+        raise NotImplementedError
+
+    def rows(self, table, keys):
+        """Return (key, row) pairs for the keys that exist."""
+        raise NotImplementedError
+
+    def scan(self, table, row_start, row_stop, limit=None):
+        """Return (key, row) pairs with row_start <= key < row_stop in key order, at most limit of them."""
+        raise NotImplementedError
+
+    def put(self, table, key, data):
+        """Store the given cells under key, merging them into the existing row."""
+        raise NotImplementedError
+
+    def put_many(self, table, items, batch_size):
+        """Store (key, data) pairs in batches and return how many were written."""
+        raise NotImplementedError
+
+    def tables(self):
+        """Return the names of the existing tables as bytes."""
+        raise NotImplementedError
+
+    def create_table(self, table, families):
+        """Create a table with the given column families."""
+        raise NotImplementedError
+
+    def close(self):
+        """Release the resources held by the backend."""
+
+
+class HBaseBackend(StorageBackend):
+    """HBase through a pool of happybase Thrift connections, reconnecting when a call fails."""
+
+    def __init__(self, host, port=9090, pool_size=4, timeout=None, retries=1):
+        import happybase
+        from thriftpy2.thrift import TException
+        self.transient_errors = (TException, IOError)
+        self.retries = retries
+        # The pool hands each thread its own connection and replaces connections that
+        # fail with a Thrift or socket error
+        self.pool = happybase.ConnectionPool(size=pool_size, host=host, port=port, timeout=timeout)
+
+    def call(self, operation):
+        """Run operation(connection) on a pooled connection, retrying on a fresh one after a failure."""
+        for attempt in range(self.retries + 1):
+            try:
+                with self.pool.connection() as connection:
+                    return operation(connection)
+            except self.transient_errors as e:
+                if attempt == self.retries:
+                    raise
+                print(f"HBase call failed, reconnecting: {e}")
+
+    def row(self, table, key):
+        return self.call(lambda connection: connection.table(table).row(key))
+
+    def rows(self, table, keys):
+        return self.call(lambda connection: connection.table(table).rows(keys))
+
+    def scan(self, table, row_start, row_stop, limit=None):
+        # The scanner is consumed inside the call so a failure is retried as a whole
+        return self.call(lambda connection: list(connection.table(table).scan(
+            row_start=row_start, row_stop=row_stop, limit=limit, batch_size=min(limit or 1000, 1000))))
+
+    def put(self, table, key, data):
+        self.call(lambda connection: connection.table(table).put(key, data))
+
+    def put_many(self, table, items, batch_size):
+        # Items may be a one-shot generator, so a failed batch write is not retried
+        with self.pool.connection() as connection:
+            count = 0
+            with connection.table(table).batch(batch_size=batch_size) as batch:
+                for key, data in items:
+                    batch.put(key, data)
+                    count += 1
+            return count
+
+    def tables(self):
+        return self.call(lambda connection: connection.tables())
+
+    def create_table(self, table, families):
+        self.call(lambda connection: connection.create_table(table, families))
+
+
+class MemoryBackend(StorageBackend):
+    """In-process dict storage, for tests and local runs without an HBase Thrift server."""
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def row(self, table, key):
+        with self.lock:
+            return dict(self.data.get(table, {}).get(key, {}))
+
+    def rows(self, table, keys):
+        with self.lock:
+            stored = self.data.get(table, {})
+            return [(key, dict(stored[key])) for key in keys if key in stored]
+
+    def scan(self, table, row_start, row_stop, limit=None):
+        with self.lock:
+            stored = self.data.get(table, {})
+            keys = sorted(key for key in stored if row_start <= key < row_stop)[:limit]
+            return [(key, dict(stored[key])) for key in keys]
+
+    def put(self, table, key, data):
+        with self.lock:
+            self.data.setdefault(table, {}).setdefault(key, {}).update(data)
+
+    def put_many(self, table, items, batch_size):
+        count = 0
+        for key, data in items:
+            self.put(table, key, data)
+            count += 1
+        return count
+
+    def tables(self):
+        with self.lock:
+            return [table.encode('utf-8') for table in self.data]
+
+    def create_table(self, table, families):
+        with self.lock:
+            self.data.setdefault(table, {})
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    Single-file storage with one SQL row per cell.
+
+    The file can be shared by several processes (for example all Python workers
+    of a local Spark run), which makes it a stand-in for HBase in load tests.
+    """
+
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+        connection = self.connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS cells ("
+                           "tbl TEXT, row BLOB, col BLOB, val BLOB, PRIMARY KEY (tbl, row, col)) WITHOUT ROWID")
+        connection.execute("CREATE TABLE IF NOT EXISTS tables (tbl TEXT PRIMARY KEY)")
+        connection.commit()
+
+    def connection(self):
+        """Return the SQLite connection of the calling thread."""
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def row(self, table, key):
+        cursor = self.connection().execute("SELECT col, val FROM cells WHERE tbl = ? AND row = ?", (table, key))
+        return {bytes(column): bytes(value) for column, value in cursor}
+
+    def rows(self, table, keys):
+        found = {}
+        keys = list(keys)
+        # Stay below SQLite's limit on bound parameters
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            cursor = self.connection().execute(
+                f"SELECT row, col, val FROM cells WHERE tbl = ? AND row IN ({','.join('?' * len(chunk))})",
+                [table] + chunk)
+            for key, column, value in cursor:
+                found.setdefault(bytes(key), {})[bytes(column)] = bytes(value)
+        return [(key, found[key]) for key in keys if key in found]
+
+    def scan(self, table, row_start, row_stop, limit=None):
+        cursor = self.connection().execute(
+            "SELECT row, col, val FROM cells WHERE tbl = ? AND row IN ("
+            "SELECT DISTINCT row FROM cells WHERE tbl = ? AND row >= ? AND row < ? ORDER BY row LIMIT ?) ORDER BY row",
+            (table, table, row_start, row_stop, -1 if limit is None else limit))
+        found = {}
+        for key, column, value in cursor:
+            found.setdefault(bytes(key), {})[bytes(column)] = bytes(value)
+        return list(found.items())
+
+    def put(self, table, key, data):
+        self.put_many(table, [(key, data)], 1)
+
+    def put_many(self, table, items, batch_size):
+        connection = self.connection()
+        count = 0
+        pending = []
+        for key, data in items:
+            pending.extend((table, key, column, value) for column, value in data.items())
+            count += 1
+            if count % batch_size == 0:
+                self.write_cells(connection, pending)
+                pending = []
+        if pending:
+            self.write_cells(connection, pending)
+        return count
+
+    def write_cells(self, connection, cells):
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO cells VALUES (?, ?, ?, ?)", cells)
+
+    def tables(self):
+        return [table.encode('utf-8') for table, in self.connection().execute("SELECT tbl FROM tables")]
+
+    def create_table(self, table, families):
+        with self.connection() as connection:
+            connection.execute("INSERT OR IGNORE INTO tables VALUES (?)", (table,))
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
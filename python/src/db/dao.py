@@ -1,7 +1,100 @@
-import happybase
+import os
+import threading
+import time
+
+from db import async_fetch
+from db import backends
+from db import profile_cache
+from db import profile_format
+from db import row_keys
+from metrics import registry
+
+PROFILE_TABLE = 'look_up_table'  # Table whose rows are kept in the profile cache
+TRANSACTIONS_TABLE = 'card_transactions'  # Keyed by row_keys.transaction_key
+
+# Format of info:transaction_dt in look_up_table, as written by load_lookuptable.py
+LOOKUP_DT_FORMAT = profile_format.LOOKUP_DT_FORMAT
+
+
+def lookup_key(card_id):
+    # Row key of a card in look_up_table, in the storage layout set by FRAUD_PROFILE_FORMAT
+    return profile_format.lookup_key(card_id)
+
+
+def transaction_cells(row):
+    # Cells of a scored transaction in card_transactions
+    return {
+        b'info:card_id': str(row.card_id).encode('utf-8'),
+        b'info:member_id': str(row.member_id).encode('utf-8'),
+        b'info:amount': str(row.amount).encode('utf-8'),
+        b'info:postcode': str(row.postcode).encode('utf-8'),
+        b'info:pos_id': str(row.pos_id).encode('utf-8'),
+        b'info:transaction_dt': str(row.transaction_dt).encode('utf-8'),
+        b'info:status': str(row.status).encode('utf-8')
+    }
+
+
+def lookup_cells(row):
+    # Cells of look_up_table updated by a genuine transaction
+    return {
+        b'info:transaction_dt': row.transaction_dt.strftime(LOOKUP_DT_FORMAT).encode('utf-8'),
+        b'info:postcode': str(row.postcode).encode('utf-8')
+    }
+
+
+def default_settings():
+    # Settings are read from the environment so that executors (spark.executorEnv.*) get them too
+    return {
+        'backend': os.environ.get('FRAUD_DAO_BACKEND', 'hbase'),  # hbase, sqlite or memory
+        'host': os.environ.get('FRAUD_HBASE_HOST', 'ec2-44-205-16-47.compute-1.amazonaws.com'),
+        'port': int(os.environ.get('FRAUD_HBASE_PORT', '9090')),
+        'pool_size': int(os.environ.get('FRAUD_DAO_POOL_SIZE', '4')),  # Thrift connections per process
+        'timeout': int(os.environ.get('FRAUD_HBASE_TIMEOUT_MS', '10000')),  # Socket timeout in milliseconds
+        'retries': int(os.environ.get('FRAUD_DAO_RETRIES', '1')),  # Reconnect attempts after a failed call
+        'sqlite_path': os.environ.get('FRAUD_DAO_SQLITE_PATH', 'fraud_detection.db'),
+        # Off by default: write-through only reaches the Python worker that wrote, so with the cache on other
+        # workers score against a last postcode/time (and a missing row for new cards) up to the TTL old
+        'profile_cache_size': int(os.environ.get('FRAUD_PROFILE_CACHE_SIZE', '0')),  # 0 disables the cache
+        'profile_cache_ttl': float(os.environ.get('FRAUD_PROFILE_CACHE_TTL', '60')) or None,  # Seconds, 0 for no TTL
+        'fetch_mode': os.environ.get('FRAUD_FETCH_MODE', 'multiget'),  # multiget (sequential) or async (concurrent)
+        'fetch_in_flight': int(os.environ.get('FRAUD_FETCH_IN_FLIGHT', '8')),  # Concurrent requests in async mode
+        'fetch_chunk_size': int(os.environ.get('FRAUD_FETCH_CHUNK_SIZE', '100')),  # Keys per async request
+        'fetch_timeout': float(os.environ.get('FRAUD_FETCH_TIMEOUT', '2')) or None,  # Seconds per request, 0 for none
+        'fetch_retries': int(os.environ.get('FRAUD_FETCH_RETRIES', '2')),  # Retries of a failed async request
+        'fetch_backoff': float(os.environ.get('FRAUD_FETCH_BACKOFF', '0.05')),  # Seconds before the first retry
+    }
+
+
+def create_backend(settings):
+    # Build the storage backend selected in the settings
+    if settings['backend'] == 'hbase':
+        pool_size = settings['pool_size']
+        if settings['fetch_mode'] == 'async':
+            # Every async fetch thread holds a connection; with fewer, requests would wait for one inside their timeout
+            pool_size = max(pool_size, async_fetch.worker_count(settings['fetch_in_flight'], settings['fetch_retries']))
+        return backends.HBaseBackend(settings['host'], port=settings['port'], pool_size=pool_size,
+                                     timeout=settings['timeout'], retries=settings['retries'])
+    if settings['backend'] == 'sqlite':
+        return backends.SQLiteBackend(settings['sqlite_path'])
+    if settings['backend'] == 'memory':
+        return backends.MemoryBackend()
+    raise ValueError(f"Unknown storage backend: {settings['backend']}")
+
+
+def create_fetcher(backend, settings):
+    # Concurrent reader for get_many() in async fetch mode, None for sequential multi-row reads
+    if settings['fetch_mode'] == 'multiget':
+        return None
+    if settings['fetch_mode'] == 'async':
+        return async_fetch.AsyncFetcher(backend, in_flight=settings['fetch_in_flight'],
+                                        chunk_size=settings['fetch_chunk_size'], timeout=settings['fetch_timeout'],
+                                        retries=settings['fetch_retries'], backoff=settings['fetch_backoff'])
+    raise ValueError(f"Unknown fetch mode: {settings['fetch_mode']}")
+
 
 class HBaseDao:
     _instance = None  # Class-level attribute for the singleton instance
+    _settings = None  # Overrides of the environment settings, see configure()
 
     @staticmethod
     def get_instance():
@@ -10,44 +103,97 @@ class HBaseDao:
             HBaseDao()  # Create an instance if it does not exist
         return HBaseDao._instance
 
+    @staticmethod
+    def configure(**settings):
+        # Override settings (host, pool_size, backend, ...) before the singleton is created
+        if HBaseDao._instance is not None:
+            raise Exception("HBaseDao is already initialized!")
+        HBaseDao._settings = settings
+
     def __init__(self):
         # Initialize the singleton instance
         if HBaseDao._instance is not None:
             raise Exception("This class is a singleton!")  # Prevent multiple instances
         else:
-            HBaseDao._instance = self  # Set the singleton instance
+            settings = default_settings()
+            settings.update(HBaseDao._settings or {})
             try:
-                # Establish the connection to HBase Thrift server
-                self.connection = happybase.Connection('ec2-44-205-16-47.compute-1.amazonaws.com', port=9090)
-                self.connection.open()  # Open the connection
+                # Connect to the configured storage (a pool of HBase Thrift connections by default)
+                self.backend = create_backend(settings)
             except Exception as e:
                 # Handle and print any connection errors
                 print(f"Error connecting to HBase: {e}")
                 raise
+            self.fetcher = create_fetcher(self.backend, settings)
+            self.profile_cache = None
+            if settings['profile_cache_size'] > 0:
+                # Profiles are read far more often than they change: keep hot ones in memory
+                self.profile_cache = profile_cache.ProfileCache(settings['profile_cache_size'],
+                                                                settings['profile_cache_ttl'])
+            self.latency = {}  # Per-operation [calls, errors, total seconds, max seconds]
+            self.latency_lock = threading.Lock()
+            HBaseDao._instance = self  # Set the singleton instance
 
-    def get_data(self, key, table):
-        # Retrieve data from HBase for a given key and table
+    def record(self, operation, started, failed=False):
+        # Add the duration of one call to the latency counters of an operation
+        elapsed = time.perf_counter() - started
+        with self.latency_lock:
+            counters = self.latency.setdefault(operation, [0, 0, 0.0, 0.0])
+            counters[0] += 1
+            counters[1] += int(failed)
+            counters[2] += elapsed
+            counters[3] = max(counters[3], elapsed)
+        registry.REGISTRY.observe('storage_seconds', elapsed, operation=operation)
+        if failed:
+            registry.REGISTRY.inc('storage_errors', operation=operation)
+
+    def stats(self):
+        # Snapshot of the per-operation latency counters
+        with self.latency_lock:
+            return {
+                operation: {'calls': calls, 'errors': errors, 'total_seconds': total,
+                            'avg_seconds': total / calls if calls else 0.0, 'max_seconds': longest}
+                for operation, (calls, errors, total, longest) in self.latency.items()
+            }
+
+    def profile_cache_stats(self):
+        # Hit/miss/eviction counters of the profile cache, None when it is disabled
+        return self.profile_cache.stats() if self.profile_cache is not None else None
+
+    def cache_for(self, table):
+        # The profile cache if it applies to the given table
+        return self.profile_cache if table == PROFILE_TABLE else None
+
+    def decode_row(self, table, row):
+        # Profiles are returned (and cached) in the cell layout, also when they are stored packed
+        return profile_format.expand(row) if table == PROFILE_TABLE else row
+
+    def read_row(self, key, table):
+        # Retrieve data from HBase for a given key and table; unlike get_data, a failed read raises
+        started = time.perf_counter()
         try:
             if not isinstance(key, str):
                 # Debug information for non-string keys
                 print(f"Debug: Key is not a string. Type: {type(key)}, Value: {key}")
                 key = str(key)  # Convert the key to string if it's not already
-            table = self.connection.table(table)  # Get the HBase table
-            row = table.row(bytes(key, 'utf-8'))  # Retrieve the row by key
-            if row is None:
-                # Return default values if no row is found
-                return {
-                    'info:UCL': 0,
-                    'info:transaction_dt': '',
-                    'info:postcode': '',
-                    'info:pos_id': '',
-                    'info:card_id': '',
-                    'info:amount': '',
-                    'info:member_id': '',
-                    'info:status': ''
-                }
-            else:
-                return row  # Return the retrieved row
+            row_key = bytes(key, 'utf-8')
+            cache = self.cache_for(table)
+            row = cache.get(row_key) if cache is not None else None
+            if row is not None:
+                return row  # Served from the profile cache
+            row = self.decode_row(table, self.backend.row(table, row_key))  # Retrieve the row by key
+            if cache is not None:
+                cache.put(row_key, row)
+            self.record('get_data', started)
+            return row  # Return the retrieved row, empty if there is none
+        except Exception:
+            self.record('get_data', started, failed=True)
+            raise
+
+    def get_data(self, key, table):
+        # Retrieve data from HBase for a given key and table, placeholder values if the read fails
+        try:
+            return self.read_row(key, table)
         except Exception as e:
             # Handle and print any errors during data retrieval
             print(f"Error retrieving data: {e}")
@@ -64,13 +210,144 @@ class HBaseDao:
 
     def write_data(self, key, data, table):
         # Write data to HBase for a given key and table
+        started = time.perf_counter()
         try:
-            if not isinstance(key, str):
+            if isinstance(key, bytes):
+                key = key.decode('utf-8')
+            elif not isinstance(key, str):
                 # Debug information for non-string keys
                 print(f"Debug: Key is not a string. Type: {type(key)}, Value: {key}")
                 key = str(key)  # Convert the key to string if it's not already
-            table = self.connection.table(table)  # Get the HBase table
-            table.put(bytes(key, 'utf-8'), data)  # Put data into the table
+            self.backend.put(table, bytes(key, 'utf-8'), data)  # Put data into the table
+            cache = self.cache_for(table)
+            if cache is not None:
+                cache.update(bytes(key, 'utf-8'), self.decode_row(table, data))  # Write-through to the profile cache
+            self.record('write_data', started)
         except Exception as e:
             # Handle and print any errors during data writing
+            self.record('write_data', started, failed=True)
+            print(f"Error writing data: {e}")
+
+    def get_many(self, keys, table, chunk_size=1000):
+        # Retrieve several rows from HBase with multi-row reads instead of one get per key
+        keys = [key if isinstance(key, str) else str(key) for key in keys]
+        result = {key: {} for key in keys}  # Missing rows come back empty, like get_data()
+        cache = self.cache_for(table)
+        if cache is not None:
+            # Only the keys missing from the profile cache go to storage
+            missing = []
+            for key in result:
+                row = cache.get(bytes(key, 'utf-8'))
+                if row is None:
+                    missing.append(key)
+                else:
+                    result[key] = row
+            registry.REGISTRY.inc('profile_cache_lookups', len(result) - len(missing), result='hit')
+            registry.REGISTRY.inc('profile_cache_lookups', len(missing), result='miss')
+            keys = missing
+        if not keys:
+            return result
+        if self.fetcher is not None:
+            return self.fetch_concurrently(keys, table, result, cache)
+        started = time.perf_counter()
+        try:
+            for start in range(0, len(keys), chunk_size):
+                # Bound the size of each Thrift call on very large batches
+                chunk = [bytes(key, 'utf-8') for key in keys[start:start + chunk_size]]
+                for row_key, row in self.backend.rows(table, chunk):
+                    result[row_key.decode('utf-8')] = self.decode_row(table, row)
+            if cache is not None:
+                for key in keys:
+                    cache.put(bytes(key, 'utf-8'), result[key])
+            self.record('get_many', started)
+        except Exception as e:
+            # Handle and print any errors during data retrieval
+            self.record('get_many', started, failed=True)
+            print(f"Error retrieving data: {e}")
+        return result
+
+    def fetch_concurrently(self, keys, table, result, cache):
+        # get_many() through the async fetcher: concurrent chunked reads, retried on failure.
+        # Keys whose request still failed come back empty and are not cached
+        started = time.perf_counter()
+        rows = self.fetcher.fetch(table, [bytes(key, 'utf-8') for key in keys])
+        failed = 0
+        for key, row in zip(keys, rows):
+            if row is None:
+                failed += 1
+                continue
+            row = self.decode_row(table, row)
+            result[key] = row
+            if cache is not None:
+                cache.put(bytes(key, 'utf-8'), row)
+        self.record('get_many', started, failed=failed > 0)
+        return result
+
+    def scan_card_history(self, card_id, limit=10, since=None, table=TRANSACTIONS_TABLE):
+        # Latest transactions of a card, newest first: one bounded scan over the card's key prefix.
+        # since (a datetime) leaves out older transactions
+        started = time.perf_counter()
+        row_start, row_stop = row_keys.history_range(card_id, since)
+        try:
+            rows = self.backend.scan(table, row_start.encode('utf-8'), row_stop.encode('utf-8'), limit)
+            self.record('scan_card_history', started)
+            return [row for _, row in rows]
+        except Exception as e:
+            # Handle and print any errors during data retrieval
+            self.record('scan_card_history', started, failed=True)
+            print(f"Error scanning card history: {e}")
+            return []
+
+    def write_batch(self, rows, table, batch_size=1000):
+        # Write (key, data) pairs to HBase through batched mutations instead of one put per row
+        started = time.perf_counter()
+        cache = self.cache_for(table)
+        written = []  # Profile rows to write through once the batch is stored
+        def items():
+            for key, data in rows:
+                key = key if isinstance(key, bytes) else bytes(str(key), 'utf-8')
+                if cache is not None:
+                    written.append((key, data))
+                yield key, data
+        try:
+            count = self.backend.put_many(table, items(), batch_size)
+            for key, data in written:
+                cache.update(key, self.decode_row(table, data))  # Write-through to the profile cache
+            self.record('write_batch', started)
+            return count
+        except Exception as e:
+            # Bulk writes must not be lost silently: report and let the caller retry
+            self.record('write_batch', started, failed=True)
+            for key, _ in written:
+                cache.invalidate(key)  # Part of the batch may not have been stored
             print(f"Error writing data: {e}")
+            raise
+
+    def write_profile_updates(self, updates, batch_size=1000):
+        # Write look_up_table updates, (key, cells) pairs in the cell layout such as lookup_cells().
+        # A packed profile is one cell, so each update is merged into the card's stored profile first;
+        # the stored profiles are read straight from storage, and a failed read fails the write
+        if profile_format.PROFILE_FORMAT != 'packed':
+            return self.write_batch(updates, PROFILE_TABLE, batch_size)
+        updates = [(key if isinstance(key, bytes) else bytes(str(key), 'utf-8'), cells) for key, cells in updates]
+        stored = {}
+        for start in range(0, len(updates), batch_size):
+            chunk = list(dict.fromkeys(key for key, _ in updates[start:start + batch_size]))
+            for row_key, row in self.backend.rows(PROFILE_TABLE, chunk):
+                stored[row_key] = profile_format.expand(row)
+        merged = []
+        for key, cells in updates:
+            # Later updates of a card build on earlier ones in the same call
+            profile = {b'info:card_id': key, **stored.get(key, {}), **cells}
+            stored[key] = profile
+            try:
+                merged.append((key, profile_format.packed_cells(profile)))
+            except ValueError as e:
+                # One card id that cannot be packed must not fail the other updates
+                print(f"Error packing profile {key!r}: {e}")
+        return self.write_batch(merged, PROFILE_TABLE, batch_size)
+
+    def ensure_table(self, table, families):
+        # Create a table if it does not exist yet
+        if bytes(table, 'utf-8') not in self.backend.tables():
+            self.backend.create_table(table, families)
@@ -1,9 +1,104 @@
 import math
+import mmap
+import os
+import struct
+import time
+import numpy as np
 import pandas as pd
 
+from metrics import registry
+
+# Location of the zip code file, overridable for local runs
+ZIP_CSV = os.environ.get('FRAUD_ZIP_CSV', 'hdfs:///sharma/uszipsv.csv')
+
+# Prebuilt binary form of the zip file (see write_artifact), used instead of the CSV when set:
+# a local path, or the name of a file shipped with SparkContext.addFile
+ZIP_ARTIFACT = os.environ.get('FRAUD_ZIP_ARTIFACT')
+
+# Artifact layout: header (magic, array size), then known flags (uint8), latitudes and
+# longitudes (float32), each array indexed by zip and starting on an 8-byte boundary
+ARTIFACT_MAGIC = b'ZIPGEO01'
+ARTIFACT_HEADER = struct.Struct('<8sQ')
+
+
+def aligned(offset):
+    return (offset + 7) // 8 * 8
+
+
+def write_artifact(zips, lats, longs, path):
+    """Write the zip index built from the given columns as an artifact file."""
+    index = GEO_Map.__new__(GEO_Map)
+    index.build_index(zips, lats, longs)
+    size = len(index.known)
+    with open(path, 'wb') as handle:
+        handle.write(ARTIFACT_HEADER.pack(ARTIFACT_MAGIC, size))
+        for array in (index.known.astype(np.uint8), index.lats.astype(np.float32), index.longs.astype(np.float32)):
+            handle.write(b'\0' * (aligned(handle.tell()) - handle.tell()))
+            handle.write(array.tobytes())
+    return size
+
+
+def read_csv(path):
+    """Zip, latitude and longitude columns of the zip code file."""
+    zip_map = pd.read_csv(path, header=None, names=['A', 'B', 'C', 'D', 'E'])
+    zips = zip_map['A'].astype(int).to_numpy()
+    lats = pd.to_numeric(zip_map['B'], errors='coerce').to_numpy(dtype=float)  # Latitude
+    longs = pd.to_numeric(zip_map['C'], errors='coerce').to_numpy(dtype=float)  # Longitude
+    return zips, lats, longs
+
+
+def artifact_path(name):
+    """Local path of the artifact: as given if it exists, otherwise the copy shipped with addFile."""
+    if os.path.exists(name):
+        return name
+    from pyspark import SparkFiles
+    return SparkFiles.get(os.path.basename(name))
+
+
+def map_artifact(path):
+    """
+    Memory-map an artifact and return its known, lats and longs arrays.
+
+    Nothing is parsed or copied: the arrays are views of the mapping, and the pages
+    are shared through the page cache by every Python worker of the host.
+    """
+    with open(path, 'rb') as handle:
+        buffer = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, size = ARTIFACT_HEADER.unpack_from(buffer)
+    if magic != ARTIFACT_MAGIC:
+        raise ValueError(f"{path} is not a zip artifact")
+    offset = aligned(ARTIFACT_HEADER.size)
+    known = np.frombuffer(buffer, dtype=np.uint8, count=size, offset=offset).view(bool)
+    offset = aligned(offset + size)
+    lats = np.frombuffer(buffer, dtype=np.float32, count=size, offset=offset)
+    offset = aligned(offset + 4 * size)  # Padded like every array, which matters when size is odd
+    longs = np.frombuffer(buffer, dtype=np.float32, count=size, offset=offset)
+    return known, lats, longs
+
+
+def warm_up(sc, tasks=None):
+    """
+    Load GEO_Map in the Python workers ahead of the first micro-batch, with one small
+    task per core by default. Executors added later still load on first use.
+    """
+    tasks = tasks or sc.defaultParallelism
+
+    def load(_):
+        GEO_Map.get_instance()
+        return []
+
+    started = time.perf_counter()
+    sc.parallelize(range(tasks), tasks).mapPartitions(load).count()
+    print(f"GEO_Map loaded on the executors in {time.perf_counter() - started:.1f}s ({tasks} tasks)")
+
 class GEO_Map:
     """
     Holds the map for zip code and its latitude and longitude.
+
+    The map is indexed by zip code: latitude and longitude live in dense arrays
+    whose position is the zip itself, so a lookup is a single array access.
+    With FRAUD_ZIP_ARTIFACT set the arrays are memory-mapped from the prebuilt
+    artifact (float32) instead of being parsed from the CSV.
     """
     __instance = None
 
@@ -20,27 +115,76 @@ class GEO_Map:
             raise Exception("This class is a singleton!")
         else:
             GEO_Map.__instance = self
-            # Read the CSV file
-            self.map = pd.read_csv("hdfs:///sharma/uszipsv.csv", header=None, names=['A', 'B', 'C', 'D', 'E'])
-            self.map['A'] = self.map['A'].astype(int)
-            self.map['B'] = pd.to_numeric(self.map['B'], errors='coerce')  # Latitude
-            self.map['C'] = pd.to_numeric(self.map['C'], errors='coerce')  # Longitude
+            started = time.perf_counter()
+            if ZIP_ARTIFACT:
+                # Map the prebuilt arrays instead of parsing the CSV
+                self.known, self.lats, self.longs = map_artifact(artifact_path(ZIP_ARTIFACT))
+            else:
+                # Read the CSV file
+                self.build_index(*read_csv(ZIP_CSV))
+            registry.REGISTRY.observe('geo_seconds', time.perf_counter() - started, operation='load')
+
+    def build_index(self, zips, lats, longs):
+        """Build the zip-indexed latitude and longitude arrays."""
+        keep = zips >= 0
+        zips, lats, longs = zips[keep], lats[keep], longs[keep]
+        size = int(zips.max()) + 1 if len(zips) else 1
+        self.known = np.zeros(size, dtype=bool)
+        self.lats = np.full(size, np.nan)
+        self.longs = np.full(size, np.nan)
+        # Assign in reverse so the first row of a duplicated zip wins, as with the old frame scan
+        self.known[zips] = True
+        self.lats[zips[::-1]] = lats[::-1]
+        self.longs[zips[::-1]] = longs[::-1]
+
+    def zip_frame(self):
+        """Return the indexed zips as a frame of zip, lat and long (one row per zip, first occurrence kept)."""
+        zips = np.flatnonzero(self.known)
+        return pd.DataFrame({'zip': zips.astype(np.int64), 'lat': self.lats[zips].astype(float),
+                             'long': self.longs[zips].astype(float)})
+
+    def index_of(self, pos_id):
+        """Return the array index of a postcode, or None if it is not in the map."""
+        if pos_id is None or isinstance(pos_id, (str, bytes)):
+            return None
+        try:
+            value = float(pos_id)
+        except (TypeError, ValueError):
+            return None
+        if not math.isfinite(value) or value != int(value):
+            return None
+        index = int(value)
+        if 0 <= index < len(self.known) and self.known[index]:
+            return index
+        return None
 
     def get_lat(self, pos_id):
         """Return latitude for a given postcode."""
-        result = self.map[self.map.A == pos_id]
-        if result.empty:
+        index = self.index_of(pos_id)
+        if index is None:
             print(f"Latitude for postcode {pos_id} not found.")
             return None
-        return result.B.iloc[0]
+        return float(self.lats[index])
 
     def get_long(self, pos_id):
         """Return longitude for a given postcode."""
-        result = self.map[self.map.A == pos_id]
-        if result.empty:
+        index = self.index_of(pos_id)
+        if index is None:
             print(f"Longitude for postcode {pos_id} not found.")
             return None
-        return result.C.iloc[0]
+        return float(self.longs[index])
+
+    def lookup_many(self, pos_ids):
+        """Return latitude and longitude arrays for an array of postcodes (NaN where not found)."""
+        pos_ids = pd.Series(pos_ids)
+        if pos_ids.dtype == object:
+            # Strings are not postcodes, as in index_of (the old frame scan compared them to integer zips)
+            pos_ids = pos_ids.where(~pos_ids.map(lambda value: isinstance(value, (str, bytes))))
+        pos_ids = pd.to_numeric(pos_ids, errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+        valid = np.isfinite(pos_ids) & (pos_ids >= 0) & (pos_ids < len(self.known)) & (pos_ids == np.floor(pos_ids))
+        index = np.where(valid, pos_ids, 0).astype(np.int64)
+        valid &= self.known[index]
+        return np.where(valid, self.lats[index], np.nan), np.where(valid, self.longs[index], np.nan)
 
     def distance(self, lat1, long1, lat2, long2):
         """Calculate the distance between two points on the Earth."""
@@ -62,6 +206,36 @@ class GEO_Map:
         dist = dist * 60 * 1.1515 * 1.609344  # Convert to kilometers
         return dist
 
+    def distance_arrays(self, lat1, long1, lat2, long2):
+        """Vectorized distance(): NaN wherever a coordinate is missing or out of range."""
+        lat1, long1, lat2, long2 = (np.asarray(a, dtype=float) for a in (lat1, long1, lat2, long2))
+        # NaN fails every comparison, so missing coordinates are caught by the range check too
+        valid = ((-90 <= lat1) & (lat1 <= 90) & (-180 <= long1) & (long1 <= 180) &
+                 (-90 <= lat2) & (lat2 <= 90) & (-180 <= long2) & (long2 <= 180))
+        theta = long1 - long2
+        dist = (np.sin(self.deg2rad(lat1)) * np.sin(self.deg2rad(lat2)) +
+                np.cos(self.deg2rad(lat1)) * np.cos(self.deg2rad(lat2)) * np.cos(self.deg2rad(theta)))
+        dist = np.clip(dist, -1.0, 1.0)
+        dist = self.rad2deg(np.arccos(dist))
+        dist = dist * 60 * 1.1515 * 1.609344  # Convert to kilometers
+        return np.where(valid, dist, np.nan)
+
+    def distance_many(self, zip_a, zip_b):
+        """Calculate the distances between two arrays of postcodes, pairwise."""
+        started = time.perf_counter()
+        lat1, long1 = self.lookup_many(zip_a)
+        lat2, long2 = self.lookup_many(zip_b)
+        distances = self.distance_arrays(lat1, long1, lat2, long2)
+        registry.REGISTRY.observe('geo_seconds', time.perf_counter() - started, operation='distance_many')
+        return distances
+
+    def distance_zip(self, zip_a, zip_b):
+        """Distance between two postcodes, NaN if either is not in the map."""
+        a, b = self.index_of(zip_a), self.index_of(zip_b)
+        if a is None or b is None:
+            return float('nan')
+        return float(self.distance_arrays(self.lats[a], self.longs[a], self.lats[b], self.longs[b]))
+
     def rad2deg(self, rad):
         """Convert radians to degrees."""
         return rad * 180.0 / math.pi
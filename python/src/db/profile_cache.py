@@ -0,0 +1,109 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Columns of a look_up_table row kept by the cache, in storage order
+PROFILE_COLUMNS = (b'info:card_id', b'info:score', b'info:UCL', b'info:postcode', b'info:transaction_dt')
+
+
+class ProfileCache:
+    """
+    Bounded LRU cache of look_up_table rows, with an optional time-to-live.
+
+    A row is stored as a tuple of its PROFILE_COLUMNS values rather than a dict,
+    which keeps the per-card footprint small. Cards without a row are cached too
+    (as all-None tuples), so unknown cards do not go back to HBase on every lookup.
+    """
+
+    def __init__(self, max_size=100000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl  # Seconds an entry stays valid, None to keep it until evicted
+        self.entries = OrderedDict()  # Row key -> (expiry time, values)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def pack(self, row):
+        return tuple(row.get(column) for column in PROFILE_COLUMNS)
+
+    def unpack(self, values):
+        return {column: value for column, value in zip(PROFILE_COLUMNS, values) if value is not None}
+
+    def expiry(self):
+        return time.monotonic() + self.ttl if self.ttl else None
+
+    def get(self, key):
+        """Return the cached row of a key, or None if it is not cached."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, values = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.unpack(values)
+
+    def put(self, key, row):
+        """Cache a row read from storage."""
+        with self.lock:
+            self.store(key, self.pack(row))
+
+    def update(self, key, data):
+        """
+        Write-through: merge cells just written to storage into the cached row, if any.
+
+        The entry keeps its expiry, so the TTL still bounds how long a card goes without
+        being read back from storage (where other writers' updates are); an entry that
+        has already expired is dropped rather than revived.
+        """
+        with self.lock:
+            entry = self.live_entry(key)
+            if entry is None:
+                return
+            expires_at, values = entry
+            merged = tuple(data.get(column, value) for column, value in zip(PROFILE_COLUMNS, values))
+            self.store(key, merged, expires_at)
+
+    def replace(self, key, row):
+        """Replace a cached row, keeping its expiry (see update); nothing is cached if the key is not."""
+        with self.lock:
+            entry = self.live_entry(key)
+            if entry is not None:
+                self.store(key, self.pack(row), entry[0])
+
+    def live_entry(self, key):
+        # The entry of a key, None if there is none or it has expired (it is then dropped)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] is not None and entry[0] <= time.monotonic():
+            del self.entries[key]
+            self.expirations += 1
+            return None
+        return entry
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def store(self, key, values, expires_at=None):
+        # A new entry gets a fresh expiry; a replaced one keeps the expiry it is given
+        self.entries[key] = (expires_at if expires_at is not None else self.expiry(), values)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        """Snapshot of the cache counters."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'evictions': self.evictions, 'expirations': self.expirations}
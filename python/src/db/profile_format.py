@@ -0,0 +1,106 @@
+import math
+import os
+import struct
+from datetime import datetime, timedelta
+
+# Storage layout of look_up_table profiles:
+#   cells   one UTF-8 string cell per field (info:card_id, info:score, info:UCL, info:postcode,
+#           info:transaction_dt), row key card_id + '.0' (the loader used to store card_id as a float)
+#   packed  one binary cell (PACKED_COLUMN) holding all fields, row key card_id
+PROFILE_FORMAT = os.environ.get('FRAUD_PROFILE_FORMAT', 'cells')
+
+PACKED_COLUMN = b'info:profile'
+PACKED_VERSION = 1
+
+# version, card_id, UCL, score, postcode, last transaction time (epoch milliseconds, UTC); big-endian, 31 bytes
+PACKED_STRUCT = struct.Struct('>Bqdhiq')
+
+# Values stored for a missing field; unpack() leaves the cell out, as if it had never been written
+MISSING_SCORE = -(2 ** 15)
+MISSING_POSTCODE = -1
+MISSING_MS = -(2 ** 63)
+
+# Format of info:transaction_dt in the cell layout
+LOOKUP_DT_FORMAT = '%Y-%m-%dT%H:%M:%S.000Z'
+EPOCH = datetime(1970, 1, 1)
+
+
+def lookup_key(card_id, profile_format=None):
+    """Row key of a card in look_up_table for a storage layout (PROFILE_FORMAT by default)."""
+    if (profile_format or PROFILE_FORMAT) == 'packed':
+        return str(card_id)
+    return str(card_id) + '.0'
+
+
+def text(cells, column):
+    value = cells.get(column)
+    if value is None:
+        return None
+    value = value.decode('utf-8') if isinstance(value, bytes) else str(value)
+    return value or None
+
+
+def pack(cells):
+    """
+    Pack a profile given in the cell layout (a dict of column -> bytes) into one
+    binary value. Missing or empty cells are stored as missing.
+    """
+    card_id = text(cells, b'info:card_id')
+    if card_id is not None and card_id.endswith('.0'):
+        # The old loader wrote card ids float-formatted ('340028465709212.0'); the digits are exact, only the suffix goes
+        card_id = card_id[:-2]
+    if card_id is None or not card_id.isdigit():
+        # Card ids are stored as integers: anything else (e.g. '4.01124E+15') would not read back as written
+        raise ValueError(f"A packed profile needs an integer info:card_id, got {card_id!r}")
+    score = text(cells, b'info:score')
+    UCL = text(cells, b'info:UCL')
+    postcode = text(cells, b'info:postcode')
+    transaction_dt = text(cells, b'info:transaction_dt')
+    if transaction_dt is None:
+        epoch_ms = MISSING_MS
+    else:
+        epoch_ms = (datetime.strptime(transaction_dt, LOOKUP_DT_FORMAT) - EPOCH) // timedelta(milliseconds=1)
+    return PACKED_STRUCT.pack(
+        PACKED_VERSION,
+        int(card_id),
+        math.nan if UCL is None else float(UCL),
+        MISSING_SCORE if score is None else int(float(score)),
+        MISSING_POSTCODE if postcode is None else int(float(postcode)),
+        epoch_ms,
+    )
+
+
+def unpack(value):
+    """Unpack a packed profile into the cell layout, leaving out missing fields."""
+    if not value or value[0] != PACKED_VERSION:
+        raise ValueError(f"Unsupported packed profile version: {value[:1]!r}")
+    _, card_id, UCL, score, postcode, epoch_ms = PACKED_STRUCT.unpack(value)
+    cells = {b'info:card_id': str(card_id).encode('utf-8')}
+    if not math.isnan(UCL):
+        cells[b'info:UCL'] = repr(UCL).encode('utf-8')
+    if score != MISSING_SCORE:
+        cells[b'info:score'] = str(score).encode('utf-8')
+    if postcode != MISSING_POSTCODE:
+        cells[b'info:postcode'] = str(postcode).encode('utf-8')
+    if epoch_ms != MISSING_MS:
+        transaction_dt = EPOCH + timedelta(milliseconds=epoch_ms)
+        cells[b'info:transaction_dt'] = transaction_dt.strftime(LOOKUP_DT_FORMAT).encode('utf-8')
+    return cells
+
+
+def packed_cells(cells):
+    """The cells to store for a profile given in the cell layout, in the packed layout."""
+    return {PACKED_COLUMN: pack(cells)}
+
+
+def expand(row):
+    """
+    A look_up_table row in the cell layout, whichever layout it is stored in, so
+    readers only deal with one. A packed cell takes precedence over string cells.
+    """
+    value = row.get(PACKED_COLUMN)
+    if value is None:
+        return row
+    cells = {column: cell for column, cell in row.items() if column != PACKED_COLUMN}
+    cells.update(unpack(value))
+    return cells
@@ -0,0 +1,76 @@
+import calendar
+import zlib
+from datetime import datetime
+
+# Row keys of card_transactions, shared by the bulk loader and the streaming sink.
+#
+#     <salt>|<card_id>|<reversed epoch ms>|<digest>
+#
+# - salt: two hex digits derived from the card id, spreading cards over SALT_BUCKETS
+#   key ranges so writes do not all land on the region holding the newest keys;
+# - card_id: all transactions of a card are contiguous, so its history is one prefix scan;
+# - reversed epoch ms: newest first within a card, so "latest N" reads the first N rows;
+# - digest: CRC32 of the transaction fields, which tells apart transactions of a card
+#   in the same second and makes rewriting the same transaction idempotent.
+#
+# transaction_dt values are naive wall-clock times, converted as if they were UTC so
+# every writer derives the same key whatever the machine's time zone.
+
+SALT_BUCKETS = 16
+SEPARATOR = '|'
+REVERSE_BASE = 10 ** 13  # Epoch milliseconds stay below this until the year 2286
+
+# Formats transaction_dt has been stored in: the CSV history and str() of a datetime
+TRANSACTION_DT_FORMATS = ('%d-%m-%Y %H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def salt(card_id):
+    """Salt bucket of a card, as two hex digits."""
+    return format(zlib.crc32(str(card_id).encode('utf-8')) % SALT_BUCKETS, '02x')
+
+
+def parse_transaction_dt(value):
+    """Parse a stored transaction_dt string, None if it is in no known format."""
+    for dt_format in TRANSACTION_DT_FORMATS:
+        try:
+            return datetime.strptime(value, dt_format)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def reversed_ms(transaction_dt):
+    """Zero-padded REVERSE_BASE - 1 - epoch milliseconds of a naive datetime."""
+    millis = calendar.timegm(transaction_dt.timetuple()) * 1000 + transaction_dt.microsecond // 1000
+    return format(REVERSE_BASE - 1 - millis, '013d')
+
+
+def card_prefix(card_id):
+    """Key prefix shared by all transactions of a card."""
+    return f'{salt(card_id)}{SEPARATOR}{card_id}{SEPARATOR}'
+
+
+def transaction_key(card_id, transaction_dt, member_id, amount, postcode, pos_id):
+    """Row key of a transaction; transaction_dt is a datetime."""
+    digest = zlib.crc32(SEPARATOR.join(str(value) for value in (member_id, amount, postcode, pos_id))
+                        .encode('utf-8'))
+    return f'{card_prefix(card_id)}{reversed_ms(transaction_dt)}{SEPARATOR}{digest:08x}'
+
+
+def history_range(card_id, since=None):
+    """
+    (row_start, row_stop) of a scan over the transactions of a card, newest first,
+    limited to those at or after since (a datetime) when it is given.
+    """
+    prefix = card_prefix(card_id)
+    if since is None:
+        # The character after the separator closes the prefix range
+        return prefix, prefix[:-1] + chr(ord(SEPARATOR) + 1)
+    # Older transactions have larger reversed timestamps
+    return prefix, prefix + format(int(reversed_ms(since)) + 1, '013d')
+
+
+def is_transaction_key(key):
+    """True for keys in this layout (the old layouts never contain the separator)."""
+    parts = key.split(SEPARATOR)
+    return len(parts) == 4 and len(parts[0]) == 2 and len(parts[2]) == 13
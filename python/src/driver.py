@@ -4,7 +4,45 @@ from pyspark.sql import SparkSession
 from pyspark.sql.functions import *
 from pyspark.sql.types import *
 from pyspark import SparkConf
-from datetime import datetime
+
+# Rows per HBase batch mutation in the sink, and the checkpoint and name of the streaming query
+SINK_BATCH_SIZE = int(os.environ.get("FRAUD_SINK_BATCH_SIZE", "1000"))
+CHECKPOINT_LOCATION = os.environ.get("FRAUD_CHECKPOINT_LOCATION", "hdfs:///sharma/checkpoints/fraud_detection")
+QUERY_NAME = "fraud_detection"
+
+# Scoring engine: "lookup" reads and writes card profiles in HBase for every batch, "stateful" keeps
+# them in Spark state seeded from a look_up_table snapshot and flushes updates to HBase in the background.
+# The snapshot must be exported from the live table (export_lookuptable.py) when switching to the stateful
+# engine, or it seeds cards with profiles older than the updates the lookup engine has written
+ENGINE = os.environ.get("FRAUD_ENGINE", "lookup")
+PROFILE_SNAPSHOT = os.environ.get("FRAUD_PROFILE_SNAPSHOT", "hdfs:///sharma/look_up_table.csv")
+
+# Wire format of the Kafka messages (see pipeline/decode.py) and where records that fail to decode go
+WIRE_FORMAT = os.environ.get("FRAUD_WIRE_FORMAT", "lenient")
+DEAD_LETTER_PATH = os.environ.get("FRAUD_DEAD_LETTER_PATH", "hdfs:///sharma/dead_letter")
+
+# Card-affine scoring for the lookup engine: with a partition count, transactions are repartitioned by card_id
+# and sorted by time, so each card of a micro-batch is read once and scored by one task in order (0 to disable)
+CARD_PARTITIONS = int(os.environ.get("FRAUD_CARD_PARTITIONS", "0"))
+
+# Geo-velocity path: "udf" (pandas UDFs over GEO_Map) or "join" (broadcast join on the zip table, Spark SQL math)
+GEO_VELOCITY = os.environ.get("FRAUD_GEO_VELOCITY", "udf")
+
+# Prebuilt zip coordinate artifact (build_zip_artifact.py) shipped to the executors instead of parsing the CSV,
+# and whether to load GEO_Map in the Python workers before the first micro-batch
+ZIP_ARTIFACT = os.environ.get("FRAUD_ZIP_ARTIFACT")
+GEO_WARM_UP = os.environ.get("FRAUD_GEO_WARM_UP", "false") == "true"
+
+# Metrics snapshot in Prometheus text format: written to a file and/or served on a local HTTP port
+METRICS_FILE = os.environ.get("FRAUD_METRICS_FILE")
+METRICS_PORT = int(os.environ.get("FRAUD_METRICS_PORT", "0"))
+
+# Micro-batch sizing: a fixed trigger interval (seconds, 0 to start each batch as soon as the previous one
+# ends) and cap on Kafka offsets per batch, or, with a latency target, both adjusted by pipeline/trigger_control.py
+TRIGGER_SECONDS = float(os.environ.get("FRAUD_TRIGGER_SECONDS", "0"))
+MAX_OFFSETS_PER_TRIGGER = int(os.environ.get("FRAUD_MAX_OFFSETS_PER_TRIGGER", "0")) or None
+LATENCY_TARGET = float(os.environ.get("FRAUD_LATENCY_TARGET", "0"))  # Seconds, 0 keeps the settings fixed
+TRIGGER_LOG = os.environ.get("FRAUD_TRIGGER_LOG")  # JSON lines audit log of the controller's decisions
 
 # Configuring Spark settings
 conf = SparkConf()
@@ -17,6 +55,11 @@ conf.set("spark.driver.memory", "4g")  # Memory allocated to the driver
 conf.set("spark.yarn.executor.memoryOverhead", "1024")  # Extra memory for each executor
 conf.set("spark.yarn.driver.memoryOverhead", "1024")  # Extra memory for the driver
 
+# Pass the storage settings (FRAUD_DAO_BACKEND, FRAUD_HBASE_HOST, FRAUD_DAO_POOL_SIZE, ...) on to the executors
+for name, value in os.environ.items():
+    if name.startswith("FRAUD_"):
+        conf.set(f"spark.executorEnv.{name}", value)
+
 # Creating a Spark session
 spark = SparkSession.builder \
     .appName("CapStone_Project") \
@@ -28,196 +71,126 @@ spark.sparkContext.setLogLevel('ERROR')
 sc = spark.sparkContext
 
 # Adding Python files to the Spark context so they can be used in the code
+sc.addPyFile('/home/hadoop/python/src/metrics/registry.py')
+sc.addPyFile('/home/hadoop/python/src/metrics/export.py')
+sc.addPyFile('/home/hadoop/python/src/db/async_fetch.py')
+sc.addPyFile('/home/hadoop/python/src/db/backends.py')
+sc.addPyFile('/home/hadoop/python/src/db/profile_cache.py')
+sc.addPyFile('/home/hadoop/python/src/db/profile_format.py')
+sc.addPyFile('/home/hadoop/python/src/db/row_keys.py')
 sc.addPyFile('/home/hadoop/python/src/db/dao.py')
 sc.addPyFile('/home/hadoop/python/src/db/geo_map.py')
+sc.addPyFile('/home/hadoop/python/src/pipeline/decode.py')
+sc.addPyFile('/home/hadoop/python/src/pipeline/enrichment.py')
+sc.addPyFile('/home/hadoop/python/src/pipeline/scoring.py')
+sc.addPyFile('/home/hadoop/python/src/pipeline/sink.py')
+sc.addPyFile('/home/hadoop/python/src/pipeline/stateful.py')
+sc.addPyFile('/home/hadoop/python/src/pipeline/transform.py')
+sc.addPyFile('/home/hadoop/python/src/pipeline/trigger_control.py')
+sc.addFile('/home/hadoop/python/src/rules/rules.json')
 sc.addFile('/home/hadoop/python/src/rules/rules.py')
+if ZIP_ARTIFACT:
+    sc.addFile(ZIP_ARTIFACT)
 
-# Importing modules that handle database operations, geographic data, and rules for determining fraud
+# Importing modules that handle geographic data, the pipeline stages and the metrics
 sys.path.append(os.path.join(os.path.dirname(__file__)))
 from db import geo_map
-from db import dao
-import rules
-
-# Reading streaming data from a Kafka topic
-kafka_df = spark \
-    .readStream \
-    .format("kafka") \
-    .option("kafka.bootstrap.servers", "18.211.252.152:9092") \
-    .option("subscribe", "transactions-topic-verified") \
-    .load()
-
-# Defining the schema (structure) of the data we're expecting
-schema = StructType([
-    StructField("card_id", StringType(), True),
-    StructField("member_id", StringType(), True),
-    StructField("amount", StringType(), True),
-    StructField("postcode", StringType(), True),
-    StructField("pos_id", StringType(), True),
-    StructField("transaction_dt", StringType(), True)
-])
-
-# Cleaning up the JSON data from Kafka
-kafka_df = kafka_df.withColumn("cleaned_value", regexp_replace(col("value").cast("string"), r'\\\"', '"'))
-kafka_df = kafka_df.withColumn("cleaned_value", regexp_extract(col("cleaned_value"), r'\{.*\}', 0))
-
-# Parsing the JSON data into a DataFrame using the schema
-json_df = kafka_df.withColumn("json_data", from_json(col("cleaned_value"), schema))
-transact_data_raw = json_df.select("json_data.*")
-
-# Converting columns from string to appropriate types like long (integer) and timestamp
-transact_data_raw = transact_data_raw \
-    .withColumn("card_id", col("card_id").cast("string")) \
-    .withColumn("member_id", col("member_id").cast("long")) \
-    .withColumn("amount", col("amount").cast("long")) \
-    .withColumn("postcode", col("postcode").cast("long")) \
-    .withColumn("pos_id", col("pos_id").cast("long")) \
-    .withColumn("transaction_dt", to_timestamp(col("transaction_dt"), "dd-MM-yyyy HH:mm:ss"))
-
-# Function to fetch the credit score from HBase database based on card ID
-def fetch_score(card_id):
-    card_id_str = str(card_id) + '.0'  # Adding .0 to card_id to match the key format in HBase
-    hdao = dao.HBaseDao.get_instance()  # Getting an instance of the HBase DAO (Data Access Object)
-    data_fetch = hdao.get_data(card_id_str, 'look_up_table')  # Fetching data from HBase
-    score = data_fetch.get(b'info:score')  # Extracting the score field
-    if score is None:
-        return '0'  # Return 0 if no score is found
-    return score.decode('utf-8') if isinstance(score, bytes) else score  # Convert bytes to string if needed
-
-# Function to fetch the postcode from HBase database based on card ID
-def postcode_data(card_id):
-    card_id_str = str(card_id) + '.0'  # Adding .0 to card_id to match the key format in HBase
-    hdao = dao.HBaseDao.get_instance()
-    data_fetch = hdao.get_data(card_id_str, 'look_up_table')
-    postcode = data_fetch.get(b'info:postcode')
-    if postcode is None:
-        return ''  # Return an empty string if no postcode is found
-    return postcode.decode('utf-8') if isinstance(postcode, bytes) else postcode
-
-# Function to fetch the UCL (Upper Control Limit) from HBase database based on card ID
-def ucl_data(card_id):
-    card_id_str = str(card_id) + '.0'  # Adding .0 to card_id to match the key format in HBase
-    hdao = dao.HBaseDao.get_instance()
-    data_fetch = hdao.get_data(card_id_str, 'look_up_table')
-    ucl = data_fetch.get(b'info:UCL')
-    if ucl is None:
-        return '0'  # Return 0 if no UCL is found
-    return ucl.decode('utf-8') if isinstance(ucl, bytes) else ucl
-
-# Function to fetch the last transaction date from HBase database based on card ID
-def lTransD_data(card_id):
-    card_id_str = str(card_id) + '.0'  # Adding .0 to card_id to match the key format in HBase
-    hdao = dao.HBaseDao.get_instance()
-    data_fetch = hdao.get_data(card_id_str, 'look_up_table')
-    transaction_dt = data_fetch.get(b'info:transaction_dt')
-    if transaction_dt is None:
-        return ''  # Return an empty string if no transaction date is found
-    return transaction_dt.decode('utf-8') if isinstance(transaction_dt, bytes) else transaction_dt
-
-# Function to calculate the distance between the last known postcode and the current postcode
-def distance_calc(last_postcode, postcode):
-    gmap = geo_map.GEO_Map.get_instance()  # Getting an instance of the GEO_Map class
-
-    # Retrieve latitude and longitude for both postcodes
-    last_lat = gmap.get_lat(last_postcode)
-    last_lon = gmap.get_long(last_postcode)
-    lat = gmap.get_lat(postcode)
-    lon = gmap.get_long(postcode)
-
-    # Check if any of the coordinates are None (missing)
-    if None in [last_lat, last_lon, lat, lon]:
-        print(f"Missing coordinates: last_lat={last_lat}, last_lon={last_lon}, lat={lat}, lon={lon}")
-        return float('nan')  # Return NaN if any coordinate is missing
-
-    # Calculate and return the distance between the two postcodes
-    return gmap.distance(last_lat, last_lon, lat, lon)
-
-# Function to calculate the speed of a transaction based on distance and time difference
-def speed_cal(dist, time):
-    if time is None or time <= 0:  # Check if time is missing or non-positive
-        return -1.0  # Return -1.0 to indicate an error in calculation
-    return dist / time  # Calculate and return the speed
-
-# Function to determine the status (FRAUD or GENUINE) of a transaction
-def status(amount, UCL, score, speed, card_id, transaction_dt, postcode, member_id, pos_id):
-    base_status = rules.fraud_status(amount, UCL, score, speed)  # Call fraud_status from rules.py to get the status
-    card_id_str = str(card_id) + '.0'  # Correct the format of the card_id for HBase key
-
-    hdao = dao.HBaseDao.get_instance()  # Get an instance of HBase DAO
-    look_up = hdao.get_data(key=card_id_str, table='look_up_table')  # Get lookup data from HBase
-
-    if not look_up:  # If lookup data is empty, use default values
-        look_up = {
-            b'info:UCL': b'0',
-            b'info:transaction_dt': b'',
-            b'info:postcode': b''
-        }
-
-    if base_status == "fraud":
-        status = "FRAUD"  # Set status to FRAUD if the transaction is suspicious
-    elif base_status == "genuine":
-        status = "GENUINE"  # Set status to GENUINE if the transaction is legitimate
-        # Update the lookup table in HBase with the latest transaction data
-        look_up[b'info:transaction_dt'] = str(transaction_dt).encode('utf-8')
-        look_up[b'info:postcode'] = str(postcode).encode('utf-8')
-        hdao.write_data(card_id_str, look_up, 'look_up_table')
-
+from metrics import export
+from pipeline import decode
+from pipeline import sink
+from pipeline import stateful
+from pipeline import transform
+from pipeline import trigger_control
+
+
+# Load the zip map in the executors' Python workers now rather than in the first micro-batch
+if GEO_WARM_UP:
+    geo_map.warm_up(sc)
+
+
+# Function to read streaming data from a Kafka topic, at most max_offsets records per micro-batch
+def kafka_source(max_offsets=None):
+    reader = spark \
+        .readStream \
+        .format("kafka") \
+        .option("kafka.bootstrap.servers", "18.211.252.152:9092") \
+        .option("subscribe", "transactions-topic-verified")
+    if max_offsets:
+        reader = reader.option("maxOffsetsPerTrigger", max_offsets)
+    return reader.load()
+
+
+# Per-stage latency histograms from the executors, combined with Spark's progress events by the listener
+metrics_accumulator = None
+if METRICS_FILE or METRICS_PORT:
+    metrics_accumulator = export.create_accumulator(sc)
+    spark.streams.addListener(export.PipelineMetricsListener(
+        metrics_accumulator, export.PrometheusExporter(METRICS_FILE, METRICS_PORT), query_name=QUERY_NAME))
+
+# The stateful and card-affine engines score each transaction in Python (pipeline/scoring.py): distances come
+# from GEO_Map and rules.json is evaluated in Python, so neither the zip join nor the Spark-compiled rules apply
+PYTHON_SCORING = ENGINE == "stateful" or CARD_PARTITIONS > 0
+if GEO_VELOCITY == "join" and PYTHON_SCORING:
+    print(f"Warning: FRAUD_GEO_VELOCITY=join is ignored with FRAUD_ENGINE={ENGINE} and "
+          f"FRAUD_CARD_PARTITIONS={CARD_PARTITIONS}; distances are computed with GEO_Map in the Python workers")
+zips = transform.zip_table(spark) if GEO_VELOCITY == "join" and not PYTHON_SCORING else None
+snapshot = None
+lookup_writer = None
+if ENGINE == "stateful":
+    snapshot = stateful.load_snapshot(spark, PROFILE_SNAPSHOT)
+    lookup_writer = stateful.AsyncLookupFlusher(batch_size=SINK_BATCH_SIZE)
+
+
+
+# Function to score the decoded transactions of a micro-batch with the lookup engine, inside the sink
+def score_batch(transactions):
+    if CARD_PARTITIONS > 0:
+        # Scoring each card's transactions in time order in one task, its profile read once and carried forward
+        return transform.score_by_card(transactions, CARD_PARTITIONS, accumulator=metrics_accumulator)
+    # Scoring with the profiles read from HBase by the enrichment stage
+    return transform.score_transactions(transactions, accumulator=metrics_accumulator, zips=zips)
+
+
+# Write the scored micro-batches to HBase with batched mutations.
+# The checkpoint keeps batch ids stable across restarts so the sink can skip replayed batches;
+# the commit log is keyed by the checkpoint too, since a new checkpoint starts again from batch 0.
+# Records that do not decode are split off by the sink and kept as JSON files with their Kafka coordinates.
+hbase_sink = sink.HBaseBatchSink(batch_size=SINK_BATCH_SIZE, query_name=QUERY_NAME, lookup_writer=lookup_writer,
+                                 accumulator=metrics_accumulator, checkpoint_location=CHECKPOINT_LOCATION,
+                                 score=None if ENGINE == "stateful" else score_batch,
+                                 dead_letter_path=DEAD_LETTER_PATH)
+
+
+# Function to build and start the scoring query from its checkpoint with the given batch sizing
+def start_scoring_query(max_offsets, trigger_seconds):
+    # Decoding the Kafka records once: typed transactions, and the dead letters next to them
+    records = decode.decode_records(kafka_source(max_offsets), WIRE_FORMAT)
+    if ENGINE == "stateful":
+        # Card profiles live in the checkpointed state store; transactions of one card in the same
+        # micro-batch are scored in time order against the profile carried forward between them
+        final_df = stateful.score_stream(records, snapshot, metrics_accumulator)
     else:
-        return "error"  # Return error for unexpected values
-
-    # Create a row for the card_transactions table with transaction details
-    row = {
-                b'info:card_id': str(card_id).encode('utf-8'),
-        b'info:member_id': str(member_id).encode('utf-8'),
-        b'info:amount': str(amount).encode('utf-8'),
-        b'info:postcode': str(postcode).encode('utf-8'),
-        b'info:pos_id': str(pos_id).encode('utf-8'),
-        b'info:transaction_dt': str(transaction_dt).encode('utf-8'),
-        b'info:status': str(status).encode('utf-8')
-    }
-
-    # Generate a unique key for each row in the card_transactions table
-    key = f'{card_id}.{member_id}.{transaction_dt.strftime("%Y-%m-%d %H:%M:%S")}.{datetime.now().strftime("%Y%m%d%H%M%S")}'
-    hdao.write_data(key.encode('utf-8'), row, 'card_transactions')  # Write the transaction data to HBase
-
-    return status  # Return the transaction status
-
-# Create UDFs (User-Defined Functions) for use in Spark transformations
-fraud_status_udf = udf(status, StringType())  # UDF for determining fraud status
-speed_udf = udf(speed_cal, DoubleType())  # UDF for calculating speed
-distance_udf = udf(distance_calc, DoubleType())  # UDF for calculating distance
-
-# UDFs for retrieving data from HBase
-lTransD_data_udf = udf(lTransD_data, StringType())  # UDF for getting last transaction date
-ucl_data_udf = udf(ucl_data, StringType())  # UDF for getting UCL value
-postcode_data_udf = udf(postcode_data, StringType())  # UDF for getting postcode
-fetch_score_udf = udf(fetch_score, StringType())  # UDF for getting credit score
-
-# Adding columns to the DataFrame with data retrieved from HBase and calculated values
-df_with_score = transact_data_raw \
-    .withColumn("score", fetch_score_udf(col("card_id"))) \
-    .withColumn("last_postcode", postcode_data_udf(col("card_id"))) \
-    .withColumn("UCL", ucl_data_udf(col("card_id"))) \
-    .withColumn("last_transaction_date", date_format(to_timestamp(lTransD_data_udf(col("card_id")), "yyyy-MM-dd'T'HH:mm:ss.SSS'Z'"), "yyyy-MM-dd HH:mm:ss")) \
-    .withColumn("transaction_dt", to_timestamp(col("transaction_dt"), "dd-MM-yyyy HH:mm:ss")) \
-    .withColumn("last_postcode", col("last_postcode").cast("integer")) \
-    .withColumn("postcode", col("postcode").cast("integer")) \
-    .withColumn("distance", distance_udf(col("last_postcode"), col("postcode"))) \
-    .withColumn("time_diff_hours", (unix_timestamp(col("transaction_dt")) - unix_timestamp(col("last_transaction_date"))) / 3600) \
-    .withColumn("time_diff_hours_abs", abs(col("time_diff_hours"))) \
-    .withColumn("speed", speed_udf(col("distance"), col("time_diff_hours_abs"))) \
-    .withColumn("status", fraud_status_udf(col("amount"), col("UCL"), col("score"), col("speed"), col("card_id"), col("transaction_dt"), col("postcode"), col("member_id"), col("pos_id")))
-
-# Select the columns to output in the final DataFrame
-final_df = df_with_score.select("card_id", "member_id", "amount", "postcode", "pos_id", "transaction_dt", "status")
-
-# Write the processed data to the console for debugging or monitoring
-query1 = final_df \
-    .writeStream \
-    .outputMode("append") \
-    .format("console") \
-    .start()
-
-# Wait for the streaming query to finish (this will keep the program running)
-query1.awaitTermination()
+        # The lookup engine scores in the sink, after the dead letters are split off (score_batch)
+        final_df = records
+    return final_df \
+        .writeStream \
+        .queryName(QUERY_NAME) \
+        .outputMode("append") \
+        .foreachBatch(hbase_sink) \
+        .trigger(processingTime=f"{trigger_seconds} seconds") \
+        .option("checkpointLocation", CHECKPOINT_LOCATION) \
+        .start()
+
+
+if LATENCY_TARGET > 0:
+    # Resize the micro-batches toward the latency target, restarting the query from its checkpoint on a change
+    controller = trigger_control.TriggerController(LATENCY_TARGET, MAX_OFFSETS_PER_TRIGGER, TRIGGER_SECONDS,
+                                                   log_path=TRIGGER_LOG)
+    trigger_control.run(start_scoring_query, controller)
+else:
+    query1 = start_scoring_query(MAX_OFFSETS_PER_TRIGGER, TRIGGER_SECONDS)
+
+    # Wait for the streaming query to finish (this will keep the program running)
+    query1.awaitTermination()
 
 
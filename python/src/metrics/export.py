@@ -0,0 +1,148 @@
+import inspect
+import os
+import threading
+import time
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from pyspark.accumulators import AccumulatorParam
+from pyspark.sql.streaming import StreamingQueryListener
+
+from metrics import registry
+from metrics.registry import render_prometheus
+
+
+class SnapshotAccumulatorParam(AccumulatorParam):
+    """Accumulates registry snapshots drained on the executors into one snapshot on the driver."""
+
+    def zero(self, value):
+        return registry.empty_snapshot()
+
+    def addInPlace(self, value1, value2):
+        return registry.merge_snapshots(value1, value2)
+
+
+def create_accumulator(sc):
+    """Accumulator the executors ship their metrics through."""
+    return sc.accumulator(registry.empty_snapshot(), SnapshotAccumulatorParam())
+
+
+def ship(accumulator):
+    """Move what this process recorded into the accumulator (a no-op without one)."""
+    if accumulator is not None:
+        accumulator.add(registry.REGISTRY.drain())
+
+
+def instrument_partitions(function, stage, accumulator):
+    """
+    Wrap a partition-level function (mapInPandas, applyInPandasWithState, foreachPartition)
+    so the time spent in it is recorded as `stage` and shipped when it finishes.
+    """
+    def finish(started):
+        registry.REGISTRY.observe('stage_seconds', time.perf_counter() - started, stage=stage)
+        ship(accumulator)
+
+    if inspect.isgeneratorfunction(function):
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                yield from function(*args, **kwargs)
+            finally:
+                finish(started)
+    else:
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                finish(started)
+    return wraps(function)(wrapper)
+
+
+def instrument_batches(function, stage, accumulator):
+    """Wrap a pandas UDF body so every Arrow batch it processes is timed as `stage`."""
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with registry.REGISTRY.timer('stage_seconds', stage=stage):
+            result = function(*args, **kwargs)
+        ship(accumulator)
+        return result
+    return wrapper
+
+
+class PrometheusExporter:
+    """Publishes the metrics text to a file (written atomically) and/or a local HTTP endpoint."""
+
+    def __init__(self, path=None, port=None):
+        self.path = path
+        self.latest = ''
+        if port:
+            exporter = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = exporter.latest.encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.server = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+            threading.Thread(target=self.server.serve_forever, name='metrics-http', daemon=True).start()
+
+    def publish(self, text):
+        self.latest = text
+        if self.path:
+            temporary = self.path + '.tmp'
+            with open(temporary, 'w') as handle:
+                handle.write(text)
+            os.replace(temporary, self.path)
+
+
+class PipelineMetricsListener(StreamingQueryListener):
+    """
+    Combines Spark's progress events (input rate, processing rate, batch duration and
+    its phases) with the stage histograms and counters shipped by the executors, and
+    publishes a snapshot after every micro-batch.
+
+    The driver gauges (batch id, rates, batch duration) describe one query: with a
+    query_name, the progress of other queries of the session is ignored.
+    """
+
+    def __init__(self, accumulator, exporter, query_name=None):
+        self.accumulator = accumulator
+        self.exporter = exporter
+        self.query_name = query_name
+
+    def onQueryStarted(self, event):
+        pass
+
+    def onQueryProgress(self, event):
+        progress = event.progress
+        if self.query_name is not None and progress.name != self.query_name:
+            return
+        driver = registry.REGISTRY
+        driver.set('input_rows_per_second', progress.inputRowsPerSecond or 0.0)
+        driver.set('processed_rows_per_second', progress.processedRowsPerSecond or 0.0)
+        driver.set('batch_input_rows', progress.numInputRows)
+        driver.set('batch_id', progress.batchId)
+        driver.observe('batch_seconds', progress.batchDuration / 1000.0)
+        for phase, millis in (progress.durationMs or {}).items():
+            driver.set('batch_phase_seconds', millis / 1000.0, phase=phase)
+        self.publish()
+
+    def onQueryIdle(self, event):
+        pass
+
+    def onQueryTerminated(self, event):
+        self.publish()
+
+    def publish(self):
+        # Executor values arrive cumulatively through the accumulator; driver values are local
+        snapshot = registry.merge_snapshots(registry.empty_snapshot(), self.accumulator.value)
+        registry.merge_snapshots(snapshot, registry.REGISTRY.snapshot())
+        self.exporter.publish(render_prometheus(snapshot))
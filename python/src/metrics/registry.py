@@ -0,0 +1,136 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets, Prometheus style
+BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def metric_key(name, labels):
+    """Hashable, picklable key of a metric series."""
+    return (name, tuple(sorted(labels.items())))
+
+
+class MetricsRegistry:
+    """
+    Process-local latency histograms, counters and gauges.
+
+    Each executor Python worker records into its own registry; drain() hands the
+    recorded values over (for example to a Spark accumulator) and starts afresh,
+    and merge() adds such a snapshot into another registry, usually on the driver.
+    Snapshots are plain dicts so they can be pickled:
+    {'histograms': {key: [bucket counts..., sum, count]}, 'counters': {key: value}, 'gauges': {key: value}}
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, name, seconds, **labels):
+        """Record one duration in a histogram."""
+        key = metric_key(name, labels)
+        with self.lock:
+            values = self.histograms.get(key)
+            if values is None:
+                values = self.histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0, 0]
+            values[bisect_left(BUCKETS, seconds)] += 1
+            values[-2] += seconds
+            values[-1] += 1
+
+    def inc(self, name, value=1, **labels):
+        """Add to a counter."""
+        key = metric_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Set a gauge."""
+        with self.lock:
+            self.gauges[metric_key(name, labels)] = value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Time the enclosed block into a histogram."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        with self.lock:
+            return {'histograms': {key: list(values) for key, values in self.histograms.items()},
+                    'counters': dict(self.counters), 'gauges': dict(self.gauges)}
+
+    def drain(self):
+        """Return the recorded values and reset the registry."""
+        with self.lock:
+            snapshot = {'histograms': self.histograms, 'counters': self.counters, 'gauges': self.gauges}
+            self.histograms, self.counters, self.gauges = {}, {}, {}
+            return snapshot
+
+    def merge(self, snapshot):
+        """Add a snapshot of another registry into this one."""
+        with self.lock:
+            merge_snapshots({'histograms': self.histograms, 'counters': self.counters, 'gauges': self.gauges},
+                            snapshot)
+
+
+def empty_snapshot():
+    return {'histograms': {}, 'counters': {}, 'gauges': {}}
+
+
+def merge_snapshots(target, source):
+    """Merge source into target in place and return target."""
+    for key, values in source['histograms'].items():
+        current = target['histograms'].get(key)
+        if current is None:
+            target['histograms'][key] = list(values)
+        else:
+            for i, value in enumerate(values):
+                current[i] += value
+    for key, value in source['counters'].items():
+        target['counters'][key] = target['counters'].get(key, 0) + value
+    target['gauges'].update(source['gauges'])
+    return target
+
+
+# Registry of this process
+REGISTRY = MetricsRegistry()
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+
+def render_prometheus(snapshot, prefix='fraud_'):
+    """Render a registry snapshot in the Prometheus text exposition format."""
+    lines = []
+    by_name = {}
+    for kind in ('histograms', 'counters', 'gauges'):
+        for (name, labels), values in sorted(snapshot[kind].items(), key=lambda item: str(item[0])):
+            by_name.setdefault((kind, name), []).append((labels, values))
+    for (kind, name), series in by_name.items():
+        metric = prefix + name
+        lines.append(f'# TYPE {metric} ' + {'histograms': 'histogram', 'counters': 'counter', 'gauges': 'gauge'}[kind])
+        for labels, values in series:
+            if kind == 'histograms':
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), values[:len(BUCKETS) + 1]):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{format_labels(labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{metric}_sum{format_labels(labels)} {values[-2]}')
+                lines.append(f'{metric}_count{format_labels(labels)} {values[-1]}')
+            else:
+                lines.append(f'{metric}{format_labels(labels)} {values}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,135 @@
+import struct
+
+from pyspark.sql.functions import (base64, col, concat, concat_ws, conv, from_json, hex, length, lit, regexp_extract,
+                                   regexp_replace, substring, timestamp_seconds, to_timestamp, when)
+from pyspark.sql.types import IntegerType, LongType, StringType, StructField, StructType, TimestampType
+
+# Wire formats of the Kafka message value:
+#   lenient - the current producer: a JSON object sent as an escaped JSON string, cleaned up with regexes
+#   json    - a plain JSON object, parsed directly without the regex passes
+#   binary  - a fixed 45-byte big-endian record (see BINARY_RECORD), decoded with Spark built-ins
+WIRE_FORMATS = ('lenient', 'json', 'binary')
+
+# Defining the schema (structure) of the data we're expecting
+TRANSACTION_SCHEMA = StructType([
+    StructField("card_id", StringType(), True),
+    StructField("member_id", StringType(), True),
+    StructField("amount", StringType(), True),
+    StructField("postcode", StringType(), True),
+    StructField("pos_id", StringType(), True),
+    StructField("transaction_dt", StringType(), True)
+])
+
+# Format of transaction_dt in the JSON formats
+EVENT_DT_FORMAT = "dd-MM-yyyy HH:mm:ss"
+
+# version, card_id, member_id, amount, postcode, pos_id, transaction_dt (epoch seconds)
+BINARY_RECORD = struct.Struct('>Bqqqiqq')
+BINARY_VERSION = 1
+
+# Kafka source columns kept with a dead letter, when present
+KAFKA_METADATA = ["topic", "partition", "offset", "timestamp"]
+
+# Columns carried next to the decoded fields by decode_records, for the dead letters of a Kafka source
+DEAD_LETTER_FIELDS = [
+    StructField("topic", StringType(), True),
+    StructField("partition", IntegerType(), True),
+    StructField("offset", LongType(), True),
+    StructField("timestamp", TimestampType(), True),
+    StructField("raw_value", StringType(), True),
+    StructField("decode_error", StringType(), True),
+]
+DEAD_LETTER_COLUMNS = [field.name for field in DEAD_LETTER_FIELDS]
+
+
+def pack_binary(card_id, member_id, amount, postcode, pos_id, epoch_seconds):
+    """Encode a transaction in the binary wire format."""
+    return BINARY_RECORD.pack(BINARY_VERSION, int(card_id), int(member_id), int(amount), int(postcode), int(pos_id),
+                              int(epoch_seconds))
+
+
+def decode_json(lenient):
+    value = col("value").cast("string")
+    if lenient:
+        # Cleaning up the JSON data from Kafka
+        value = regexp_extract(regexp_replace(value, r'\\\"', '"'), r'\{.*\}', 0)
+    json_data = from_json(value, TRANSACTION_SCHEMA)
+    return {
+        "card_id": json_data["card_id"].cast("string"),
+        "member_id": json_data["member_id"].cast("long"),
+        "amount": json_data["amount"].cast("long"),
+        "postcode": json_data["postcode"].cast("long"),
+        "pos_id": json_data["pos_id"].cast("long"),
+        "transaction_dt": to_timestamp(json_data["transaction_dt"], EVENT_DT_FORMAT),
+    }, lit(None).cast("string")
+
+
+def decode_binary():
+    value = col("value").cast("binary")
+
+    def number(offset, size):
+        # Hex digits of the big-endian field read back as a signed 64-bit integer
+        return conv(hex(substring(value, offset + 1, size)), 16, -10).cast("long")
+
+    fields = {
+        "card_id": number(1, 8).cast("string"),
+        "member_id": number(9, 8),
+        "amount": number(17, 8),
+        "postcode": number(25, 4),
+        "pos_id": number(29, 8),
+        "transaction_dt": timestamp_seconds(number(37, 8)),
+    }
+    error = when(value.isNull() | (length(value) != BINARY_RECORD.size), lit("bad record length")) \
+        .when(number(0, 1) != BINARY_VERSION, lit("unknown record version"))
+    return fields, error
+
+
+def decode(raw_df, wire_format="lenient", extra_columns=()):
+    """
+    Decode the Kafka records (a `value` column) into typed transactions.
+
+    Every row gets a decode_error column: null for a good record, otherwise why it
+    was rejected (unparseable, or the fields that are missing or invalid).
+    transaction_dt is parsed once, here.
+    """
+    if wire_format == "binary":
+        fields, error = decode_binary()
+    elif wire_format in ("lenient", "json"):
+        fields, error = decode_json(wire_format == "lenient")
+    else:
+        raise ValueError(f"Unknown wire format {wire_format}, expected one of {WIRE_FORMATS}")
+
+    missing = [when(column.isNull(), lit(name)) for name, column in fields.items()]
+    all_missing = lit(True)
+    for column in fields.values():
+        all_missing = all_missing & column.isNull()
+    invalid = concat_ws(",", *missing)
+    decode_error = when(error.isNotNull(), error) \
+        .when(all_missing, lit("unparseable record")) \
+        .when(invalid != "", concat(lit("missing or invalid: "), invalid))
+
+    return raw_df.select(*[column.alias(name) for name, column in fields.items()], *extra_columns,
+                         decode_error.alias("decode_error"))
+
+
+def decode_records(raw_df, wire_format="lenient"):
+    """
+    decode() keeping what a dead letter needs: the Kafka coordinates (when present) and
+    the raw value (base64 for the binary format), so good records and dead letters can
+    be told apart later from one decoded DataFrame (see split_dead_letters).
+    """
+    metadata = [name for name in KAFKA_METADATA if name in raw_df.columns]
+    value = base64(col("value").cast("binary")) if wire_format == "binary" else col("value").cast("string")
+    return decode(raw_df, wire_format, extra_columns=[*metadata, value.alias("raw_value")])
+
+
+def split_dead_letters(decoded_df):
+    """Split the output of decode_records into (transactions, dead letters)."""
+    dead_letter_columns = [name for name in DEAD_LETTER_COLUMNS if name in decoded_df.columns]
+    transactions = decoded_df.filter(col("decode_error").isNull()).drop(*dead_letter_columns)
+    return transactions, decoded_df.filter(col("decode_error").isNotNull()).select(*dead_letter_columns)
+
+
+def dead_letters(raw_df, wire_format="lenient"):
+    """Rejected records with their Kafka coordinates and the raw value (base64 for the binary format)."""
+    return split_dead_letters(decode_records(raw_df, wire_format))[1]
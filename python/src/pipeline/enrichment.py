@@ -0,0 +1,83 @@
+import pandas as pd
+from pyspark.sql.types import StructType, StructField, StringType
+
+from db import dao
+from metrics import export
+
+LOOKUP_TABLE = 'look_up_table'
+
+# Profile columns added by the stage: (output column, HBase column, default when missing)
+PROFILE_FIELDS = [
+    ('score', b'info:score', '0'),
+    ('last_postcode', b'info:postcode', ''),
+    ('UCL', b'info:UCL', '0'),
+    ('last_transaction_date', b'info:transaction_dt', ''),
+]
+
+
+# Row key of a card in look_up_table
+lookup_key = dao.lookup_key
+
+
+def decode_cell(row, column, default):
+    """Return a cell of an HBase row as a string, or the default if it is missing."""
+    value = row.get(column)
+    if value is None:
+        return default
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def fetch_profiles(card_ids):
+    """
+    Fetch the look_up_table profiles of the given cards with one multi-row read.
+
+    Returns a dict mapping each card_id to a tuple of values in PROFILE_FIELDS order.
+    """
+    card_ids = [card_id for card_id in set(card_ids) if pd.notna(card_id)]
+    hdao = dao.HBaseDao.get_instance()
+    rows = hdao.get_many([lookup_key(card_id) for card_id in card_ids], LOOKUP_TABLE)
+    profiles = {}
+    for card_id in card_ids:
+        row = rows.get(lookup_key(card_id), {})
+        profiles[card_id] = tuple(decode_cell(row, column, default) for _, column, default in PROFILE_FIELDS)
+    return profiles
+
+
+def enrich_frame(pdf, profiles):
+    """Add the profile columns to a pandas batch of transactions."""
+    defaults = tuple(default for _, _, default in PROFILE_FIELDS)
+    values = [profiles.get(card_id, defaults) for card_id in pdf['card_id']]
+    for i, (name, _, _) in enumerate(PROFILE_FIELDS):
+        pdf[name] = pd.Series([value[i] for value in values], index=pdf.index, dtype=object)
+    return pdf
+
+
+def enrich_partition(batches):
+    """
+    mapInPandas function: collect the distinct card_ids of the whole partition,
+    fetch them in one pass and attach the profile columns to every batch.
+    """
+    batches = list(batches)
+    if not batches:
+        return
+    card_ids = set()
+    for pdf in batches:
+        card_ids.update(pdf['card_id'])
+    profiles = fetch_profiles(card_ids)
+    for pdf in batches:
+        yield enrich_frame(pdf, profiles)
+
+
+def enriched_schema(schema):
+    """Return the schema of the enrichment output for an input schema."""
+    return StructType(schema.fields + [StructField(name, StringType(), True) for name, _, _ in PROFILE_FIELDS])
+
+
+def enrich(df, accumulator=None):
+    """
+    Enrichment stage: add score, last_postcode, UCL and last_transaction_date to a transaction DataFrame.
+
+    With a metrics accumulator, the stage time and the HBase latencies are shipped to the driver.
+    """
+    return df.mapInPandas(export.instrument_partitions(enrich_partition, 'enrichment', accumulator),
+                          enriched_schema(df.schema))
@@ -0,0 +1,101 @@
+from collections import namedtuple
+
+import pandas as pd
+
+from db import geo_map
+import rules
+
+# What the pipeline knows about a card before scoring its next transaction
+CardProfile = namedtuple('CardProfile', ['score', 'UCL', 'last_postcode', 'last_transaction_dt'])
+
+# Order in which a card's transactions are scored: by time, ties broken on the other fields so that
+# every engine (stateful, card partitions, replay) scores same-second transactions the same way
+EVENT_ORDER = ["transaction_dt", "member_id", "pos_id", "postcode", "amount"]
+
+
+# Function to calculate the speed of a transaction based on distance and time difference
+def speed_cal(dist, time):
+    if time is None or time <= 0:  # Check if time is missing or non-positive
+        return -1.0  # Return -1.0 to indicate an error in calculation
+    return dist / time  # Calculate and return the speed
+
+
+# Function to determine the status (FRAUD or GENUINE) of a transaction and the rules that fired.
+# Scoring is a pure function: the HBase writes happen in the foreachBatch sink, so Spark
+# re-evaluating it can no longer duplicate them.
+def decide(amount, UCL, score, speed):
+    base_status, fired = rules.evaluate(amount, UCL, score, speed)  # Call rules.py to get the status and rules hit
+    if base_status == "fraud":
+        return "FRAUD", fired  # Set status to FRAUD if the transaction is suspicious
+    elif base_status == "genuine":
+        return "GENUINE", fired  # Set status to GENUINE if the transaction is legitimate
+    return "error", fired  # Return error for unexpected values
+
+
+# Function to determine the status (FRAUD or GENUINE) of a transaction
+def status(amount, UCL, score, speed):
+    return decide(amount, UCL, score, speed)[0]
+
+
+def parse_lookup_dt(value):
+    """Parse a look_up_table transaction_dt string, None if it is empty or invalid."""
+    if value is None or (not isinstance(value, str) and pd.isna(value)) or value == '':
+        return None
+    parsed = pd.to_datetime(value, format='%Y-%m-%dT%H:%M:%S.%fZ', errors='coerce')
+    return None if pd.isna(parsed) else parsed
+
+
+def parse_postcode(value):
+    """Parse a stored postcode, None if it is empty or invalid."""
+    parsed = pd.to_numeric(pd.Series([value], dtype=object), errors='coerce')[0]
+    return None if pd.isna(parsed) else int(parsed)
+
+
+def profile_from_lookup(score, UCL, postcode, transaction_dt):
+    """Build a CardProfile from look_up_table values (strings, possibly missing)."""
+    return CardProfile(
+        score='0' if score is None or pd.isna(score) else score,
+        UCL='0' if UCL is None or pd.isna(UCL) else UCL,
+        last_postcode=parse_postcode(postcode),
+        last_transaction_dt=parse_lookup_dt(transaction_dt),
+    )
+
+
+def score_event(profile, amount, postcode, transaction_dt, gmap=None):
+    """
+    Score one transaction against a card profile.
+
+    Returns the status, the fired rule names and the profile to use for the card's
+    next transaction: after a genuine transaction the last postcode and time move to it.
+    """
+    gmap = gmap or geo_map.GEO_Map.get_instance()
+    dist = gmap.distance_zip(profile.last_postcode, postcode)
+    if profile.last_transaction_dt is None or pd.isna(transaction_dt):
+        time_diff = None
+    else:
+        # Whole seconds, like unix_timestamp() in the streaming query
+        seconds = int(transaction_dt.timestamp()) - int(profile.last_transaction_dt.timestamp())
+        time_diff = abs(seconds) / 3600
+    result, rules_fired = decide(amount, profile.UCL, profile.score, speed_cal(dist, time_diff))
+    if result == "GENUINE":
+        profile = profile._replace(last_postcode=postcode, last_transaction_dt=transaction_dt)
+    return result, rules_fired, profile
+
+
+def score_card_events(events, profile):
+    """
+    Score the transactions of one card in time order, carrying its profile forward.
+
+    After each genuine transaction the last postcode and transaction time move to
+    it, so later transactions of the same card are measured against it rather
+    than against the stale stored profile. Returns the statuses and fired rule
+    names (in the order of events) and the updated profile.
+    """
+    gmap = geo_map.GEO_Map.get_instance()
+    statuses = []
+    fired = []
+    for row in events.itertuples(index=False):
+        result, rules_fired, profile = score_event(profile, row.amount, row.postcode, row.transaction_dt, gmap)
+        statuses.append(result)
+        fired.append(rules_fired)
+    return statuses, fired, profile
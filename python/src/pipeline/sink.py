@@ -0,0 +1,148 @@
+import zlib
+from functools import partial
+
+from pyspark.sql import Window
+from pyspark.sql.functions import col, explode, row_number
+
+from db import dao
+from db import row_keys
+from metrics import export
+from metrics import registry
+from pipeline import decode
+from pipeline import enrichment
+from pipeline import scoring
+
+TRANSACTIONS_TABLE = dao.TRANSACTIONS_TABLE
+COMMIT_TABLE = 'sink_commit_log'
+
+
+def transaction_key(row):
+    """
+    Row key of a scored transaction in card_transactions (see db/row_keys.py).
+
+    The key only depends on the transaction, so a replayed micro-batch overwrites
+    the rows it wrote before instead of duplicating them.
+    """
+    return row_keys.transaction_key(row.card_id, row.transaction_dt, row.member_id, row.amount, row.postcode,
+                                    row.pos_id)
+
+
+# Cell layouts shared with the scoring service (see db/dao.py)
+transaction_cells = dao.transaction_cells
+lookup_cells = dao.lookup_cells
+
+
+def write_transactions(rows, batch_size):
+    """foreachPartition function: write the scored transactions of a partition to card_transactions."""
+    hdao = dao.HBaseDao.get_instance()
+    hdao.write_batch(((transaction_key(row), transaction_cells(row)) for row in rows),
+                     TRANSACTIONS_TABLE, batch_size)
+
+
+def write_lookup_updates(rows, batch_size):
+    """foreachPartition function: write the latest genuine transaction of each card to look_up_table."""
+    hdao = dao.HBaseDao.get_instance()
+    hdao.write_profile_updates([(enrichment.lookup_key(row.card_id), lookup_cells(row)) for row in rows],
+                               batch_size)
+
+
+class HBaseBatchSink:
+    """
+    foreachBatch sink for the scored stream.
+
+    Writes card_transactions rows and look_up_table updates of genuine transactions
+    with batched mutations, and records every written batch id in a commit log table
+    so that a micro-batch replayed after a failure is not written twice.
+
+    With a lookup_writer (see stateful.AsyncLookupFlusher) the look_up_table updates
+    are collected and handed to it instead of being written before the batch ends.
+
+    Batch ids are only meaningful within one checkpoint: they start again at 0 when
+    the checkpoint is reset or moved. The commit log keys therefore include a digest
+    of the checkpoint location, so a new checkpoint never matches an old commit.
+
+    A micro-batch of decode.decode_records output (with a decode_error column) is
+    split here: the dead letters are written as JSON under dead_letter_path, one
+    directory per batch, and the good rows are scored with score (a function of a
+    DataFrame of transactions, when they are not scored in the stream already).
+    The Kafka records are read and decoded once, by the same query.
+    """
+
+    def __init__(self, batch_size=1000, query_name='fraud_detection', commit_table=COMMIT_TABLE, lookup_writer=None,
+                 accumulator=None, checkpoint_location=None, score=None, dead_letter_path=None):
+        self.batch_size = batch_size
+        self.lookup_writer = lookup_writer
+        self.accumulator = accumulator  # Metrics accumulator of the executor-side writers
+        self.query_name = query_name
+        self.checkpoint_location = checkpoint_location
+        self.commit_table = commit_table
+        self.score = score
+        self.dead_letter_path = dead_letter_path
+        dao.HBaseDao.get_instance().ensure_table(commit_table, {'info': dict()})
+
+    def commit_key(self, batch_id):
+        if self.checkpoint_location is None:
+            return f'{self.query_name}.{batch_id}'
+        checkpoint = zlib.crc32(self.checkpoint_location.encode('utf-8'))
+        return f'{self.query_name}.{checkpoint:08x}.{batch_id}'
+
+    def is_committed(self, batch_id):
+        row = dao.HBaseDao.get_instance().get_data(self.commit_key(batch_id), self.commit_table)
+        return b'info:committed' in row
+
+    def mark_committed(self, batch_id):
+        dao.HBaseDao.get_instance().write_data(self.commit_key(batch_id), {b'info:committed': b'1'}, self.commit_table)
+
+    def write_dead_letters(self, rejected, batch_id):
+        count = rejected.count()
+        if count == 0:
+            return
+        registry.REGISTRY.inc('dead_letters', count)
+        if self.dead_letter_path is None:
+            print(f"Batch {batch_id}: {count} records failed to decode and no dead letter path is set")
+            return
+        # Overwritten, not appended, when a failed batch is run again, so its dead letters are not duplicated
+        rejected.write.mode("overwrite").json(f"{self.dead_letter_path}/{self.commit_key(batch_id)}")
+
+    def __call__(self, batch_df, batch_id):
+        if self.is_committed(batch_id):
+            print(f"Batch {batch_id} already written (commit log key {self.commit_key(batch_id)}, "
+                  f"checkpoint {self.checkpoint_location}), skipping replay")
+            return
+
+        decoded = None
+        if "decode_error" in batch_df.columns:
+            # Cached so the Kafka records are not read and decoded again for each of the two outputs
+            decoded = batch_df.persist()
+            batch_df, rejected = decode.split_dead_letters(decoded)
+            self.write_dead_letters(rejected, batch_id)
+        if self.score is not None:
+            batch_df = self.score(batch_df)
+
+        scored = batch_df.filter(col("status").isin("FRAUD", "GENUINE") & col("transaction_dt").isNotNull()).persist()
+        scored.foreachPartition(export.instrument_partitions(
+            partial(write_transactions, batch_size=self.batch_size), 'write_transactions',
+            self.accumulator))
+        for row in scored.groupBy("status").count().collect():
+            registry.REGISTRY.inc('decisions', row['count'], status=row['status'])
+        if "fired_rules" in scored.columns:
+            for row in scored.select(explode("fired_rules").alias("rule")).groupBy("rule").count().collect():
+                registry.REGISTRY.inc('rule_hits', row['count'], rule=row['rule'])
+
+        # Only the latest genuine transaction of a card matters for its profile: the last in the order the
+        # scorers carry profiles forward in, so ties within a second pick the same postcode they did
+        latest = Window.partitionBy("card_id").orderBy(*[col(name).desc() for name in scoring.EVENT_ORDER])
+        updates = scored.filter(col("status") == "GENUINE") \
+            .withColumn("rank", row_number().over(latest)) \
+            .filter(col("rank") == 1)
+        if self.lookup_writer is not None:
+            self.lookup_writer.submit([(enrichment.lookup_key(row.card_id), lookup_cells(row))
+                                       for row in updates.collect()])
+        else:
+            updates.foreachPartition(export.instrument_partitions(
+                partial(write_lookup_updates, batch_size=self.batch_size), 'write_lookup', self.accumulator))
+
+        scored.unpersist()
+        if decoded is not None:
+            decoded.unpersist()
+        self.mark_committed(batch_id)
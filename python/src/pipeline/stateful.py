@@ -0,0 +1,199 @@
+import queue
+import threading
+
+import pandas as pd
+from pyspark.sql.functions import broadcast, col, lit, pmod, xxhash64
+from pyspark.sql.streaming.state import GroupStateTimeout
+from pyspark.sql.types import ArrayType, StructType, StructField, StringType, LongType, TimestampType
+
+from db import dao
+from metrics import export
+from pipeline import decode
+from pipeline import scoring
+
+# Per-card state kept in the checkpointed state store
+STATE_SCHEMA = StructType([
+    StructField("score", StringType(), True),
+    StructField("UCL", StringType(), True),
+    StructField("last_postcode", LongType(), True),
+    StructField("last_transaction_dt", TimestampType(), True),
+])
+
+# Scored transactions emitted by the stateful operator
+OUTPUT_SCHEMA = StructType([
+    StructField("card_id", StringType(), True),
+    StructField("member_id", LongType(), True),
+    StructField("amount", LongType(), True),
+    StructField("postcode", LongType(), True),
+    StructField("pos_id", LongType(), True),
+    StructField("transaction_dt", TimestampType(), True),
+    StructField("status", StringType(), True),
+    StructField("fired_rules", ArrayType(StringType()), True),
+])
+
+# Output of the streaming query: scored transactions, and the dead letters passed through unscored for the sink
+STREAM_SCHEMA = StructType(OUTPUT_SCHEMA.fields + decode.DEAD_LETTER_FIELDS)
+
+SEED_COLUMNS = ["seed_score", "seed_UCL", "seed_postcode", "seed_transaction_dt"]
+
+# Batch re-scoring output: the scored transactions and the status they were stored with
+REPLAY_SCHEMA = StructType(OUTPUT_SCHEMA.fields + [StructField("original_status", StringType(), True)])
+
+
+def load_snapshot(spark, path):
+    """
+    Load a bulk snapshot of look_up_table (the loader's CSV layout) as seed columns.
+
+    Every column is read as a string so card ids keep their exact text form. The
+    snapshot is cached: the stream-static join in score_stream() reads it in every
+    micro-batch, which would otherwise re-read the whole CSV each time.
+
+    The snapshot must reflect the live table (see export_lookuptable.py): profiles
+    updated in HBase after it was taken are not seen by the stateful engine.
+    """
+    return spark.read.csv(path, header=True) \
+        .select(col("card_id"),
+                col("score").alias("seed_score"),
+                col("UCL").alias("seed_UCL"),
+                col("postcode").alias("seed_postcode"),
+                col("transaction_dt").alias("seed_transaction_dt")) \
+        .persist()
+
+
+def seed_profile(events, last_seen=True):
+    """
+    Profile of a card from the snapshot columns joined to its transactions. Without
+    last_seen only the score and UCL are taken: the last postcode and time are left
+    empty, to be set by the card's own transactions.
+    """
+    seed = events.iloc[0]
+    if not last_seen:
+        return scoring.profile_from_lookup(seed["seed_score"], seed["seed_UCL"], None, None)
+    return scoring.profile_from_lookup(seed["seed_score"], seed["seed_UCL"],
+                                       seed["seed_postcode"], seed["seed_transaction_dt"])
+
+
+def score_card_group(key, batches, state):
+    """
+    applyInPandasWithState function: score the transactions of one card in this
+    micro-batch in time order, starting from the card's state (or its snapshot row
+    the first time the card is seen) and storing the carried-forward profile back.
+
+    Records that failed to decode are passed through unscored and leave the state alone.
+    """
+    events = pd.concat(list(batches), ignore_index=True)
+    rejected = events[events["decode_error"].notna()]
+    if not rejected.empty:
+        yield rejected.assign(status=None, fired_rules=None)[[field.name for field in STREAM_SCHEMA.fields]]
+    events = events[events["decode_error"].isna()].sort_values(scoring.EVENT_ORDER, kind="stable")
+    if events.empty:
+        return
+    if state.exists:
+        score, UCL, last_postcode, last_transaction_dt = state.get
+        profile = scoring.CardProfile(score, UCL, last_postcode,
+                                      None if last_transaction_dt is None else pd.Timestamp(last_transaction_dt))
+    else:
+        profile = seed_profile(events)
+
+    statuses, fired, profile = scoring.score_card_events(events, profile)
+    state.update((profile.score, profile.UCL,
+                  None if profile.last_postcode is None else int(profile.last_postcode),
+                  None if profile.last_transaction_dt is None else profile.last_transaction_dt.to_pydatetime()))
+
+    events["status"] = statuses
+    events["fired_rules"] = fired
+    yield events[[field.name for field in STREAM_SCHEMA.fields]]
+
+
+def score_stream(transactions, snapshot, accumulator=None):
+    """
+    Stateful scoring engine: profiles live in Spark state keyed by card_id instead of
+    being read from and written to HBase for every transaction.
+
+    transactions are decoded records (decode.decode_records); the scoring has to
+    happen in the stream, so the dead letters come out with it (see STREAM_SCHEMA)
+    and the sink splits them off.
+    """
+    for field in decode.DEAD_LETTER_FIELDS:
+        if field.name not in transactions.columns:
+            transactions = transactions.withColumn(field.name, lit(None).cast(field.dataType))
+    seeded = transactions.join(broadcast(snapshot), on="card_id", how="left")
+    return seeded.groupBy("card_id").applyInPandasWithState(
+        export.instrument_partitions(score_card_group, 'stateful_scoring', accumulator),
+        STREAM_SCHEMA, STATE_SCHEMA, "append", GroupStateTimeout.NoTimeout)
+
+
+def score_card_histories(events):
+    """
+    applyInPandas function: score the transactions of every card in the group, each
+    card in time order from its snapshot score and UCL. Ties in time are broken on the
+    other columns so a replay gives the same result however the input was split.
+
+    The snapshot's last postcode and time are not used: the snapshot is taken after
+    the replayed transactions, so they would put a card's last-seen location later
+    than its history. The first replayed transaction of a card has no speed check.
+    """
+    events = events.sort_values(["card_id", *scoring.EVENT_ORDER], kind="stable")
+    statuses = []
+    fired = []
+    # Groups come out in the sorted order, so the results line up with events
+    for _, card_events in events.groupby("card_id", sort=False, dropna=False):
+        card_statuses, card_fired, _ = scoring.score_card_events(card_events,
+                                                                 seed_profile(card_events, last_seen=False))
+        statuses.extend(card_statuses)
+        fired.extend(card_fired)
+    events["status"] = statuses
+    events["fired_rules"] = fired
+    return events[[field.name for field in REPLAY_SCHEMA.fields]]
+
+
+def score_history(transactions, snapshot, buckets=200):
+    """
+    Batch counterpart of score_stream(): re-score a set of past transactions, each card
+    in time order from its snapshot score and UCL (see score_card_histories), with no
+    state store and no HBase access.
+    transactions needs an original_status column (null when it is not known).
+
+    Cards are hashed into buckets and each bucket is scored in one Python call, which
+    avoids the per-group overhead of grouping by card when most cards have few rows.
+    """
+    seeded = transactions.join(broadcast(snapshot), on="card_id", how="left") \
+        .withColumn("card_bucket", pmod(xxhash64("card_id"), lit(buckets)))
+    return seeded.groupBy("card_bucket").applyInPandas(score_card_histories, REPLAY_SCHEMA)
+
+
+class AsyncLookupFlusher:
+    """
+    Writes look_up_table updates from a background thread on the driver, so the
+    micro-batch does not wait for HBase. The state store stays the source of truth;
+    HBase is brought up to date shortly after each batch.
+    """
+
+    def __init__(self, batch_size=1000, max_pending=100):
+        self.batch_size = batch_size
+        self.pending = queue.Queue(maxsize=max_pending)  # Bounded: a stuck HBase slows batches down eventually
+        self.thread = threading.Thread(target=self.run, name="lookup-flusher", daemon=True)
+        self.thread.start()
+
+    def submit(self, updates):
+        """Queue a list of (row key, cells) updates."""
+        if updates:
+            self.pending.put(updates)
+
+    def run(self):
+        hdao = dao.HBaseDao.get_instance()
+        while True:
+            updates = self.pending.get()
+            if updates is None:
+                break
+            try:
+                hdao.write_profile_updates(updates, self.batch_size)
+            except Exception as e:
+                print(f"Error flushing {len(updates)} lookup updates: {e}")
+            finally:
+                self.pending.task_done()
+
+    def close(self):
+        """Flush what is queued and stop the thread."""
+        self.pending.put(None)
+        self.thread.join()
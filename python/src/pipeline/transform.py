@@ -0,0 +1,184 @@
+import math
+
+import pandas as pd
+from pyspark.sql.functions import (abs, acos, broadcast, col, cos, date_format, greatest, least, lit, pandas_udf, sin,
+                                   to_timestamp, unix_timestamp, when)
+from pyspark.sql.types import ArrayType, DoubleType, StringType, StructField, StructType
+
+from db import geo_map
+from metrics import export
+from pipeline import decode
+from pipeline import enrichment
+from pipeline import scoring
+import rules
+
+# Columns of a scored transaction, as written by the sink
+OUTPUT_COLUMNS = ["card_id", "member_id", "amount", "postcode", "pos_id", "transaction_dt", "status", "fired_rules"]
+
+
+def parse_transactions(raw_df, extra_columns=(), wire_format="lenient"):
+    """
+    Parse the raw Kafka records (a `value` column) into typed transactions.
+
+    extra_columns are carried through next to the parsed fields. Records that do
+    not decode are left out; decode.dead_letters returns them.
+    """
+    return decode.decode(raw_df, wire_format, extra_columns) \
+        .filter(col("decode_error").isNull()) \
+        .drop("decode_error")
+
+
+# Vectorized distance between the last known postcode and the current postcode of each row.
+# Whole Arrow batches are resolved through the GEO_Map zip index instead of four lookups per row.
+def distance_batch(last_postcode: pd.Series, postcode: pd.Series) -> pd.Series:
+    gmap = geo_map.GEO_Map.get_instance()  # Getting an instance of the GEO_Map class
+    return pd.Series(gmap.distance_many(last_postcode, postcode), index=postcode.index)
+
+
+# Vectorized speed_cal: -1.0 where the time difference is missing or non-positive
+def speed_batch(distance: pd.Series, hours: pd.Series) -> pd.Series:
+    return (distance / hours).where(hours.notna() & (hours > 0), -1.0)
+
+
+def zip_table(spark):
+    """
+    The GEO_Map zip index as a Spark DataFrame (zip, lat, long), small enough to broadcast.
+
+    It is built from the same index as GEO_Map, so duplicated and malformed zips
+    resolve exactly as they do for distance_udf.
+    """
+    return spark.createDataFrame(geo_map.GEO_Map.get_instance().zip_frame(), "zip long, lat double, long double")
+
+
+def deg2rad(deg):
+    return deg * math.pi / 180.0
+
+
+def distance_column(lat1, long1, lat2, long2):
+    """GEO_Map.distance as a Spark expression: NaN wherever a coordinate is missing or out of range."""
+    valid = lat1.between(-90, 90) & long1.between(-180, 180) & lat2.between(-90, 90) & long2.between(-180, 180)
+    theta = long1 - long2
+    dist = (sin(deg2rad(lat1)) * sin(deg2rad(lat2)) +
+            cos(deg2rad(lat1)) * cos(deg2rad(lat2)) * cos(deg2rad(theta)))
+    dist = acos(greatest(lit(-1.0), least(lit(1.0), dist))) * 180.0 / math.pi
+    dist = dist * 60 * 1.1515 * 1.609344  # Convert to kilometers
+    # Coordinates of unknown zips are null after the left joins, which leaves valid null, not true.
+    # NaN sorts above every number in Spark, so NaN coordinates fail between() too
+    return when(valid, dist).otherwise(lit(float('nan')))
+
+
+def speed_column(distance, hours):
+    """speed_cal as a Spark expression."""
+    return when(hours.isNull() | (hours <= 0), lit(-1.0)).otherwise(distance / hours)
+
+
+def with_geo_velocity(df, zips):
+    """
+    Add distance and speed columns by joining the broadcast zip table on the last and the
+    current postcode, so the geo-velocity check runs without Python workers.
+    """
+    last = zips.select(col("zip").alias("last_postcode"), col("lat").alias("last_lat"), col("long").alias("last_long"))
+    current = zips.select(col("zip").alias("postcode"), col("lat").alias("lat"), col("long").alias("long"))
+    return df \
+        .join(broadcast(last), on="last_postcode", how="left") \
+        .join(broadcast(current), on="postcode", how="left") \
+        .withColumn("distance", distance_column(col("last_lat"), col("last_long"), col("lat"), col("long"))) \
+        .withColumn("speed", speed_column(col("distance"), col("time_diff_hours_abs")))
+
+
+def scoring_udfs(accumulator=None):
+    """Create the pandas UDFs of the scoring chain, timed per batch when a metrics accumulator is given."""
+    distance_udf = pandas_udf(export.instrument_batches(distance_batch, 'distance', accumulator), DoubleType())
+    speed_udf = pandas_udf(export.instrument_batches(speed_batch, 'speed', accumulator), DoubleType())
+    return distance_udf, speed_udf
+
+
+def score_transactions(transactions, extra_columns=(), accumulator=None, zips=None):
+    """
+    Score parsed transactions against the look_up_table profiles of their cards.
+
+    With zips (see zip_table) distance and speed are computed with a broadcast join
+    and Spark SQL math instead of the pandas UDFs.
+
+    Returns OUTPUT_COLUMNS followed by extra_columns.
+    """
+    # The rules of rules.json compiled to Spark expressions: evaluated in the JVM, no Python round trip
+    status, fired_rules = rules.spark_columns(fraud="FRAUD", genuine="GENUINE")
+
+    # Enrichment stage: score, last postcode, UCL and last transaction date for every card of a
+    # partition are fetched from HBase with one multi-row read instead of one get per column and row
+    enriched_df = enrichment.enrich(transactions, accumulator)
+
+    # Adding columns to the DataFrame with calculated values
+    df_with_score = enriched_df \
+        .withColumn("last_transaction_date", date_format(to_timestamp(col("last_transaction_date"), "yyyy-MM-dd'T'HH:mm:ss.SSS'Z'"), "yyyy-MM-dd HH:mm:ss")) \
+        .withColumn("last_postcode", col("last_postcode").cast("integer")) \
+        .withColumn("postcode", col("postcode").cast("integer")) \
+        .withColumn("time_diff_hours", (unix_timestamp(col("transaction_dt")) - unix_timestamp(col("last_transaction_date"))) / 3600) \
+        .withColumn("time_diff_hours_abs", abs(col("time_diff_hours")))
+
+    if zips is not None:
+        df_with_score = with_geo_velocity(df_with_score, zips)
+    else:
+        distance_udf, speed_udf = scoring_udfs(accumulator)
+        df_with_score = df_with_score \
+            .withColumn("distance", distance_udf(col("last_postcode"), col("postcode"))) \
+            .withColumn("speed", speed_udf(col("distance"), col("time_diff_hours_abs")))
+
+    df_with_score = df_with_score \
+        .withColumn("status", status) \
+        .withColumn("fired_rules", fired_rules)
+
+    # Select the columns to output in the final DataFrame
+    return df_with_score.select(*OUTPUT_COLUMNS, *extra_columns)
+
+
+def score_card_partition(batches):
+    """
+    mapInPandas function for card-partitioned input: fetch the profiles of the
+    partition's cards in one pass, then score the transactions in the order they
+    arrive (time order, see score_by_card), carrying each card's profile forward so
+    a card's later transactions are measured against its earlier genuine ones.
+    """
+    batches = list(batches)
+    if not batches:
+        return
+    card_ids = set()
+    for pdf in batches:
+        card_ids.update(pdf['card_id'])
+    # fetch_profiles values are in enrichment.PROFILE_FIELDS order: score, last postcode, UCL, last date
+    profiles = {card_id: scoring.profile_from_lookup(score, UCL, postcode, transaction_dt)
+                for card_id, (score, postcode, UCL, transaction_dt) in enrichment.fetch_profiles(card_ids).items()}
+    unknown = scoring.profile_from_lookup(None, None, None, None)
+    gmap = geo_map.GEO_Map.get_instance()
+    for pdf in batches:
+        statuses = []
+        fired = []
+        for row in pdf.itertuples(index=False):
+            result, rules_fired, profiles[row.card_id] = scoring.score_event(
+                profiles.get(row.card_id, unknown), row.amount, row.postcode, row.transaction_dt, gmap)
+            statuses.append(result)
+            fired.append(rules_fired)
+        pdf['status'] = statuses
+        pdf['fired_rules'] = fired
+        yield pdf
+
+
+def score_by_card(transactions, partitions, extra_columns=(), accumulator=None):
+    """
+    Card-affine counterpart of score_transactions(): repartition by a hash of card_id
+    and sort every partition by transaction time, so all transactions of a card in a
+    micro-batch are scored by one task, in order, with its profile carried forward.
+
+    Each card's profile is read from HBase once per batch, and two transactions of a
+    card in the same batch no longer both use the stale stored postcode and time.
+
+    Returns OUTPUT_COLUMNS followed by extra_columns.
+    """
+    schema = StructType(transactions.schema.fields + [StructField("status", StringType(), True),
+                                                      StructField("fired_rules", ArrayType(StringType()), True)])
+    return transactions \
+        .repartition(partitions, col("card_id")) \
+        .sortWithinPartitions(*scoring.EVENT_ORDER) \
+        .mapInPandas(export.instrument_partitions(score_card_partition, 'card_scoring', accumulator), schema) \
+        .select(*OUTPUT_COLUMNS, *extra_columns)
@@ -0,0 +1,182 @@
+import json
+import time
+from datetime import datetime, timezone
+
+from metrics import registry
+
+# Share of the latency target a micro-batch may spend processing; the rest is left for
+# the wait until the next trigger
+BATCH_SHARE = 0.5
+
+
+def batch_seconds(progress):
+    # Wall time of a micro-batch from its progress dict (the JSON form has no batchDuration field)
+    return ((progress.get('durationMs') or {}).get('triggerExecution') or 0) / 1000.0
+
+
+class TriggerController:
+    """
+    Sizes micro-batches toward an end-to-end latency target.
+
+    An event waits up to one trigger interval for its batch to start and then for
+    the batch to run, so its latency is about interval + batch duration. From the
+    progress of every batch the controller keeps a smoothed processing rate and
+    batch duration, and proposes:
+
+    - max_offsets: the rows the query can process in BATCH_SHARE of the target,
+      re-estimated while batches hit the cap and cut in proportion at once when
+      a batch overruns the target;
+    - interval: the target minus the smoothed batch duration, so quiet periods
+      run fewer, larger batches, and no wait at all while the query is behind
+      (a batch hit the offset cap or overran the target).
+
+    Changing either setting means restarting the query, so a proposal is only
+    applied once cooldown batches have passed since the previous change and when
+    it differs from the current settings by more than min_change (relative).
+    Every evaluation is logged as a JSON line (to log_path, if given) so the
+    backpressure behaviour can be audited afterwards.
+    """
+
+    def __init__(self, target_seconds, max_offsets, interval, min_offsets=1000, max_offsets_limit=1000000,
+                 min_interval=0.0, max_interval=60.0, smoothing=0.3, cooldown=3, min_change=0.2, log_path=None):
+        self.target = target_seconds
+        self.max_offsets = max_offsets
+        self.interval = interval
+        self.min_offsets = min_offsets
+        self.max_offsets_limit = max_offsets_limit
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.smoothing = smoothing  # Weight of the newest batch in the moving averages
+        self.cooldown = cooldown
+        self.min_change = min_change
+        self.log_path = log_path
+        self.rate = None  # Smoothed rows processed per second
+        self.duration = None  # Smoothed batch duration in seconds
+        self.batches_since_change = 0
+        self.pending = None  # (max_offsets, interval) waiting to be applied by the driver
+
+    def smooth(self, average, value):
+        return value if average is None else average + self.smoothing * (value - average)
+
+    def observe(self, progress):
+        """Take in the progress (a dict) of a finished micro-batch; return a pending change or None."""
+        rows = progress.get('numInputRows') or 0
+        duration = batch_seconds(progress)
+        self.batches_since_change += 1
+        if rows == 0 or duration <= 0:
+            # Empty batches say nothing about the processing rate
+            self.log('hold', progress, 'empty batch')
+            return None
+        self.rate = self.smooth(self.rate, rows / duration)
+        self.duration = self.smooth(self.duration, duration)
+
+        backlog = self.max_offsets is not None and rows >= 0.95 * self.max_offsets
+        if duration > self.target:
+            # Missed the target: shrink in proportion right away instead of waiting for the average
+            max_offsets = min(self.rate * self.target * BATCH_SHARE, rows * self.target * BATCH_SHARE / duration)
+        elif backlog or self.max_offsets is None:
+            max_offsets = self.rate * self.target * BATCH_SHARE
+        else:
+            # The cap did not limit this batch, and small batches understate the rate (fixed costs dominate)
+            max_offsets = self.max_offsets
+        max_offsets = int(min(max(max_offsets, self.min_offsets), self.max_offsets_limit))
+
+        behind = backlog or duration > self.target
+        interval = self.min_interval if behind else self.target - self.duration
+        interval = round(min(max(interval, self.min_interval), self.max_interval), 1)
+
+        reason = f"{'behind' if behind else 'keeping up'}, {self.rate:.0f} rows/s, batch {duration:.2f}s"
+        if self.batches_since_change < self.cooldown:
+            self.log('hold', progress, f'{reason}, cooling down', max_offsets, interval)
+            return None
+        if not (self.changed(self.max_offsets, max_offsets) or self.changed(self.interval, interval)):
+            self.log('hold', progress, reason, max_offsets, interval)
+            return None
+        self.pending = (max_offsets, interval)
+        self.log('adjust', progress, reason, max_offsets, interval)
+        return self.pending
+
+    def changed(self, current, proposed):
+        if current is None:
+            return True
+        if current == 0:
+            return proposed >= 1
+        return abs(proposed - current) / current > self.min_change
+
+    def applied(self):
+        """Called by the driver once the pending settings are in effect."""
+        self.max_offsets, self.interval = self.pending
+        self.pending = None
+        self.batches_since_change = 0
+        registry.REGISTRY.set('trigger_max_offsets', self.max_offsets)
+        registry.REGISTRY.set('trigger_interval_seconds', self.interval)
+        registry.REGISTRY.inc('trigger_restarts')
+
+    def log(self, action, progress, reason, max_offsets=None, interval=None):
+        entry = {
+            'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'action': action,
+            'batch_id': progress.get('batchId'),
+            'input_rows': progress.get('numInputRows'),
+            'batch_seconds': batch_seconds(progress),
+            'input_rows_per_second': progress.get('inputRowsPerSecond'),
+            'processed_rows_per_second': progress.get('processedRowsPerSecond'),
+            'reason': reason,
+            'max_offsets': self.max_offsets,
+            'interval': self.interval,
+            'proposed_max_offsets': max_offsets,
+            'proposed_interval': interval,
+        }
+        if action != 'hold':
+            print(f"Trigger control: {reason}; maxOffsetsPerTrigger {self.max_offsets} -> {max_offsets}, "
+                  f"interval {self.interval}s -> {interval}s")
+        if self.log_path:
+            with open(self.log_path, 'a') as handle:
+                handle.write(json.dumps(entry) + '\n')
+
+
+def wait_for_batch_end(query, timeout=60.0, poll=0.2):
+    # Let the running micro-batch finish so stopping does not throw its work away. Under load the
+    # next one starts at once and is cut short by the stop, to be replayed after the restart
+    last = query.lastProgress
+    last_seen = last['timestamp'] if last else ''
+    deadline = time.monotonic() + timeout
+    while query.isActive and query.status.get('isTriggerActive') and time.monotonic() < deadline:
+        last = query.lastProgress
+        if last and last['timestamp'] > last_seen:
+            return
+        time.sleep(poll)
+
+
+def run(start_query, controller, poll=1.0):
+    """
+    Run a streaming query under a TriggerController until it terminates.
+
+    start_query(max_offsets, interval) builds and starts the query from its
+    checkpoint. The progress of new batches is fed to the controller and, when it
+    asks for other settings, the query is stopped between batches and started again
+    with them: it resumes from the checkpointed offsets, and a batch cut short is
+    replayed (the sink skips batches it has already written).
+    """
+    last_seen = ''
+
+    def observe_new(query):
+        # Idle queries report progress under the id of the batch still to come, so entries are
+        # told apart by their (ISO 8601, UTC) timestamps rather than by batch id
+        nonlocal last_seen
+        for progress in query.recentProgress:
+            if progress['timestamp'] > last_seen:
+                last_seen = progress['timestamp']
+                controller.observe(progress)
+
+    query = start_query(controller.max_offsets, controller.interval)
+    while True:
+        if query.awaitTermination(poll):
+            return query  # Stopped from outside or failed: awaitTermination raised already if it failed
+        observe_new(query)
+        if controller.pending is not None:
+            wait_for_batch_end(query)
+            query.stop()
+            observe_new(query)  # The batch that just ended is logged too
+            controller.applied()
+            query = start_query(controller.max_offsets, controller.interval)
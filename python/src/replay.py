@@ -0,0 +1,174 @@
+"""
+Re-scores past transactions in batch, e.g. after a change to the rules or thresholds.
+
+Reads a Kafka offset range (decoded like the streaming query) or a card_transactions
+export (CSV or Parquet), seeds every card with its score and UCL from a look_up_table
+snapshot, scores each card's transactions in time order with the pipeline's scoring
+code, and writes the decisions to Parquet. Nothing is read from or written to HBase.
+The last postcode and time of a card come from its replayed transactions, not from
+the snapshot, which is newer than the history being replayed.
+
+When the input carries the stored status (the card_transactions exports do), a diff
+report compares it with the new decisions.
+
+    spark-submit python/src/replay.py --csv card_transactions.csv --profiles look_up_table.csv \\
+        --rules new_rules.json --output replay/ --report replay_diff.json
+    spark-submit --packages org.apache.spark:spark-sql-kafka-0-10_2.12:3.5.3 python/src/replay.py \\
+        --kafka 18.211.252.152:9092 --starting-offsets '{"transactions-topic-verified":{"0":1000}}' \\
+        --ending-offsets latest --output replay/
+"""
+import argparse
+import json
+import os
+import sys
+
+SRC = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(SRC, 'rules'))
+sys.path.insert(0, SRC)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--csv', help='card_transactions CSV export (with a header row)')
+    source.add_argument('--parquet', help='card_transactions Parquet export')
+    source.add_argument('--kafka', metavar='BOOTSTRAP_SERVERS', help='read an offset range of a Kafka topic')
+    parser.add_argument('--topic', default='transactions-topic-verified')
+    parser.add_argument('--starting-offsets', default='earliest', help='Kafka startingOffsets (earliest or JSON)')
+    parser.add_argument('--ending-offsets', default='latest', help='Kafka endingOffsets (latest or JSON)')
+    parser.add_argument('--wire-format', default=os.environ.get('FRAUD_WIRE_FORMAT', 'lenient'),
+                        help='Kafka message format, see pipeline/decode.py')
+    parser.add_argument('--profiles', default=os.environ.get('FRAUD_PROFILE_SNAPSHOT', 'hdfs:///sharma/look_up_table.csv'),
+                        help='look_up_table snapshot CSV with the score and UCL of the cards')
+    parser.add_argument('--rules', help='rules file to score with (default: the deployed rules.json)')
+    parser.add_argument('--zip-csv', default=os.environ.get('FRAUD_ZIP_CSV', os.path.join(SRC, 'db', 'uszipsv.csv')))
+    parser.add_argument('--output', required=True, help='Parquet directory for the decisions (overwritten)')
+    parser.add_argument('--report', help='write the diff report as JSON too')
+    parser.add_argument('--master', default=None, help='Spark master (default: local[*] unless spark-submit sets one)')
+    return parser.parse_args()
+
+
+def configure_environment(args):
+    # Set before Spark starts so local Python workers inherit it; executorEnv carries it to a cluster,
+    # where the source tree must be at the same path on every node
+    os.environ['FRAUD_ZIP_CSV'] = args.zip_csv
+    os.environ['PYTHONPATH'] = os.pathsep.join([SRC, os.path.join(SRC, 'rules'), os.environ.get('PYTHONPATH', '')])
+    if args.rules:
+        os.environ['FRAUD_RULES_FILE'] = os.path.abspath(args.rules)
+
+
+def create_session(args):
+    from pyspark import SparkConf
+    from pyspark.sql import SparkSession
+
+    builder = SparkSession.builder.appName("fraud_replay")
+    if args.master or not SparkConf().contains("spark.master"):
+        # Run on all local cores unless spark-submit chose a master
+        builder = builder.master(args.master or 'local[*]')
+    for name, value in os.environ.items():
+        if name.startswith("FRAUD_") or name == "PYTHONPATH":
+            builder = builder.config(f"spark.executorEnv.{name}", value)
+    spark = builder.getOrCreate()
+    spark.sparkContext.setLogLevel('ERROR')
+    # A few card buckets per core rather than the default 200 small tasks
+    spark.conf.set("spark.sql.shuffle.partitions", str(spark.sparkContext.defaultParallelism * 4))
+    return spark
+
+
+def read_export(spark, args):
+    """Transactions of a card_transactions export, typed like the decoded Kafka records."""
+    from pyspark.sql.functions import coalesce, col, lit, to_timestamp
+    from pipeline import decode
+
+    if args.csv:
+        df = spark.read.csv(args.csv, header=True)  # Every column as a string: card ids keep their text form
+    else:
+        df = spark.read.parquet(args.parquet)
+    transaction_dt = col("transaction_dt")
+    if dict(df.dtypes).get("transaction_dt") == "string":
+        # The history uses the event format; str() of a datetime is accepted too
+        transaction_dt = coalesce(to_timestamp(transaction_dt, decode.EVENT_DT_FORMAT), to_timestamp(transaction_dt))
+    original_status = col("status") if "status" in df.columns else lit(None)
+    return df.select(col("card_id").cast("string"),
+                     col("member_id").cast("long"),
+                     col("amount").cast("double").cast("long"),
+                     col("postcode").cast("long"),
+                     col("pos_id").cast("long"),
+                     transaction_dt.cast("timestamp").alias("transaction_dt"),
+                     original_status.cast("string").alias("original_status"))
+
+
+def read_kafka(spark, args):
+    """Transactions of a Kafka offset range; the stored status is not known."""
+    from pyspark.sql.functions import lit
+    from pipeline import decode
+
+    raw = spark.read \
+        .format("kafka") \
+        .option("kafka.bootstrap.servers", args.kafka) \
+        .option("subscribe", args.topic) \
+        .option("startingOffsets", args.starting_offsets) \
+        .option("endingOffsets", args.ending_offsets) \
+        .load()
+    decoded = decode.decode(raw, args.wire_format)
+    rejected = decoded.filter("decode_error IS NOT NULL").count()
+    if rejected:
+        print(f"Skipping {rejected} records that do not decode")
+    return decoded.filter("decode_error IS NULL") \
+        .drop("decode_error") \
+        .withColumn("original_status", lit(None).cast("string"))
+
+
+def diff_report(decisions):
+    """Counts of (original status, new status) pairs and the rules behind the changed decisions."""
+    from pyspark.sql.functions import col, explode
+
+    pairs = decisions.groupBy("original_status", "status").count().collect()
+    known = decisions.filter(col("original_status").isNotNull())
+    changed = known.filter(col("original_status") != col("status"))
+    rule_hits = changed.select(explode("fired_rules").alias("rule")).groupBy("rule").count().collect()
+    report = {
+        'transactions': sum(row['count'] for row in pairs),
+        'compared': sum(row['count'] for row in pairs if row['original_status'] is not None),
+        'changed': sum(row['count'] for row in pairs
+                       if row['original_status'] is not None and row['original_status'] != row['status']),
+        'transitions': sorted(({'from': row['original_status'], 'to': row['status'], 'count': row['count']}
+                               for row in pairs), key=lambda entry: -entry['count']),
+        'rules_on_changed': {row['rule']: row['count'] for row in rule_hits},
+    }
+    return report
+
+
+def print_report(report):
+    print(f"{report['transactions']} transactions re-scored, {report['compared']} with a stored status, "
+          f"{report['changed']} decisions changed")
+    for entry in report['transitions']:
+        print(f"  {str(entry['from']):>8} -> {entry['to']:<8} {entry['count']}")
+    for rule, count in sorted(report['rules_on_changed'].items(), key=lambda item: -item[1]):
+        print(f"  rule {rule} fired on {count} changed decisions")
+
+
+def main():
+    args = parse_args()
+    configure_environment(args)
+    spark = create_session(args)
+    from pipeline import stateful
+
+    transactions = read_kafka(spark, args) if args.kafka else read_export(spark, args)
+    decisions = stateful.score_history(transactions, stateful.load_snapshot(spark, args.profiles),
+                                       buckets=int(spark.conf.get("spark.sql.shuffle.partitions")))
+    decisions.write.mode("overwrite").parquet(args.output)
+    print(f"Decisions written to {args.output}")
+
+    # The report reads the written decisions back instead of scoring everything a second time
+    report = diff_report(spark.read.parquet(args.output))
+    print_report(report)
+    if args.report:
+        with open(args.report, 'w') as handle:
+            json.dump(report, handle, indent=2)
+        print(f"Report saved to {args.report}")
+    spark.stop()
+
+
+if __name__ == '__main__':
+    main()
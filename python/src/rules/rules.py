@@ -1,3 +1,203 @@
+import ast
+import json
+import operator
+import os
+from collections import namedtuple
+
+import numpy as np
+
+# Rules are declared in rules.json (or the file named by FRAUD_RULES_FILE), e.g.
+#   {"name": "low_score", "expression": "score", "op": "<", "threshold": 200}
+# expression and threshold are arithmetic (+ - * /) over numbers and input fields
+# (amount, UCL, score, speed). A transaction is fraud when any rule fires; a rule whose
+# expression or threshold is not a finite number (NaN, infinite, divided by zero) does not fire.
+RULES_FILE = os.environ.get('FRAUD_RULES_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rules.json'))
+
+# Inputs a rule can refer to
+INPUT_FIELDS = ('amount', 'UCL', 'score', 'speed')
+
+OPERATORS = {'>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le}
+ARITHMETIC = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv}
+
+Rule = namedtuple('Rule', ['name', 'expression', 'op', 'threshold', 'fields'])
+
+
+def parse_expression(text):
+    """Parse a rule expression (or a numeric threshold) into an AST, rejecting anything but arithmetic."""
+    tree = ast.parse(str(text), mode='eval').body
+    for node in ast.walk(tree):
+        if isinstance(node, ast.BinOp) and type(node.op) in ARITHMETIC:
+            continue
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            continue
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            continue
+        if isinstance(node, ast.Name) or type(node) in ARITHMETIC or isinstance(node, (ast.USub, ast.Load)):
+            continue
+        raise ValueError(f"Unsupported rule expression: {text}")
+    return tree
+
+
+def build(node, resolve, constant):
+    """Build an expression tree with resolve(field) for fields and constant(number) for numbers."""
+    if isinstance(node, ast.Name):
+        return resolve(node.id)
+    if isinstance(node, ast.Constant):
+        return constant(float(node.value))
+    if isinstance(node, ast.UnaryOp):
+        return -build(node.operand, resolve, constant)
+    return ARITHMETIC[type(node.op)](build(node.left, resolve, constant), build(node.right, resolve, constant))
+
+
+def load_rules(path=RULES_FILE):
+    """Read and validate the rule definitions."""
+    with open(path) as handle:
+        definitions = json.load(handle)['rules']
+    rules = []
+    for definition in definitions:
+        if definition['op'] not in OPERATORS:
+            raise ValueError(f"Unsupported operator in rule {definition['name']}: {definition['op']}")
+        expression = parse_expression(definition['expression'])
+        threshold = parse_expression(definition['threshold'])
+        fields = sorted({node.id for tree in (expression, threshold) for node in ast.walk(tree)
+                         if isinstance(node, ast.Name)})
+        unknown = [field for field in fields if field not in INPUT_FIELDS]
+        if unknown:
+            # Caught here rather than as a KeyError or AnalysisException once the query runs
+            raise ValueError(f"Unknown field in rule {definition['name']}: {', '.join(unknown)} "
+                             f"(known: {', '.join(INPUT_FIELDS)})")
+        rules.append(Rule(definition['name'], expression, definition['op'], threshold, fields))
+    return rules
+
+
+RULES = load_rules()
+
+# Every input field any rule reads
+FIELDS = sorted({field for rule in RULES for field in rule.fields})
+
+
+def evaluate_values(values, rules=None):
+    """
+    Evaluate the rules for one transaction given as a dict of field values.
+
+    Returns (status, names of the rules that fired), status being "fraud",
+    "genuine", or "error" if an input is not a number.
+    """
+    rules = RULES if rules is None else rules
+    try:
+        numbers = {field: np.float64(float(values[field])) for field in {f for rule in rules for f in rule.fields}}
+    except (TypeError, ValueError):
+        return "error", []  # Or handle the error as appropriate
+
+    fired = []
+    with np.errstate(all='ignore'):  # Division by zero gives inf/nan, which are not finite and do not fire
+        for rule in rules:
+            left = build(rule.expression, numbers.__getitem__, np.float64)
+            right = build(rule.threshold, numbers.__getitem__, np.float64)
+            if np.isfinite(left) and np.isfinite(right) and OPERATORS[rule.op](left, right):
+                fired.append(rule.name)
+    return ("fraud" if fired else "genuine"), fired
+
+
+def as_float_array(values):
+    """Values as a float array, with a mask of the ones that are present but not numbers."""
+    array = np.asarray(values)
+    if array.dtype.kind in 'fiub':
+        return array.astype(float), np.zeros(len(array), dtype=bool)
+    floats = np.full(len(array), np.nan)
+    invalid = np.zeros(len(array), dtype=bool)
+    for i, value in enumerate(array):
+        try:
+            floats[i] = float(value)
+        except (TypeError, ValueError):
+            invalid[i] = True
+    return floats, invalid
+
+
+def evaluate_arrays(columns, rules=None):
+    """
+    Vectorized NumPy evaluation for callers without Spark.
+
+    columns maps each field to an array of values. Returns (statuses, fired), an
+    array of "fraud"/"genuine"/"error" and a boolean matrix with one column per rule.
+    """
+    rules = RULES if rules is None else rules
+    numbers = {}
+    invalid = None
+    for field in {f for rule in rules for f in rule.fields}:
+        numbers[field], bad = as_float_array(columns[field])
+        invalid = bad if invalid is None else invalid | bad
+    size = len(next(iter(numbers.values()))) if numbers else 0
+
+    fired = np.zeros((size, len(rules)), dtype=bool)
+    with np.errstate(all='ignore'):  # As in evaluate_values, a side that is not finite does not fire
+        for i, rule in enumerate(rules):
+            left = build(rule.expression, numbers.__getitem__, np.float64)
+            right = build(rule.threshold, numbers.__getitem__, np.float64)
+            fired[:, i] = OPERATORS[rule.op](left, right) & np.isfinite(left) & np.isfinite(right)
+    if invalid is not None:
+        fired[invalid] = False
+    statuses = np.where(fired.any(axis=1), "fraud", "genuine").astype(object)
+    if invalid is not None:
+        statuses[invalid] = "error"
+    return statuses, fired
+
+
+def spark_columns(rules=None, fraud="fraud", genuine="genuine", error="error"):
+    """
+    Compile the rules to Spark Column expressions over the input columns, so they are
+    evaluated in the JVM. Returns (status column, column with the array of fired rule names).
+    """
+    from pyspark.sql import functions as F
+
+    rules = RULES if rules is None else rules
+    numbers = {field: F.col(field).cast('double') for field in {f for rule in rules for f in rule.fields}}
+
+    conditions = []
+    for rule in rules:
+        left = build(rule.expression, numbers.__getitem__, F.lit)
+        right = build(rule.threshold, numbers.__getitem__, F.lit)
+        # Only finite sides may fire a rule, as in evaluate_values: Spark orders NaN above every number,
+        # and division by zero gives null (compared to null, then coalesced to False)
+        finite = ~F.isnan(left) & ~F.isnan(right) & (F.abs(left) != float('inf')) & (F.abs(right) != float('inf'))
+        condition = OPERATORS[rule.op](left, right) & finite
+        conditions.append((rule.name, F.coalesce(condition, F.lit(False))))
+
+    # A field that is missing or not a number casts to null
+    missing = F.lit(False)
+    for number in numbers.values():
+        missing = missing | number.isNull()
+    fired_any = F.lit(False)
+    for _, condition in conditions:
+        fired_any = fired_any | condition
+
+    status = F.when(missing, F.lit(error)).when(fired_any, F.lit(fraud)).otherwise(F.lit(genuine))
+    names = F.array(*[F.when(condition, F.lit(name)) for name, condition in conditions])
+    fired = F.when(missing, F.array().cast('array<string>')).otherwise(F.filter(names, lambda name: name.isNotNull()))
+    return status, fired
+
+
+def fired_rules(amount, UCL, score, speed):
+    """
+    Returns the names of the fraud rules a transaction triggers.
+
+    Parameters are numbers (see fraud_status for their meaning).
+    """
+    return evaluate_values({'amount': amount, 'UCL': UCL, 'score': score, 'speed': speed})[1]
+
+
+def evaluate(amount, UCL, score, speed):
+    """
+    Like fraud_status, but also returns the names of the rules that fired.
+
+    Returns:
+    - ("fraud", [rule names]) if any of the rules fires
+    - ("genuine", []) otherwise
+    - ("error", []) if an input is not a number
+    """
+    return evaluate_values({'amount': amount, 'UCL': UCL, 'score': score, 'speed': speed})
+
+
 def fraud_status(amount, UCL, score, speed):
     """
     Determines the fraud status based on amount, UCL, score, and speed.
@@ -9,19 +209,7 @@ def fraud_status(amount, UCL, score, speed):
     - speed: Transaction speed
 
     Returns:
-    - "fraud" if any of the conditions are met
+    - "fraud" if any of the rules in rules.json fires
     - "genuine" otherwise
     """
-    try:
-        amount = float(amount)
-        UCL = float(UCL)
-        score = float(score)
-        speed = float(speed)
-    except ValueError:
-        return "error"  # Or handle the error as appropriate
-
-    if amount > UCL or score < 200 or speed > 900:
-        return "fraud"
-    else:
-        return "genuine"
-
+    return evaluate(amount, UCL, score, speed)[0]
@@ -0,0 +1,171 @@
+"""
+Load-test client for the scoring service.
+
+Sends POST /score requests at a fixed target rate (open loop: requests go out on
+schedule whether or not earlier ones have been answered) over a pool of keep-alive
+connections, and reports the achieved rate and the latency percentiles. Latency is
+measured from the time a request was due, so a server that falls behind shows up
+in the percentiles instead of silently lowering the offered load.
+
+Card ids come from a look_up_table CSV and postcodes from the zip code file, so the
+requests hit real profiles and distances.
+
+    python python/src/service/load_test.py --url http://localhost:8090 --qps 2000 --duration 30
+"""
+import argparse
+import asyncio
+import csv
+import json
+import random
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
+
+import numpy as np
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8090')
+    parser.add_argument('--qps', type=float, default=1000, help='target requests per second')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load')
+    parser.add_argument('--connections', type=int, default=64, help='maximum open connections')
+    parser.add_argument('--cards', default='look_up_table.csv', help='CSV with a card_id column')
+    parser.add_argument('--zips', default='python/src/db/uszipsv.csv', help='zip code CSV (zip first)')
+    parser.add_argument('--timeout', type=float, default=5.0, help='seconds before a request counts as failed')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default=None, help='result JSON')
+    return parser.parse_args()
+
+
+def read_column(path, column=None):
+    with open(path, newline='') as handle:
+        rows = csv.reader(handle)
+        if column is None:
+            return [row[0] for row in rows if row]
+        header = next(rows)
+        index = header.index(column)
+        return [row[index] for row in rows if row]
+
+
+class Requests:
+    """Endless stream of request bodies for random cards, one second apart in event time."""
+
+    def __init__(self, cards, zips, seed):
+        self.cards = cards
+        self.zips = zips
+        self.random = random.Random(seed)
+        self.clock = datetime(2018, 1, 1)
+
+    def next(self):
+        self.clock += timedelta(seconds=1)
+        return json.dumps({
+            'card_id': self.random.choice(self.cards),
+            'member_id': str(self.random.randrange(10 ** 9, 10 ** 10)),
+            'amount': str(self.random.randrange(100, 10 ** 6)),
+            'postcode': self.random.choice(self.zips),
+            'pos_id': str(self.random.randrange(10 ** 14, 10 ** 15)),
+            'transaction_dt': self.clock.strftime('%d-%m-%Y %H:%M:%S'),
+        }).encode('utf-8')
+
+
+class ConnectionPool:
+    """Keep-alive connections to the service, opened on demand up to a limit."""
+
+    def __init__(self, host, port, limit):
+        self.host = host
+        self.port = port
+        self.idle = []
+        self.slots = asyncio.Semaphore(limit)
+
+    async def acquire(self):
+        await self.slots.acquire()
+        if self.idle:
+            return self.idle.pop()
+        return await asyncio.open_connection(self.host, self.port)
+
+    def release(self, connection, reusable):
+        if reusable:
+            self.idle.append(connection)
+        else:
+            connection[1].close()
+        self.slots.release()
+
+
+async def post(pool, host, body, timeout):
+    """Send one request; return the response status and JSON body."""
+    connection = await pool.acquire()
+    reader, writer = connection
+    try:
+        writer.write((f'POST /score HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n'
+                      f'Content-Length: {len(body)}\r\n\r\n').encode('latin-1') + body)
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+        lines = head.decode('latin-1').split('\r\n')
+        length = next(int(line.split(':', 1)[1]) for line in lines if line.lower().startswith('content-length:'))
+        payload = await asyncio.wait_for(reader.readexactly(length), timeout)
+        pool.release(connection, True)
+        return int(lines[0].split(' ')[1]), json.loads(payload)
+    except BaseException:
+        pool.release(connection, False)
+        raise
+
+
+async def run(args):
+    url = urlparse(args.url)
+    pool = ConnectionPool(url.hostname, url.port or 80, args.connections)
+    requests = Requests(read_column(args.cards, 'card_id'), read_column(args.zips), args.seed)
+    latencies = []
+    outcomes = {}
+
+    async def one(due, body):
+        try:
+            status, payload = await post(pool, url.hostname, body, args.timeout)
+            outcome = payload.get('status') if status == 200 else f'http_{status}'
+        except Exception as e:
+            outcome = type(e).__name__
+        latencies.append(time.perf_counter() - due)
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    total = int(args.qps * args.duration)
+    interval = 1.0 / args.qps
+    started = time.perf_counter()
+    tasks = []
+    for i in range(total):
+        due = started + i * interval
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(one(due, requests.next())))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    millis = np.array(latencies) * 1000
+    failed = sum(count for outcome, count in outcomes.items() if outcome not in ('GENUINE', 'FRAUD'))
+    return {
+        'target_qps': args.qps,
+        'achieved_qps': len(latencies) / elapsed,
+        'requests': len(latencies),
+        'failed': failed,
+        'outcomes': outcomes,
+        'latency_ms': {name: float(np.percentile(millis, q)) for name, q in
+                       (('p50', 50), ('p90', 90), ('p99', 99), ('p999', 99.9))} | {'max': float(millis.max())},
+    }
+
+
+def main():
+    args = parse_args()
+    result = asyncio.run(run(args))
+    latency = result['latency_ms']
+    print(f"{result['requests']} requests at {result['achieved_qps']:.0f}/s (target {args.qps:.0f}/s), "
+          f"{result['failed']} failed")
+    print(f"latency ms: p50 {latency['p50']:.2f}  p90 {latency['p90']:.2f}  p99 {latency['p99']:.2f}  "
+          f"p99.9 {latency['p999']:.2f}  max {latency['max']:.2f}")
+    print(f"outcomes: {result['outcomes']}")
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump({'config': vars(args), 'result': result}, handle, indent=2)
+        print(f"Results saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+"""
+Standalone scoring service for synchronous authorization calls.
+
+Scores one transaction per request with the streaming pipeline's scoring code
+(the rules of rules.json, GEO_Map distances, look_up_table profiles through
+HBaseDao), without Spark:
+
+    POST /score   {"card_id": "...", "member_id": "...", "amount": "...", "postcode": "...",
+                   "pos_id": "...", "transaction_dt": "dd-mm-YYYY HH:MM:SS"}
+              ->  {"card_id": "...", "status": "GENUINE", "fired_rules": []}
+    GET /health
+    GET /metrics  (Prometheus text, for the worker process that answers)
+
+Each worker process runs an asyncio HTTP/1.1 server on the same port (SO_REUSEPORT,
+the kernel spreads connections over them) and keeps the parsed profiles of hot
+cards in memory. A profile is read from HBase on a miss (on a thread, off the event
+loop) and carried forward in memory after every genuine transaction. The
+card_transactions row and the look_up_table update are handed to a background
+WriteBatcher, so responses never wait for HBase writes.
+
+Cards are not pinned to a worker: a profile updated by one worker reaches the
+others through HBase once it is written and their cached copy expires
+(FRAUD_PROFILE_CACHE_TTL). Carrying a profile forward does not extend the life of
+the cached copy, so a busy card is re-read at least once per TTL.
+
+    python python/src/service/scoring_service.py --port 8090 --workers 4
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'rules'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import dao
+from db import geo_map
+from db import profile_cache
+from db import row_keys
+from metrics import registry
+from pipeline import scoring
+from service import write_batcher
+
+# Format of transaction_dt in requests, as in the Kafka messages
+REQUEST_DT_FORMAT = '%d-%m-%Y %H:%M:%S'
+REQUEST_FIELDS = ('card_id', 'member_id', 'amount', 'postcode', 'pos_id', 'transaction_dt')
+MAX_BODY = 64 * 1024
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='server processes')
+    parser.add_argument('--lookup-threads', type=int, default=8, help='concurrent HBase reads per process')
+    parser.add_argument('--profile-cache-size', type=int, default=100000, help='parsed card profiles kept per process')
+    parser.add_argument('--batch-size', type=int, default=500, help='rows per background write batch')
+    parser.add_argument('--flush-interval', type=float, default=0.05, help='seconds before a partial batch is written')
+    parser.add_argument('--no-writes', action='store_true', help='score without writing to HBase (shadow mode)')
+    return parser.parse_args()
+
+
+class ParsedProfileCache(profile_cache.ProfileCache):
+    """ProfileCache holding CardProfile tuples ready for scoring instead of raw look_up_table cells."""
+
+    def pack(self, row):
+        return row
+
+    def unpack(self, values):
+        return values
+
+
+class ProfileUnavailable(Exception):
+    """A card profile could not be read from HBase; the request is answered with 503."""
+
+
+def cell(row, column):
+    value = row.get(column)
+    return value.decode('utf-8') if isinstance(value, bytes) else None
+
+
+class Scorer:
+    """Scores requests of one worker process against its in-memory card profiles."""
+
+    def __init__(self, args):
+        settings = dao.default_settings()
+        # Profiles are cached here already parsed, so the DAO does not keep its own copy.
+        # Each lookup thread holds an HBase connection while it reads
+        dao.HBaseDao.configure(profile_cache_size=0, pool_size=max(settings['pool_size'], args.lookup_threads))
+        self.hdao = dao.HBaseDao.get_instance()
+        self.gmap = geo_map.GEO_Map.get_instance()
+        self.profiles = ParsedProfileCache(max(args.profile_cache_size, 1), settings['profile_cache_ttl'])
+        self.lookups = ThreadPoolExecutor(max_workers=args.lookup_threads, thread_name_prefix='profile-lookup')
+        self.writer = None if args.no_writes else write_batcher.WriteBatcher(args.batch_size, args.flush_interval)
+
+    async def profile(self, card_id):
+        key = dao.lookup_key(card_id)
+        profile = self.profiles.get(key)
+        if profile is None:
+            # A miss reads the card from HBase on a thread, so other requests keep being served.
+            # A failed read is not scored as an unknown card, nor cached: the caller gets a 503 and can retry
+            try:
+                row = await asyncio.get_running_loop().run_in_executor(
+                    self.lookups, self.hdao.read_row, key, dao.PROFILE_TABLE)
+            except Exception as e:
+                raise ProfileUnavailable(f"profile of card {card_id} unavailable: {e}") from e
+            profile = scoring.profile_from_lookup(cell(row, b'info:score'), cell(row, b'info:UCL'),
+                                                  cell(row, b'info:postcode'), cell(row, b'info:transaction_dt'))
+            self.profiles.put(key, profile)
+        return profile
+
+    async def score(self, request):
+        """Score one request (a dict of REQUEST_FIELDS) and queue its writes."""
+        transaction = SimpleNamespace(
+            card_id=str(request['card_id']),
+            member_id=int(request['member_id']),
+            amount=int(float(request['amount'])),
+            postcode=int(request['postcode']),
+            pos_id=int(request['pos_id']),
+            transaction_dt=datetime.strptime(request['transaction_dt'], REQUEST_DT_FORMAT),
+        )
+        key = dao.lookup_key(transaction.card_id)
+        profile = await self.profile(transaction.card_id)
+        # Naive timestamps are taken as UTC, as in the streaming query
+        status, fired, updated = scoring.score_event(profile, transaction.amount, transaction.postcode,
+                                                     pd.Timestamp(transaction.transaction_dt), self.gmap)
+        transaction.status = status
+        if updated is not profile:
+            # The card's next transaction is measured from this one. The entry keeps its expiry, so the
+            # profile is still read back from HBase (with other workers' updates) once its TTL has passed
+            self.profiles.replace(key, updated)
+        if self.writer is not None:
+            self.writer.submit(dao.TRANSACTIONS_TABLE, row_keys.transaction_key(
+                transaction.card_id, transaction.transaction_dt, transaction.member_id, transaction.amount,
+                transaction.postcode, transaction.pos_id), dao.transaction_cells(transaction))
+            if status == "GENUINE":
+                self.writer.submit(dao.PROFILE_TABLE, key, dao.lookup_cells(transaction))
+        return {'card_id': transaction.card_id, 'status': status, 'fired_rules': fired}
+
+    def metrics(self):
+        stats = self.profiles.stats()
+        registry.REGISTRY.set('service_profile_cache_size', stats['size'])
+        registry.REGISTRY.set('service_profile_cache_hit_rate', stats['hit_rate'])
+        return registry.render_prometheus(registry.REGISTRY.snapshot())
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.lookups.shutdown(wait=False)
+
+
+def response(status, body, content_type='application/json', keep_alive=True):
+    if not isinstance(body, bytes):
+        body = (json.dumps(body) if content_type == 'application/json' else body).encode('utf-8')
+    return (f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n'
+            f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n').encode('latin-1') + body
+
+
+async def handle_connection(scorer, reader, writer):
+    # Minimal HTTP/1.1 with keep-alive: one request at a time per connection
+    try:
+        while True:
+            try:
+                head = await reader.readuntil(b'\r\n\r\n')
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+            lines = head.decode('latin-1').split('\r\n')
+            method, path, version = (lines[0].split(' ') + ['', '', ''])[:3]
+            headers = {name.strip().lower(): value.strip()
+                       for name, _, value in (line.partition(':') for line in lines[1:] if line)}
+            keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+            length = int(headers.get('content-length', '0') or 0)
+            if length > MAX_BODY:
+                writer.write(response('413 Payload Too Large', {'error': 'body too large'}, keep_alive=False))
+                return
+            body = await reader.readexactly(length) if length else b''
+            writer.write(await route(scorer, method, path, body, keep_alive))
+            await writer.drain()
+            if not keep_alive:
+                return
+    finally:
+        writer.close()
+
+
+async def route(scorer, method, path, body, keep_alive):
+    started = time.perf_counter()
+    if method == 'POST' and path == '/score':
+        try:
+            request = json.loads(body)
+            missing = [name for name in REQUEST_FIELDS if request.get(name) in (None, '')]
+            if missing:
+                raise ValueError(f"missing fields: {', '.join(missing)}")
+            result = await scorer.score(request)
+        except (ValueError, TypeError, KeyError) as e:
+            registry.REGISTRY.inc('service_requests', outcome='bad_request')
+            return response('400 Bad Request', {'error': str(e)}, keep_alive=keep_alive)
+        except ProfileUnavailable as e:
+            registry.REGISTRY.inc('service_requests', outcome='unavailable')
+            print(f"Error scoring request: {e}")
+            return response('503 Service Unavailable', {'error': str(e)}, keep_alive=keep_alive)
+        except Exception as e:
+            registry.REGISTRY.inc('service_requests', outcome='error')
+            print(f"Error scoring request: {e}")
+            return response('500 Internal Server Error', {'error': str(e)}, keep_alive=keep_alive)
+        registry.REGISTRY.inc('service_requests', outcome=result['status'])
+        registry.REGISTRY.observe('service_seconds', time.perf_counter() - started, operation='score')
+        return response('200 OK', result, keep_alive=keep_alive)
+    if method == 'GET' and path == '/health':
+        return response('200 OK', {'status': 'ok', 'pid': os.getpid()}, keep_alive=keep_alive)
+    if method == 'GET' and path == '/metrics':
+        return response('200 OK', scorer.metrics(), content_type='text/plain; version=0.0.4', keep_alive=keep_alive)
+    return response('404 Not Found', {'error': f'no route for {method} {path}'}, keep_alive=keep_alive)
+
+
+async def serve(args):
+    scorer = Scorer(args)
+    server = await asyncio.start_server(lambda reader, writer: handle_connection(scorer, reader, writer),
+                                        args.host, args.port, reuse_port=True, backlog=1024)
+    stop = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        asyncio.get_running_loop().add_signal_handler(signum, stop.set)
+    print(f"Scoring service worker {os.getpid()} listening on {args.host}:{args.port}")
+    async with server:
+        await stop.wait()
+    # Queued writes are flushed before the worker exits
+    scorer.close()
+
+
+def run_worker(args):
+    asyncio.run(serve(args))
+
+
+def main():
+    args = parse_args()
+    if args.workers <= 1:
+        run_worker(args)
+        return
+    # Fresh interpreters: every worker opens its own HBase connections and maps GEO_Map itself
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=run_worker, args=(args,), name=f'scoring-worker-{i}')
+               for i in range(args.workers)]
+    for worker in workers:
+        worker.start()
+
+    # Stopping the parent stops the workers, which flush their queued writes before exiting
+    def stop(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == '__main__':
+    main()
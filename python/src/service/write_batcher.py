@@ -0,0 +1,75 @@
+import queue
+import threading
+import time
+
+from db import dao
+from metrics import registry
+
+
+class WriteBatcher:
+    """
+    Collects single-row writes from the scoring service and stores them in batched
+    mutations from a background thread, so a request never waits for HBase.
+
+    A batch is written when batch_size rows are queued or flush_interval seconds
+    after its first row, whichever comes first. The queue is bounded: if HBase
+    falls behind for long (max_pending rows queued), submit() drops the row and
+    counts it in service_rows_dropped rather than letting memory grow without limit
+    or blocking the event loop it is called from.
+    """
+
+    def __init__(self, batch_size=500, flush_interval=0.05, max_pending=100000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self.run, name="write-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, table, key, cells):
+        """Queue one row write, or drop it if the queue is full."""
+        try:
+            self.pending.put_nowait((table, key, cells))
+        except queue.Full:
+            registry.REGISTRY.inc('service_rows_dropped', table=table, reason='queue_full')
+
+    def run(self):
+        hdao = dao.HBaseDao.get_instance()
+        stopping = False
+        while not stopping:
+            item = self.pending.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.pending.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self.write(hdao, batch)
+            registry.REGISTRY.set('service_write_queue', self.pending.qsize())
+
+    def write(self, hdao, batch):
+        # One batched mutation per table, in the order the rows were submitted
+        tables = {}
+        for table, key, cells in batch:
+            tables.setdefault(table, []).append((key, cells))
+        for table, rows in tables.items():
+            try:
+                if table == dao.PROFILE_TABLE:
+                    hdao.write_profile_updates(rows, self.batch_size)
+                else:
+                    hdao.write_batch(rows, table, self.batch_size)
+                registry.REGISTRY.inc('service_rows_written', len(rows), table=table)
+            except Exception as e:
+                registry.REGISTRY.inc('service_rows_dropped', len(rows), table=table, reason='write_error')
+                print(f"Error writing {len(rows)} rows to {table}: {e}")
+
+    def close(self):
+        """Write what is queued and stop the thread."""
+        self.pending.put(None)
+        self.thread.join()
@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+# The modules import each other as in driver.py: db.*, pipeline.*, metrics.* from python/src and rules from python/src/rules
+sys.path.insert(0, os.path.join(SRC, 'rules'))
+sys.path.insert(0, SRC)
+
+
+@pytest.fixture(scope='session')
+def spark():
+    """A local SparkSession for the tests that compare against Spark's own evaluation."""
+    pytest.importorskip('pyspark')
+    from pyspark.sql import SparkSession
+
+    # The Python workers import the modules like the tests do, and never reach a real HBase
+    python_path = os.pathsep.join([SRC, os.path.join(SRC, 'rules'), os.environ.get('PYTHONPATH', '')])
+    session = SparkSession.builder.master('local[2]').appName('fraud-tests') \
+        .config('spark.executorEnv.PYTHONPATH', python_path) \
+        .config('spark.executorEnv.FRAUD_DAO_BACKEND', 'memory') \
+        .config('spark.sql.shuffle.partitions', '2') \
+        .config('spark.sql.session.timeZone', 'UTC') \
+        .config('spark.ui.enabled', 'false') \
+        .getOrCreate()
+    yield session
+    session.stop()
@@ -0,0 +1,76 @@
+import base64
+import json
+from datetime import datetime
+
+import pytest
+
+from pipeline import decode
+
+TRANSACTION = {'card_id': '348702330256514', 'member_id': '37495066290', 'amount': '9084849', 'postcode': '33946',
+               'pos_id': '614677375609919', 'transaction_dt': '11-02-2018 00:00:00'}
+
+
+def decode_values(spark, values, wire_format, column_type='string'):
+    raw = spark.createDataFrame([(value,) for value in values], f'value {column_type}')
+    return decode.decode_records(raw, wire_format).collect()
+
+
+@pytest.mark.parametrize('wire_format, value', [
+    ('json', json.dumps(TRANSACTION)),
+    # The producer sends the JSON object as an escaped JSON string
+    ('lenient', json.dumps(json.dumps(TRANSACTION))),
+])
+def test_json_formats_decode(spark, wire_format, value):
+    [row] = decode_values(spark, [value], wire_format)
+    assert row['decode_error'] is None
+    assert (row['card_id'], row['member_id'], row['amount'], row['postcode'], row['pos_id']) == \
+        ('348702330256514', 37495066290, 9084849, 33946, 614677375609919)
+    assert row['transaction_dt'] == datetime(2018, 2, 11)
+
+
+def test_binary_format_decodes(spark):
+    value = decode.pack_binary(348702330256514, 37495066290, 9084849, 33946, 614677375609919, 1518307200)
+    [row] = decode_values(spark, [bytearray(value)], 'binary', 'binary')
+    assert row['decode_error'] is None
+    assert (row['card_id'], row['amount'], row['postcode']) == ('348702330256514', 9084849, 33946)
+    assert row['transaction_dt'] == datetime(2018, 2, 11)
+
+
+def test_json_errors(spark):
+    rows = decode_values(spark, ['not json', '{}', json.dumps({**TRANSACTION, 'amount': 'x', 'pos_id': None}),
+                                 json.dumps({**TRANSACTION, 'transaction_dt': '2018-02-11'})], 'json')
+    assert [row['decode_error'] for row in rows] == [
+        'unparseable record', 'unparseable record', 'missing or invalid: amount,pos_id',
+        'missing or invalid: transaction_dt']
+
+
+def test_binary_errors(spark):
+    good = decode.pack_binary(1, 2, 3, 4, 5, 6)
+    rows = decode_values(spark, [bytearray(good[:-1]), bytearray(b'\x02' + good[1:])], 'binary', 'binary')
+    assert [row['decode_error'] for row in rows] == ['bad record length', 'unknown record version']
+
+
+def test_unknown_wire_format(spark):
+    raw = spark.createDataFrame([('{}',)], 'value string')
+    with pytest.raises(ValueError, match='Unknown wire format'):
+        decode.decode(raw, 'xml')
+
+
+def test_split_routes_each_record_once(spark):
+    values = [json.dumps(TRANSACTION), 'not json', json.dumps({**TRANSACTION, 'card_id': '1'}), '{}']
+    raw = spark.createDataFrame([(value, 'transactions', 0, offset) for offset, value in enumerate(values)],
+                                'value string, topic string, partition int, offset long')
+    transactions, rejected = decode.split_dead_letters(decode.decode_records(raw, 'json'))
+    assert transactions.columns == ['card_id', 'member_id', 'amount', 'postcode', 'pos_id', 'transaction_dt']
+    assert sorted(row['card_id'] for row in transactions.collect()) == ['1', '348702330256514']
+    assert rejected.columns == ['topic', 'partition', 'offset', 'raw_value', 'decode_error']
+    assert [(row['offset'], row['raw_value']) for row in rejected.orderBy('offset').collect()] == \
+        [(1, 'not json'), (3, '{}')]
+
+
+def test_binary_dead_letters_keep_the_value_in_base64(spark):
+    value = b'\x01\x02'
+    raw = spark.createDataFrame([(bytearray(value),)], 'value binary')
+    [row] = decode.dead_letters(raw, 'binary').collect()
+    assert row['raw_value'] == base64.b64encode(value).decode('ascii')
+    assert row['decode_error'] == 'bad record length'
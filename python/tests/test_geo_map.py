@@ -0,0 +1,142 @@
+import math
+import os
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from db import geo_map
+
+ZIP_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'db', 'uszipsv.csv')
+
+# Duplicated, malformed and out-of-range rows next to good ones
+EDGE_ROWS = """501,40.8154,-73.0451,Holtsville,NY
+1001,42.0702,-72.6227,Agawam,MA
+1001,10.0,10.0,Duplicate,MA
+1002,abc,-72.5,Malformed,MA
+1003,95.0,-72.5,OutOfRange,MA
+99950,55.5422,-131.4322,Ketchikan,AK
+"""
+
+
+class OldGeoMap:
+    """The frame-scan GEO_Map the zip index replaced, kept as the reference."""
+
+    def __init__(self, path):
+        self.map = pd.read_csv(path, header=None, names=['A', 'B', 'C', 'D', 'E'])
+        self.map['A'] = self.map['A'].astype(int)
+        self.map['B'] = pd.to_numeric(self.map['B'], errors='coerce')
+        self.map['C'] = pd.to_numeric(self.map['C'], errors='coerce')
+
+    def get_lat(self, pos_id):
+        result = self.map[self.map.A == pos_id]
+        return None if result.empty else result.B.iloc[0]
+
+    def get_long(self, pos_id):
+        result = self.map[self.map.A == pos_id]
+        return None if result.empty else result.C.iloc[0]
+
+    def distance(self, lat1, long1, lat2, long2):
+        if None in [lat1, long1, lat2, long2]:
+            return float('nan')
+        if not (-90 <= lat1 <= 90 and -180 <= long1 <= 180 and -90 <= lat2 <= 90 and -180 <= long2 <= 180):
+            return float('nan')
+        rad = math.pi / 180.0
+        dist = (math.sin(lat1 * rad) * math.sin(lat2 * rad) +
+                math.cos(lat1 * rad) * math.cos(lat2 * rad) * math.cos((long1 - long2) * rad))
+        return math.acos(min(1.0, max(-1.0, dist))) * 180.0 / math.pi * 60 * 1.1515 * 1.609344
+
+    def distance_zip(self, a, b):
+        return self.distance(self.get_lat(a), self.get_long(a), self.get_lat(b), self.get_long(b))
+
+
+def index(path):
+    gmap = geo_map.GEO_Map.__new__(geo_map.GEO_Map)
+    gmap.build_index(*geo_map.read_csv(path))
+    return gmap
+
+
+def same(a, b):
+    if a is None or b is None:
+        return a is None and b is None
+    return (math.isnan(a) and math.isnan(b)) or a == pytest.approx(b, rel=1e-12, abs=1e-9)
+
+
+@pytest.fixture(scope='module')
+def edge_csv(tmp_path_factory):
+    path = tmp_path_factory.mktemp('zips') / 'zips.csv'
+    path.write_text(EDGE_ROWS)
+    return str(path)
+
+
+POSTCODES = [501, 1001, 1002, 1003, 99950, 1004, 0, -5, 10 ** 6, 1001.0, 1001.5, '1001', None, math.nan]
+
+
+def test_lookups_match_the_frame_scan(edge_csv):
+    old, new = OldGeoMap(edge_csv), index(edge_csv)
+    for postcode in POSTCODES:
+        assert same(new.get_lat(postcode), old.get_lat(postcode)), postcode
+        assert same(new.get_long(postcode), old.get_long(postcode)), postcode
+    # The first row of a duplicated zip wins
+    assert new.get_lat(1001) == pytest.approx(42.0702)
+
+
+def test_distances_match_the_frame_scan(edge_csv):
+    old, new = OldGeoMap(edge_csv), index(edge_csv)
+    pairs = [(a, b) for a in POSTCODES for b in POSTCODES]
+    many = new.distance_many([a for a, _ in pairs], [b for _, b in pairs])
+    for (a, b), vectorized in zip(pairs, many):
+        expected = old.distance_zip(a, b)
+        assert same(new.distance_zip(a, b), expected), (a, b)
+        assert same(float(vectorized), expected), (a, b)
+
+
+def test_full_zip_file_matches_the_frame_scan():
+    old, new = OldGeoMap(ZIP_CSV), index(ZIP_CSV)
+    zips = old.map['A'].tolist()
+    pairs = [tuple(random.Random(seed).sample(zips, 2)) for seed in range(300)]
+    many = new.distance_many([a for a, _ in pairs], [b for _, b in pairs])
+    for (a, b), vectorized in zip(pairs, many):
+        expected = old.distance_zip(a, b)
+        assert same(new.distance_zip(a, b), expected)
+        assert same(float(vectorized), expected)
+
+
+@pytest.mark.parametrize('extra_zip', [None, 99951])
+def test_artifact_maps_the_same_index(edge_csv, tmp_path, extra_zip):
+    # An odd and an even array size: every array of the artifact starts on an 8-byte boundary
+    zips, lats, longs = geo_map.read_csv(edge_csv)
+    if extra_zip is not None:
+        zips, lats, longs = np.append(zips, extra_zip), np.append(lats, 50.0), np.append(longs, -100.0)
+    path = str(tmp_path / 'zips.bin')
+    size = geo_map.write_artifact(zips, lats, longs, path)
+    built = geo_map.GEO_Map.__new__(geo_map.GEO_Map)
+    built.build_index(zips, lats, longs)
+    mapped_known, mapped_lats, mapped_longs = geo_map.map_artifact(path)
+    assert size == len(built.known)
+    assert np.array_equal(mapped_known, built.known)
+    # Stored as float32
+    np.testing.assert_allclose(mapped_lats, built.lats, rtol=1e-6, equal_nan=True)
+    np.testing.assert_allclose(mapped_longs, built.longs, rtol=1e-6, equal_nan=True)
+
+
+def test_zip_frame_keeps_the_first_occurrence(edge_csv):
+    frame = index(edge_csv).zip_frame()
+    assert frame['zip'].tolist() == [501, 1001, 1002, 1003, 99950]
+    assert frame.loc[frame['zip'] == 1001, 'lat'].item() == pytest.approx(42.0702)
+
+
+def test_spark_distance_matches(spark, edge_csv):
+    from pipeline import transform
+
+    gmap = index(edge_csv)
+    zips = spark.createDataFrame(gmap.zip_frame(), 'zip long, lat double, long double')
+    codes = [501, 1001, 1002, 1003, 99950, 1004, None]
+    pairs = [(a, b, 1.0) for a in codes for b in codes]
+    df = spark.createDataFrame(pairs, 'last_postcode long, postcode long, time_diff_hours_abs double')
+    result = transform.with_geo_velocity(df, zips).select('last_postcode', 'postcode', 'distance').collect()
+    assert len(result) == len(pairs)
+    for row in result:
+        expected = gmap.distance_zip(row['last_postcode'], row['postcode'])
+        assert same(row['distance'], expected), (row['last_postcode'], row['postcode'])
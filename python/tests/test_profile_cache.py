@@ -0,0 +1,104 @@
+import pytest
+
+from db import profile_cache
+
+ROW = {b'info:card_id': b'1', b'info:score': b'250', b'info:UCL': b'1000.0', b'info:postcode': b'33946',
+       b'info:transaction_dt': b'2018-02-11T10:05:03.000Z'}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(profile_cache.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_rows_round_trip_without_other_columns():
+    cache = profile_cache.ProfileCache(10)
+    cache.put(b'1', {**ROW, b'info:other': b'x'})
+    assert cache.get(b'1') == ROW
+
+
+def test_missing_rows_are_cached_as_empty():
+    cache = profile_cache.ProfileCache(10)
+    assert cache.get(b'2') is None
+    cache.put(b'2', {})
+    assert cache.get(b'2') == {}
+
+
+def test_least_recently_used_is_evicted():
+    cache = profile_cache.ProfileCache(2)
+    cache.put(b'1', ROW)
+    cache.put(b'2', ROW)
+    cache.get(b'1')  # 2 is now the least recently used
+    cache.put(b'3', ROW)
+    assert cache.get(b'2') is None
+    assert cache.get(b'1') == ROW and cache.get(b'3') == ROW
+    assert cache.stats()['evictions'] == 1 and cache.stats()['size'] == 2
+
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = profile_cache.ProfileCache(10, ttl=60)
+    cache.put(b'1', ROW)
+    clock[0] += 59
+    assert cache.get(b'1') == ROW
+    clock[0] += 1
+    assert cache.get(b'1') is None
+    assert cache.stats()['expirations'] == 1 and cache.stats()['size'] == 0
+
+
+def test_no_ttl_keeps_entries(clock):
+    cache = profile_cache.ProfileCache(10, ttl=None)
+    cache.put(b'1', ROW)
+    clock[0] += 10 ** 6
+    assert cache.get(b'1') == ROW
+
+
+def test_write_through_merges_into_cached_rows_only(clock):
+    cache = profile_cache.ProfileCache(10, ttl=60)
+    cache.put(b'1', ROW)
+    clock[0] += 30
+    cache.update(b'1', {b'info:postcode': b'10001'})
+    cache.update(b'2', {b'info:postcode': b'10001'})
+    assert cache.get(b'1') == {**ROW, b'info:postcode': b'10001'}
+    assert cache.get(b'2') is None
+    # A write-through keeps the entry's expiry, so the row is read back from storage within the TTL
+    clock[0] += 30
+    assert cache.get(b'1') is None
+
+
+def test_write_through_does_not_revive_expired_rows(clock):
+    cache = profile_cache.ProfileCache(10, ttl=60)
+    cache.put(b'1', ROW)
+    clock[0] += 60
+    cache.update(b'1', {b'info:postcode': b'10001'})
+    assert cache.stats()['size'] == 0 and cache.stats()['expirations'] == 1
+    assert cache.get(b'1') is None
+
+
+def test_invalidate_and_stats():
+    cache = profile_cache.ProfileCache(10)
+    cache.put(b'1', ROW)
+    cache.invalidate(b'1')
+    cache.invalidate(b'missing')
+    assert cache.get(b'1') is None
+    cache.put(b'1', ROW)
+    cache.get(b'1')
+    assert cache.stats() == {'size': 1, 'hits': 1, 'misses': 1, 'hit_rate': 0.5, 'evictions': 0,
+                             'expirations': 0}
+
+
+def test_replace_keeps_the_expiry(clock):
+    cache = profile_cache.ProfileCache(10, ttl=60)
+    cache.replace(b'1', ROW)
+    assert cache.get(b'1') is None  # Not cached, so not added
+    cache.put(b'1', ROW)
+    clock[0] += 30
+    cache.replace(b'1', {**ROW, b'info:score': b'300'})
+    assert cache.get(b'1') == {**ROW, b'info:score': b'300'}
+    clock[0] += 30
+    assert cache.get(b'1') is None
+    cache.put(b'2', ROW)
+    clock[0] += 60
+    cache.replace(b'2', ROW)
+    assert cache.stats()['size'] == 0
@@ -0,0 +1,95 @@
+import pytest
+
+from db import dao
+from db import profile_format
+
+PROFILE = {
+    b'info:card_id': b'348702330256514',
+    b'info:score': b'250',
+    b'info:UCL': b'1234567.89',
+    b'info:postcode': b'33946',
+    b'info:transaction_dt': b'2018-02-11T10:05:03.000Z',
+}
+
+
+def test_round_trip():
+    value = profile_format.pack(PROFILE)
+    assert len(value) == profile_format.PACKED_STRUCT.size == 31
+    assert profile_format.unpack(value) == PROFILE
+
+
+def test_numbers_stored_as_floats_are_read_back_as_integers():
+    cells = {**PROFILE, b'info:score': b'250.0', b'info:postcode': b'33946.0'}
+    assert profile_format.unpack(profile_format.pack(cells)) == PROFILE
+
+
+def test_card_ids_stored_as_floats_are_read_back_as_integers():
+    # The old loader's info:card_id cell, as the '.0' row keys still show
+    cells = {**PROFILE, b'info:card_id': b'348702330256514.0'}
+    assert profile_format.unpack(profile_format.pack(cells)) == PROFILE
+
+
+@pytest.mark.parametrize('column', [b'info:score', b'info:UCL', b'info:postcode', b'info:transaction_dt'])
+def test_missing_fields_stay_missing(column):
+    for cells in ({k: v for k, v in PROFILE.items() if k != column}, {**PROFILE, column: b''}):
+        assert profile_format.unpack(profile_format.pack(cells)) == \
+            {k: v for k, v in PROFILE.items() if k != column}
+
+
+@pytest.mark.parametrize('card_id', [b'4.01124E+15', b'', None, b'12a', b'12.5', b'.0'])
+def test_card_ids_must_be_integers(card_id):
+    with pytest.raises(ValueError):
+        profile_format.pack({**PROFILE, b'info:card_id': card_id})
+
+
+def test_unknown_version_is_rejected():
+    value = profile_format.pack(PROFILE)
+    with pytest.raises(ValueError, match='version'):
+        profile_format.unpack(b'\x02' + value[1:])
+    with pytest.raises(ValueError):
+        profile_format.unpack(b'')
+
+
+def test_expand_reads_both_layouts():
+    assert profile_format.expand(PROFILE) is PROFILE
+    packed = profile_format.packed_cells(PROFILE)
+    assert profile_format.expand(packed) == PROFILE
+    # A packed cell takes precedence over leftover string cells
+    stale = {**packed, b'info:score': b'100', b'info:other': b'x'}
+    assert profile_format.expand(stale) == {**PROFILE, b'info:other': b'x'}
+
+
+def test_lookup_keys():
+    assert profile_format.lookup_key(348702330256514, 'packed') == '348702330256514'
+    assert profile_format.lookup_key('348702330256514', 'cells') == '348702330256514.0'
+
+
+@pytest.fixture
+def packed_dao(monkeypatch):
+    monkeypatch.setattr(profile_format, 'PROFILE_FORMAT', 'packed')
+    monkeypatch.setattr(dao.HBaseDao, '_instance', None)
+    monkeypatch.setattr(dao.HBaseDao, '_settings', None)
+    dao.HBaseDao.configure(backend='memory', profile_cache_size=0, fetch_mode='multiget')
+    hdao = dao.HBaseDao.get_instance()
+    hdao.ensure_table(dao.PROFILE_TABLE, {'info': dict()})
+    return hdao
+
+
+def test_updates_merge_into_the_stored_profile(packed_dao):
+    key = b'348702330256514'
+    packed_dao.write_batch([(key, profile_format.packed_cells(PROFILE))], dao.PROFILE_TABLE)
+    packed_dao.write_profile_updates([
+        (key, {b'info:postcode': b'10001', b'info:transaction_dt': b'2018-03-01T00:00:00.000Z'}),
+        (key, {b'info:transaction_dt': b'2018-03-02T00:00:00.000Z'}),
+    ])
+    row = packed_dao.get_data(key.decode(), dao.PROFILE_TABLE)
+    assert row == {**PROFILE, b'info:postcode': b'10001', b'info:transaction_dt': b'2018-03-02T00:00:00.000Z'}
+
+
+def test_updates_of_new_cards_and_bad_ids(packed_dao):
+    packed_dao.write_profile_updates([
+        (b'4.01124E+15', {b'info:postcode': b'10001'}),
+        (b'42', {b'info:postcode': b'10001'}),
+    ])
+    assert packed_dao.get_data('42', dao.PROFILE_TABLE) == {b'info:card_id': b'42', b'info:postcode': b'10001'}
+    assert packed_dao.get_data('4.01124E+15', dao.PROFILE_TABLE) == {}
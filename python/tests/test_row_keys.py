@@ -0,0 +1,82 @@
+import random
+from datetime import datetime, timedelta
+
+from db import row_keys
+
+
+def key(card_id, transaction_dt, pos_id=1):
+    return row_keys.transaction_key(card_id, transaction_dt, 37495066290, 9084849, 33946, pos_id)
+
+
+def scan(keys, row_start, row_stop):
+    """The keys an HBase scan over [row_start, row_stop) returns, in order."""
+    return [k for k in sorted(keys) if row_start <= k < row_stop]
+
+
+def test_newest_first_within_a_card():
+    times = [datetime(2018, 1, 1) + timedelta(seconds=random.Random(i).randrange(10 ** 8)) for i in range(50)]
+    keys = [key('348702330256514', t) for t in times]
+    ordered = [t for _, t in sorted(zip(keys, times))]
+    assert ordered == sorted(times, reverse=True)
+
+
+def test_milliseconds_are_ordered():
+    later = datetime(2018, 1, 1, 0, 0, 0, 2000)
+    earlier = datetime(2018, 1, 1, 0, 0, 0, 1000)
+    assert key('1', later) < key('1', earlier)
+
+
+def test_same_second_transactions_get_distinct_keys():
+    when = datetime(2018, 1, 1)
+    assert key('1', when, pos_id=1) != key('1', when, pos_id=2)
+    assert key('1', when, pos_id=1) == key('1', when, pos_id=1)
+
+
+def test_key_layout():
+    k = key('348702330256514', datetime(2018, 2, 11))
+    assert row_keys.is_transaction_key(k)
+    assert k.startswith(row_keys.card_prefix('348702330256514'))
+    assert not row_keys.is_transaction_key('348702330256514.0')
+    assert 0 <= int(row_keys.salt('348702330256514'), 16) < row_keys.SALT_BUCKETS
+
+
+def test_history_range_holds_one_card():
+    start = datetime(2018, 1, 1)
+    keys = {card: [key(card, start + timedelta(hours=i)) for i in range(10)] for card in ('1', '12', '2', '10')}
+    everything = [k for card_keys in keys.values() for k in card_keys]
+    for card, card_keys in keys.items():
+        # '1' must not pick up '12' or '10', whose keys share its leading characters
+        assert scan(everything, *row_keys.history_range(card)) == sorted(card_keys)
+
+
+def test_history_range_since_is_inclusive():
+    start = datetime(2018, 1, 1)
+    times = [start + timedelta(minutes=i) for i in range(10)]
+    keys = [key('1', t) for t in times] + [key('2', t) for t in times]
+    since = times[4]
+    found = scan(keys, *row_keys.history_range('1', since))
+    assert found == sorted(key('1', t) for t in times[4:])
+    # A transaction a millisecond before since is left out, one at the same millisecond is kept
+    assert scan([key('1', since - timedelta(milliseconds=1))], *row_keys.history_range('1', since)) == []
+    assert scan([key('1', since, pos_id=9)], *row_keys.history_range('1', since)) == [key('1', since, pos_id=9)]
+
+
+def test_parse_transaction_dt_formats():
+    expected = datetime(2018, 2, 11, 10, 5, 3)
+    for value in ('11-02-2018 10:05:03', '2018-02-11 10:05:03', '2018-02-11 10:05:03.000000',
+                  '2018-02-11T10:05:03.000Z'):
+        assert row_keys.parse_transaction_dt(value) == expected
+    assert row_keys.parse_transaction_dt('yesterday') is None
+    assert row_keys.parse_transaction_dt(None) is None
+
+
+def test_keys_do_not_depend_on_the_local_time_zone(monkeypatch):
+    import time
+    before = key('1', datetime(2018, 7, 1, 12))
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    try:
+        assert key('1', datetime(2018, 7, 1, 12)) == before
+    finally:
+        monkeypatch.undo()
+        time.tzset()
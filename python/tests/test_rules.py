@@ -0,0 +1,127 @@
+import json
+import math
+
+import numpy as np
+import pytest
+
+import rules
+
+
+def write_rules(tmp_path, definitions):
+    path = tmp_path / 'rules.json'
+    path.write_text(json.dumps({'rules': definitions}))
+    return str(path)
+
+
+def test_default_rules_fire_independently():
+    assert rules.evaluate(100, 50, 300, 10) == ('fraud', ['amount_above_ucl'])
+    assert rules.evaluate(10, 50, 150, 10) == ('fraud', ['low_score'])
+    assert rules.evaluate(10, 50, 300, 1000) == ('fraud', ['impossible_speed'])
+    assert rules.evaluate(100, 50, 150, 1000) == ('fraud', ['amount_above_ucl', 'low_score', 'impossible_speed'])
+    assert rules.evaluate(10, 50, 300, 10) == ('genuine', [])
+
+
+def test_thresholds_are_exclusive():
+    assert rules.fraud_status(50, 50, 200, 900) == 'genuine'
+
+
+def test_strings_are_read_as_numbers():
+    assert rules.evaluate('100', '50.0', '300', '0') == ('fraud', ['amount_above_ucl'])
+
+
+@pytest.mark.parametrize('bad', [None, 'abc', ''])
+def test_missing_or_invalid_input_is_an_error(bad):
+    assert rules.evaluate(bad, 50, 300, 10) == ('error', [])
+    assert rules.evaluate(10, 50, 300, bad) == ('error', [])
+
+
+def test_nan_never_fires():
+    assert rules.evaluate(math.nan, 50, 300, 10) == ('genuine', [])
+    assert rules.evaluate(10, 50, 300, math.nan) == ('genuine', [])
+
+
+RATIO_RULES = [{'name': 'ratio', 'expression': 'amount / UCL', 'op': '>', 'threshold': 2},
+               {'name': 'inverse', 'expression': 'UCL', 'op': '<', 'threshold': 'amount / UCL'}]
+
+
+def test_division_by_zero_does_not_fire(tmp_path):
+    compiled = rules.load_rules(write_rules(tmp_path, RATIO_RULES))
+    assert rules.evaluate_values({'amount': 0, 'UCL': 0}, compiled) == ('genuine', [])
+    assert rules.evaluate_values({'amount': 1, 'UCL': 0}, compiled) == ('genuine', [])
+    assert rules.evaluate_values({'amount': -1, 'UCL': 0}, compiled) == ('genuine', [])
+    assert rules.evaluate_values({'amount': 3, 'UCL': 1}, compiled) == ('fraud', ['ratio', 'inverse'])
+
+
+def test_infinite_inputs_do_not_fire():
+    assert rules.evaluate('inf', 50, 300, 10) == ('genuine', [])
+    assert rules.evaluate(10, 50, '-inf', 10) == ('genuine', [])
+
+
+def test_arithmetic_and_fields(tmp_path):
+    compiled = rules.load_rules(write_rules(tmp_path, [
+        {'name': 'scaled', 'expression': '-amount * 2 + 1', 'op': '<=', 'threshold': 'UCL - score'}]))
+    assert compiled[0].fields == ['UCL', 'amount', 'score']
+    assert rules.evaluate_values({'amount': 5, 'UCL': 0, 'score': 1}, compiled) == ('fraud', ['scaled'])
+    assert rules.evaluate_values({'amount': -5, 'UCL': 0, 'score': 1}, compiled) == ('genuine', [])
+
+
+@pytest.mark.parametrize('definition, message', [
+    ({'name': 'r', 'expression': 'amount', 'op': '==', 'threshold': 1}, 'Unsupported operator'),
+    ({'name': 'r', 'expression': 'amount ** 2', 'op': '>', 'threshold': 1}, 'Unsupported rule expression'),
+    ({'name': 'r', 'expression': '__import__("os")', 'op': '>', 'threshold': 1}, 'Unsupported rule expression'),
+    ({'name': 'r', 'expression': 'amount', 'op': '>', 'threshold': 'limit'}, 'Unknown field in rule r: limit'),
+    ({'name': 'r', 'expression': 'ammount', 'op': '>', 'threshold': 'UCL'}, 'Unknown field in rule r: ammount'),
+])
+def test_invalid_rules_are_rejected(tmp_path, definition, message):
+    with pytest.raises(ValueError, match=message):
+        rules.load_rules(write_rules(tmp_path, [definition]))
+
+
+def test_arrays_match_values():
+    columns = {
+        'amount': np.array([100, 10, 10, 10, None, 10], dtype=object),
+        'UCL': np.array([50, 50, 50, 50, 50, 'x'], dtype=object),
+        'score': np.array([300, 150, 300, 300, 300, 300], dtype=object),
+        'speed': np.array([10, 10, 1000, math.nan, 10, 10], dtype=object),
+    }
+    statuses, fired = rules.evaluate_arrays(columns)
+    for i in range(len(statuses)):
+        status, names = rules.evaluate_values({field: values[i] for field, values in columns.items()})
+        assert statuses[i] == status
+        assert [rule.name for rule, hit in zip(rules.RULES, fired[i]) if hit] == names
+
+
+def test_arrays_match_values_on_division_by_zero(tmp_path):
+    compiled = rules.load_rules(write_rules(tmp_path, RATIO_RULES))
+    columns = {'amount': np.array([0, 1, -1, 3, 1]), 'UCL': np.array([0, 0, 0, 1, 1])}
+    statuses, fired = rules.evaluate_arrays(columns, compiled)
+    for i in range(len(statuses)):
+        status, names = rules.evaluate_values({field: values[i] for field, values in columns.items()}, compiled)
+        assert statuses[i] == status
+        assert [rule.name for rule, hit in zip(compiled, fired[i]) if hit] == names
+
+
+def test_spark_columns_match_values(spark, tmp_path):
+    rows = [
+        ('100', '50', '300', '10'),
+        ('10', '50', '150', '10'),
+        ('10', '50', '300', '1000'),
+        ('10', '50', '300', '10'),
+        (None, '50', '300', '10'),
+        ('abc', '50', '300', '10'),
+        ('10', '50', '300', 'NaN'),
+        ('Infinity', '50', '300', '10'),
+        ('50', '50', '200', '900'),
+        ('1', '0', '300', '10'),
+        ('0', '0', '300', '10'),
+        ('-1', '0', '300', '10'),
+        ('300', '100', '300', '10'),
+    ]
+    df = spark.createDataFrame(rows, 'amount string, UCL string, score string, speed string')
+    # The default rules plus division rules, whose divisor is 0 in some rows
+    compiled = rules.RULES + rules.load_rules(write_rules(tmp_path, RATIO_RULES))
+    status, fired = rules.spark_columns(compiled)
+    results = df.select(status.alias('status'), fired.alias('fired')).collect()
+    for values, result in zip(rows, results):
+        expected = rules.evaluate_values(dict(zip(('amount', 'UCL', 'score', 'speed'), values)), compiled)
+        assert (result['status'], list(result['fired'])) == expected, values
@@ -0,0 +1,46 @@
+from datetime import datetime
+
+import pytest
+
+from db import dao
+from pipeline import scoring
+from pipeline import sink
+from pipeline import stateful
+
+
+class CollectingWriter:
+    """lookup_writer that keeps the look_up_table updates it is handed."""
+
+    def __init__(self):
+        self.updates = []
+
+    def submit(self, updates):
+        self.updates.extend(updates)
+
+
+@pytest.fixture
+def memory_dao(monkeypatch):
+    monkeypatch.setattr(dao.HBaseDao, '_instance', None)
+    monkeypatch.setattr(dao.HBaseDao, '_settings', None)
+    dao.HBaseDao.configure(backend='memory', profile_cache_size=0, fetch_mode='multiget')
+    hdao = dao.HBaseDao.get_instance()
+    hdao.ensure_table(dao.TRANSACTIONS_TABLE, {'info': dict()})
+    hdao.ensure_table(dao.PROFILE_TABLE, {'info': dict()})
+    return hdao
+
+
+def test_profile_update_follows_the_scoring_order(spark, memory_dao):
+    second = datetime(2018, 2, 11, 10, 0, 0)
+    # Two genuine transactions of a card in the same second: the scorers carry the profile forward in
+    # EVENT_ORDER, so the one with the larger member_id is the card's last
+    rows = [('1', 7, 100, 10001, 5, second, 'GENUINE', []),
+            ('1', 9, 100, 33946, 4, second, 'GENUINE', []),
+            ('1', 8, 100, 60601, 6, datetime(2018, 2, 11, 9, 0, 0), 'GENUINE', [])]
+    batch = spark.createDataFrame(rows, stateful.OUTPUT_SCHEMA)
+    expected = sorted(rows, key=lambda row: (row[5], row[1], row[4], row[3], row[2]))[-1]
+    assert scoring.EVENT_ORDER == ["transaction_dt", "member_id", "pos_id", "postcode", "amount"]
+
+    writer = CollectingWriter()
+    sink.HBaseBatchSink(lookup_writer=writer)(batch, 0)
+    [(key, cells)] = writer.updates
+    assert cells[b'info:postcode'] == str(expected[3]).encode('utf-8')
@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+from pipeline import trigger_control
+
+
+def progress(rows, seconds, batch_id=0):
+    return {'batchId': batch_id, 'numInputRows': rows, 'durationMs': {'triggerExecution': int(seconds * 1000)}}
+
+
+def controller(**overrides):
+    settings = dict(target_seconds=10, max_offsets=100000, interval=5.0, cooldown=1)
+    settings.update(overrides)
+    return trigger_control.TriggerController(**settings)
+
+
+def test_empty_batches_are_ignored():
+    control = controller()
+    assert control.observe(progress(0, 0.5)) is None
+    assert control.rate is None and control.pending is None
+
+
+def test_overrun_shrinks_in_proportion_and_stops_waiting():
+    control = controller()
+    # 100000 rows in 20s is 5000 rows/s; half of the 10s target fits 25000
+    assert control.observe(progress(100000, 20)) == (25000, 0.0)
+
+
+def test_backlog_grows_the_cap_from_the_rate():
+    control = controller()
+    # The cap was hit in 2s: 50000 rows/s, half the target is 250000 rows, no wait while behind
+    assert control.observe(progress(100000, 2)) == (250000, 0.0)
+
+
+def test_keeping_up_keeps_the_cap_and_waits_out_the_target():
+    control = controller(interval=0.0)
+    assert control.observe(progress(20000, 1)) == (100000, 9.0)
+
+
+def test_cooldown_holds_changes():
+    control = controller(cooldown=3)
+    assert control.observe(progress(100000, 20, 0)) is None
+    assert control.observe(progress(100000, 20, 1)) is None
+    assert control.observe(progress(100000, 20, 2)) is not None
+
+
+def test_small_changes_are_not_applied():
+    control = controller(interval=8.5)
+    # Keeping up: same cap, interval 9.0 is within min_change of 8.5
+    assert control.observe(progress(20000, 1)) is None
+
+
+def test_limits():
+    assert controller(min_offsets=1000).observe(progress(100, 200))[0] == 1000
+    assert controller(max_offsets_limit=150000).observe(progress(100000, 2))[0] == 150000
+    assert controller(interval=0.0, max_interval=4.0).observe(progress(20000, 1))[1] == 4.0
+
+
+def test_applied_resets_the_cooldown():
+    control = controller(cooldown=2)
+    control.batches_since_change = 2
+    assert control.observe(progress(100000, 20)) == (25000, 0.0)
+    control.applied()
+    assert (control.max_offsets, control.interval, control.pending) == (25000, 0.0, None)
+    assert control.observe(progress(25000, 20)) is None  # Cooling down again
+
+
+def test_unlimited_cap_is_estimated():
+    control = controller(max_offsets=None)
+    assert control.observe(progress(5000, 1))[0] == 25000
+
+
+def test_decisions_are_logged(tmp_path):
+    log = tmp_path / 'trigger.jsonl'
+    control = controller(log_path=str(log))
+    control.observe(progress(0, 0, 0))
+    control.observe(progress(100000, 20, 1))
+    entries = [json.loads(line) for line in log.read_text().splitlines()]
+    assert [(entry['batch_id'], entry['action']) for entry in entries] == [(0, 'hold'), (1, 'adjust')]
+    assert entries[1]['proposed_max_offsets'] == 25000 and entries[1]['batch_seconds'] == pytest.approx(20)